@@ -0,0 +1,132 @@
+import gzip
+import json
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = " \t\n\r"
+# Characters that continue a number cut short as "1." or "2.5e"
+NUMBER_TAIL = ".eE"
+# Arrays of a loader2 test file that are sent one element at a time
+STREAM_KEYS = ("values", "tests")
+
+
+# Open a dataset as text, decompressing it if it is gzipped (eg chicago-1k.json.gz)
+def open_dataset(file_name):
+    with open(file_name, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    if gzipped:
+        return gzip.open(file_name, 'rt', encoding='utf-8')
+    return open(file_name, 'r', encoding='utf-8')
+
+
+class JSONStream:
+    """
+    Incremental JSON reader over a text file. Values are decoded one at a
+    time with JSONDecoder.raw_decode from a buffer that only holds the text
+    not yet consumed, so memory stays flat however large the file is and
+    the first element is available as soon as its text has been read.
+    """
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    # Read more text, dropping what was consumed. Returns False at end of file
+    def fill(self):
+        if self.eof:
+            return False
+        # Grow the read with the pending text so a large value is not re-decoded once per chunk
+        chunk = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def error(self, msg):
+        return json.JSONDecodeError(msg, self.buf, self.pos)
+
+    # Skip whitespace and return the next character, "" at end of file
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise self.error("Expecting '%s'" % char)
+        self.pos += 1
+
+    # Decode the next complete JSON value
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # A number at the end of the buffer, or cut before its fraction or
+            # exponent, may continue in the next chunk
+            at_edge = end == len(self.buf) or self.buf[end] in NUMBER_TAIL
+            if at_edge and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    # Yield the elements of the array starting at the current position
+    def items(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            separator = self.peek()
+            self.pos += 1
+            if separator == "]":
+                return
+            if separator != ",":
+                self.pos -= 1
+                raise self.error("Expecting ',' or ']'")
+
+
+# Yield the elements of a JSON file holding a top-level array
+def iter_array(file_name):
+    with open_dataset(file_name) as f:
+        yield from JSONStream(f).items()
+
+
+# Read a loader2 test file. Its "values"/"tests" array is returned as a lazy
+# iterator when "response" and the path come before it (as in the provided
+# data), otherwise the array is read into a list. Iterators must be consumed
+# before the file is closed.
+def load_test_script(f):
+    stream = JSONStream(f)
+    stream.expect("{")
+    script = {}
+    if stream.peek() == "}":
+        return script
+    while True:
+        key = stream.value()
+        stream.expect(":")
+        header_read = "response" in script and ("post_path" in script or "get_path" in script)
+        if key in STREAM_KEYS and header_read:
+            script[key] = stream.items()
+            return script
+        script[key] = list(stream.items()) if key in STREAM_KEYS else stream.value()
+        separator = stream.peek()
+        stream.pos += 1
+        if separator == "}":
+            return script
+        if separator != ",":
+            stream.pos -= 1
+            raise stream.error("Expecting ',' or '}'")
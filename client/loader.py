@@ -1,22 +1,41 @@
 import json
 import argparse
 import sys
+import time
 import requests
 from requests.exceptions import ConnectionError, ConnectTimeout
+from jsonstream import JSONStream, open_dataset
 
 load_url="inspections"
+txn_url="txn"
 
 
 #TODO extract commont function
 
+# Print the results of a transaction session response
+def print_session_results(r):
+    for result in r.json()["results"]:
+        if result["status"] >= 400:
+            print("Error.  %s" % result)
+        else:
+            print("Resp: %s" % result)
+
+
 def run_loader(config):
-    with open(config.file) as jfile:
-        json_input = json.load(jfile)
+    # Files may be gzipped; arrays are read and sent one record at a time
+    with open_dataset(config.file) as jfile:
         post_url = "http://%s:%s/%s" % (config.server,config.port,load_url)
+        session_url = None
+        if config.session:
+            # Writes are batched in our own session, so loaders can run side by side
+            r = requests.post("http://%s:%s/%s" % (config.server,config.port,txn_url),
+                              json={"size": config.session})
+            session_url = "http://%s:%s/%s/%s" % (config.server,config.port,txn_url,r.json()["token"])
+            post_url = "%s?txn=%s" % (post_url, r.json()["token"])
         print("Using post url to load %s" % post_url)
         if config.single:
             try:
-                r = requests.post(post_url,json=json_input)
+                r = requests.post(post_url,json=json.load(jfile))
                 
                 if r.status_code > 400:
                     print("Error.  %s  Body: %s" % (r,r.content))
@@ -29,10 +48,12 @@ def run_loader(config):
                 print("Unexpected error:", sys.exc_info()[0])
                 raise            
         else:
-            for x in json_input:
+            for x in JSONStream(jfile).items():
                 try:
                     r = requests.post(post_url,json=x,)                    
-                    if r.status_code > 400:
+                    if session_url and r.status_code == 202:
+                        print_session_results(r)
+                    elif r.status_code > 400:
                         print("Error.  %s  Body: %s" % (r,r.content))
                     else: 
                         print("Resp: %s  Body: %s" % (r,r.content))
@@ -42,6 +63,14 @@ def run_loader(config):
                 except:
                     print("Unexpected error:", sys.exc_info()[0])
                     raise
+            if session_url:
+                # The server holds session commits back while a /txn batch is open
+                r = requests.post("%s/commit" % session_url)
+                while r.status_code == 409:
+                    time.sleep(0.1)
+                    r = requests.post("%s/commit" % session_url)
+                print_session_results(r)
+                requests.delete(session_url)
 
 
 if __name__ == "__main__":
@@ -50,6 +79,8 @@ if __name__ == "__main__":
     parser.add_argument("-s","--server", help="Server hostname (default localhost)",default="localhost")
     parser.add_argument("-p","--port", help="Server port (default 30235)",default=30235, type=int)
     parser.add_argument("--single", help="Call a loader for a JSON file with a single entry",action="store_true")
+    parser.add_argument("--session", help="Load through a transaction session that flushes every SESSION records",
+                        default=0, type=int)
     config = parser.parse_args()
     run_loader(config)
 
@@ -5,6 +5,7 @@ import requests
 from requests.exceptions import ConnectionError, ConnectTimeout
 from collections import defaultdict
 from os import path
+from jsonstream import load_test_script, open_dataset
 
 
 class LoaderError(Exception):
@@ -18,7 +19,7 @@ class LoaderError(Exception):
 
 # Validate the script file
 def validate_script(script_file):
-    with open(script_file, 'r') as file_in:
+    with open_dataset(script_file) as file_in:
         script_dir = path.dirname(script_file)
         json_script = json.load(file_in)
         if not isinstance(json_script, list):
@@ -31,8 +32,9 @@ def validate_script(script_file):
             elif "file" in script_obj:
                 if not path.exists(path.join(script_dir, script_obj["file"])):
                     raise LoaderError("File given but does not exist %s" % script_obj["file"])
-                with open(path.join(script_dir, script_obj["file"]), 'r') as test_file:
-                    test_file_json = json.load(test_file)
+                # Only reads up to the values/tests array
+                with open_dataset(path.join(script_dir, script_obj["file"])) as test_file:
+                    test_file_json = load_test_script(test_file)
                     if "response" not in test_file_json:
                         raise LoaderError("Test script file %s missing response %s"
                                           % (test_file, test_file_json.keys()))
@@ -47,8 +49,8 @@ def validate_script(script_file):
 
 # Run a single file which is made up of multiple requests to the same URL
 def run_test_file(server, test_file_path, fail_on_wrong_response=True):
-    with open(test_file_path, 'r') as test_file:
-        script = json.load(test_file)
+    with open_dataset(test_file_path) as test_file:
+        script = load_test_script(test_file)
         response = script["response"]
         if not isinstance(response, list):
             response = [ response ]
@@ -116,7 +118,7 @@ def run_script(script_file, cfg):
     print("Running script %s" % script_file)
     server = "http://%s:%s/" % (cfg.server, cfg.port)
     script_dir = path.dirname(script_file)
-    with open(script_file, 'r') as file_in:
+    with open_dataset(script_file) as file_in:
         json_script = json.load(file_in)
         for script in json_script:
             if "url" in script:
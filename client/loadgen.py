@@ -0,0 +1,237 @@
+import json
+import argparse
+import random
+import threading
+import time
+import requests
+from requests.exceptions import RequestException
+from collections import defaultdict
+from os import path
+
+from jsonstream import load_test_script, open_dataset
+from loader2 import LoaderError, validate_script
+
+# Script urls that change server state rather than read it. Those before the
+# first test file are run once as setup; later ones are not replayed.
+CONTROL_PATHS = ("create", "reset", "seed", "txn", "commit", "abort", "clean")
+
+
+class Operation:
+    def __init__(self, method, label, url, expected, body=None):
+        self.method = method
+        self.label = label
+        self.url = url
+        self.expected = expected
+        self.body = body
+
+
+def expected_codes(response):
+    if not isinstance(response, list):
+        response = [response]
+    return response
+
+
+# Split a loader2 script into setup urls, read operations and write operations
+def load_operations(script_file, server):
+    script_dir = path.dirname(script_file)
+    setup, reads, writes = [], [], []
+    with open_dataset(script_file) as file_in:
+        json_script = json.load(file_in)
+    seen_file = False
+    for script in json_script:
+        if "url" in script:
+            control = script["url"].split("/")[0] in CONTROL_PATHS
+            if control and not seen_file:
+                setup.append("%s%s" % (server, script["url"]))
+            elif not control:
+                reads.append(Operation("GET", "GET %s" % script["url"].split("/")[0],
+                                       "%s%s" % (server, script["url"]),
+                                       expected_codes(script["response"])))
+            continue
+        seen_file = True
+        with open_dataset(path.join(script_dir, script["file"])) as test_file:
+            test_script = load_test_script(test_file)
+            expected = expected_codes(test_script["response"])
+            if "post_path" in test_script:
+                post_url = "%s%s" % (server, test_script["post_path"])
+                for v in test_script["values"]:
+                    writes.append(Operation("POST", "POST %s" % test_script["post_path"],
+                                            post_url, expected, v))
+            else:
+                get_urlbase = "%s%s" % (server, test_script["get_path"])
+                for v in test_script["tests"]:
+                    if "inputs" in v:
+                        get_url = "%s/%s" % (get_urlbase, str(v["inputs"]))
+                    else:
+                        get_url = get_urlbase
+                    reads.append(Operation("GET", "GET %s" % test_script["get_path"],
+                                           get_url, expected))
+    return setup, reads, writes
+
+
+class LoadRun:
+    """
+    Replays read and write operations from worker threads, either as fast as
+    `concurrency` workers allow or at a fixed `rate` of requests per second.
+    With a rate, latency is measured from each request's scheduled send time
+    so a slow server is not hidden by the client waiting for it.
+    """
+    def __init__(self, reads, writes, cfg):
+        self.reads = reads
+        self.writes = writes
+        self.cfg = cfg
+        self.random = random.Random(cfg.seed)
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.write_index = 0
+        self.samples = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+        self.unexpected = defaultdict(int)
+
+    # Pick the next operation and its scheduled send time, or None when done
+    def next_operation(self):
+        with self.lock:
+            if self.cfg.requests and self.sent >= self.cfg.requests:
+                return None
+            if time.perf_counter() >= self.end:
+                return None
+            scheduled = None
+            if self.cfg.rate:
+                scheduled = self.start + self.sent / self.cfg.rate
+            self.sent += 1
+            read = self.random.random() < self.cfg.read_ratio
+            if (read and self.reads) or not self.writes:
+                return self.random.choice(self.reads), scheduled
+            op = self.writes[self.write_index % len(self.writes)]
+            self.write_index += 1
+            return op, scheduled
+
+    def worker(self):
+        session = requests.Session()
+        while True:
+            nxt = self.next_operation()
+            if nxt is None:
+                return
+            op, scheduled = nxt
+            if scheduled is not None:
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                start = scheduled
+            else:
+                start = time.perf_counter()
+            status = None
+            try:
+                if op.method == "POST":
+                    r = session.post(op.url, json=op.body)
+                else:
+                    r = session.get(op.url)
+                status = r.status_code
+            except RequestException:
+                pass
+            end = time.perf_counter()
+            if end < self.measure_from:
+                continue
+            with self.lock:
+                self.samples[op.label].append((end - start) * 1000)
+                self.statuses[op.label][str(status)] += 1
+                if status is None or status >= 500:
+                    self.errors[op.label] += 1
+                elif status not in op.expected:
+                    self.unexpected[op.label] += 1
+
+    def run(self):
+        self.start = time.perf_counter()
+        self.measure_from = self.start + self.cfg.warmup
+        self.end = self.measure_from + self.cfg.duration
+        workers = [threading.Thread(target=self.worker)
+                   for _ in range(self.cfg.concurrency)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = max(time.perf_counter() - self.measure_from, 1e-9)
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        paths = {}
+        for label, samples in sorted(self.samples.items()):
+            paths[label] = summarize(samples, elapsed, self.errors[label],
+                                     self.unexpected[label])
+            paths[label]["statuses"] = dict(self.statuses[label])
+        all_samples = [s for samples in self.samples.values() for s in samples]
+        total = summarize(all_samples, elapsed, sum(self.errors.values()),
+                          sum(self.unexpected.values()))
+        return {"elapsed_seconds": elapsed, "total": total, "paths": paths}
+
+
+def percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def summarize(samples, elapsed, errors, unexpected):
+    samples = sorted(samples)
+    result = {"requests": len(samples),
+              "throughput_rps": len(samples) / elapsed,
+              "errors": errors,
+              "error_rate": errors / len(samples) if samples else 0.0,
+              "unexpected_status": unexpected}
+    if samples:
+        result.update({"mean_ms": sum(samples) / len(samples),
+                       "p50_ms": percentile(samples, 50),
+                       "p95_ms": percentile(samples, 95),
+                       "p99_ms": percentile(samples, 99),
+                       "max_ms": samples[-1]})
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay loader2 scripts as load and report latency per path")
+    parser.add_argument("-f", "--file", dest="files", action="append", required=True,
+                        help="Input json script file, may be given more than once")
+    parser.add_argument("-s", "--server", help="Server hostname (default localhost)", default="localhost")
+    parser.add_argument("-p", "--port", help="Server port (default 30235)", default=30235, type=int)
+    parser.add_argument("-c", "--concurrency", help="Worker threads (default 4)", default=4, type=int)
+    parser.add_argument("-r", "--rate", help="Target requests per second across all workers "
+                        "(default: as fast as the workers go)", default=0, type=float)
+    parser.add_argument("--read-ratio", help="Fraction of requests that are reads (default 0.8)",
+                        default=0.8, type=float)
+    parser.add_argument("-d", "--duration", help="Seconds measured after warmup (default 10)",
+                        default=10, type=float)
+    parser.add_argument("-n", "--requests", help="Stop after this many requests, warmup included",
+                        default=0, type=int)
+    parser.add_argument("--warmup", help="Seconds of load not included in the report (default 2)",
+                        default=2, type=float)
+    parser.add_argument("--seed", help="Seed for the read/write mix (default 0)", default=0, type=int)
+    parser.add_argument("--no-setup", help="Do not call the create/reset/txn urls that start the scripts",
+                        default=False, action="store_true")
+    parser.add_argument("-o", "--out", help="Write the JSON report to this file")
+    config = parser.parse_args()
+    try:
+        server = "http://%s:%s/" % (config.server, config.port)
+        setup, reads, writes = [], [], []
+        for script_file in config.files:
+            validate_script(script_file)
+            script_setup, script_reads, script_writes = load_operations(script_file, server)
+            setup += script_setup
+            reads += script_reads
+            writes += script_writes
+        if not reads and not writes:
+            raise LoaderError("No requests to replay in %s" % config.files)
+        if not config.no_setup:
+            for url in setup:
+                requests.get(url)
+        results = LoadRun(reads, writes, config).run()
+        report = {"benchmark": "loadgen",
+                  "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "params": vars(config),
+                  "results": results}
+        if config.out:
+            with open(config.out, 'w') as f:
+                json.dump(report, f, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+    except LoaderError as e:
+        print("LoaderError: %s" % e.message)
@@ -0,0 +1,5 @@
+# The client modules are scripts, not a package; import them from client/
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
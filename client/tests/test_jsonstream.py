@@ -0,0 +1,41 @@
+import gzip
+import io
+import json
+
+import pytest
+
+from jsonstream import JSONStream, iter_array, load_test_script
+
+NUMBERS = '[1.5, 2, -2.5e10, 1e+5, -0.25E-3, 12345, 0, 3.0]'
+
+
+@pytest.mark.parametrize('chunk_size', range(1, 12))
+def test_numbers_split_at_chunk_boundaries(chunk_size):
+    stream = JSONStream(io.StringIO(NUMBERS), chunk_size)
+    assert list(stream.items()) == json.loads(NUMBERS)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7])
+def test_mixed_values(chunk_size):
+    text = '[{"name": "DELI", "lat": 41.9, "tags": ["a.e", true, null]}, -7]'
+    stream = JSONStream(io.StringIO(text), chunk_size)
+    assert list(stream.items()) == json.loads(text)
+
+
+def test_number_cut_short_at_end_of_file():
+    with pytest.raises(json.JSONDecodeError):
+        list(JSONStream(io.StringIO('[1.]'), 1).items())
+
+
+def test_gzipped_array(tmp_path):
+    file_name = tmp_path / 'values.json.gz'
+    with gzip.open(file_name, 'wt', encoding='utf-8') as f:
+        f.write(NUMBERS)
+    assert list(iter_array(file_name)) == json.loads(NUMBERS)
+
+
+def test_test_script_values_are_streamed():
+    text = '{"response": 201, "post_path": "/tweet", "values": [{"v": 2.5}]}'
+    script = load_test_script(io.StringIO(text))
+    assert script['response'] == 201
+    assert list(script['values']) == [{'v': 2.5}]
@@ -0,0 +1,90 @@
+# Latency of /restaurants/all-by-inspection as the cluster size grows.
+# Compares the single-query create_json_output with the previous N+1 lookup.
+import argparse
+import json
+import tempfile
+from os import path
+
+from benchutil import open_db, time_calls, write_results
+from db import dict_factory
+import clean_restaurants
+
+
+def legacy_json_output(db, inspection_id):
+    '''
+    The original N+1 implementation, kept here as the comparison baseline.
+    '''
+    c = db.conn.cursor()
+    c.row_factory = dict_factory
+    c.execute('''SELECT * FROM ri_restaurants WHERE id IN (
+                 SELECT restaurant_id FROM ri_inspections WHERE id = ?)''',
+              [inspection_id])
+    main_restaurant = c.fetchall()
+    c = db.conn.cursor()
+    c.row_factory = dict_factory
+    c.execute('''SELECT original_rest_id FROM ri_linked
+                 WHERE primary_rest_id IN (
+                 SELECT restaurant_id FROM ri_inspections WHERE id = ?)''',
+              [inspection_id])
+    linked_rests = []
+    ids = []
+    for linked_id in c.fetchall():
+        c2 = db.conn.cursor()
+        c2.row_factory = dict_factory
+        c2.execute('SELECT * FROM ri_restaurants WHERE id = ?',
+                   [linked_id['original_rest_id']])
+        linked_rests.append(c2.fetchall())
+        ids.append(linked_id['original_rest_id'])
+    return json.dumps({"primary": main_restaurant, "linked": linked_rests,
+                       "ids": ids})
+
+
+def load_cluster(db, size, background):
+    '''
+    Loads `background` unrelated restaurants and one cluster of `size`
+    restaurants linked to a primary. Returns the primary's inspection id.
+    '''
+    c = db.conn.cursor()
+    rows = [('REST %d' % i, '%d W MAIN ST' % i, '60601')
+            for i in range(background + size)]
+    c.executemany('''INSERT INTO ri_restaurants (name, address, zip)
+                     VALUES (?, ?, ?)''', rows)
+    c.executemany('''INSERT INTO ri_inspections (id, restaurant_id)
+                     VALUES (?, ?)''',
+                  [(str(i), i) for i in range(1, background + size + 1)])
+    primary = background + 1
+    c.executemany('''INSERT INTO ri_linked (primary_rest_id, original_rest_id)
+                     VALUES (?, ?)''',
+                  [(primary, r_id) for r_id in range(primary, primary + size)])
+    db.conn.commit()
+    return str(primary)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1,10,100,1000",
+                        help="Comma separated cluster sizes")
+    parser.add_argument("--background", default=10000, type=int,
+                        help="Unrelated restaurants loaded next to the cluster")
+    parser.add_argument("--repeat", default=200, type=int)
+    parser.add_argument("-o", "--out", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in [int(s) for s in args.sizes.split(",")]:
+            db = open_db(path.join(tmp, "bench%d.db" % size))
+            inspection_id = load_cluster(db, size, args.background)
+            # Both implementations must agree before timing them
+            assert (json.loads(clean_restaurants.create_json_output(db, inspection_id))
+                    == json.loads(legacy_json_output(db, inspection_id)))
+            results.append({
+                'cluster_size': size,
+                'single_query': time_calls(
+                    lambda: clean_restaurants.create_json_output(db, inspection_id),
+                    args.repeat),
+                'n_plus_one': time_calls(
+                    lambda: legacy_json_output(db, inspection_id), args.repeat),
+            })
+            db.conn.close()
+    write_results("all_by_inspection", vars(args), results, args.out)
@@ -0,0 +1,167 @@
+# Shared helpers for the in-process benchmarks in this directory.
+# Benchmarks are run from the server directory, e.g. python3 bench/<name>.py
+from contextlib import contextmanager
+from os import path
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+SERVER_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from db import DB
+from normalize import match_keys
+
+# Seconds between polls of a starting server, and before giving up on it
+POLL_SECONDS = 0.005
+START_TIMEOUT = 30
+
+
+@contextmanager
+def in_server_dir():
+    '''
+    Runs the block from the server directory, where DB looks up the schema
+    scripts, and returns to the previous directory after it.
+    '''
+    cwd = os.getcwd()
+    os.chdir(SERVER_DIR)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def open_db(db_file, create=True, factory=sqlite3.Connection):
+    '''
+    Opens a connection configured like server.py and optionally runs
+    create.sql on it. Returns the DB wrapper.
+    '''
+    conn = sqlite3.connect(db_file, factory=factory)
+    db = DB(conn)
+    if create:
+        with in_server_dir():
+            db.create_script()
+    return db
+
+
+def load_restaurants(db, records):
+    '''
+    Writes each record's restaurant and match keys straight to the tables,
+    with ids from 1, skipping the inspection ingest path to keep large sizes
+    quick. Returns the records written.
+    '''
+    c = db.conn.cursor()
+    records = list(records)
+    for r_id, record in enumerate(records, 1):
+        c.execute('''INSERT INTO ri_restaurants (id, name, address, city,
+                     state, zip, latitude, longitude) VALUES
+                     (?, ?, ?, ?, ?, ?, ?, ?)''',
+                  [r_id, record['name'], record['address'], record['city'],
+                   record['state'], record['zip'], record['latitude'],
+                   record['longitude']])
+        c.execute('INSERT INTO ri_restaurant_keys VALUES (?, ?, ?)',
+                  [r_id] + list(match_keys(record['name'], record['address'])))
+    db.conn.commit()
+    return records
+
+
+def ingest(db, records):
+    '''
+    Ingests records through the normal ingest path in one transaction.
+    Returns the (response code, restaurant id) of each.
+    '''
+    db.begin_transaction()
+    results = [db.add_inspection_for_restaurant(record) for record in records]
+    db.commit_active()
+    return results
+
+
+def time_calls(fn, repeat):
+    '''
+    Calls fn repeat times and returns latency statistics in milliseconds.
+    '''
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {'runs': repeat,
+            'mean_ms': statistics.mean(samples),
+            'p50_ms': samples[len(samples) // 2],
+            'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            'max_ms': samples[-1]}
+
+
+def write_results(name, params, results, out_file=None):
+    '''
+    Writes benchmark results as JSON to out_file, or stdout if not given.
+    '''
+    report = {'benchmark': name,
+              'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'params': params,
+              'results': results}
+    if out_file:
+        with open(out_file, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def http_ok(url, body=None):
+    '''
+    Sends a GET (or a POST of body as JSON) and returns True on a 2xx.
+    '''
+    data = None if body is None else json.dumps(body).encode('utf-8')
+    req = urllib.request.Request(url, data,
+                                 {'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req) as resp:
+            resp.read()
+            return 200 <= resp.status < 300
+    except (urllib.error.URLError, ConnectionError):
+        return False
+
+
+def start_server(workdir, args=()):
+    '''
+    Launches server.py from workdir, where it keeps its database, on a free
+    port. Returns the process and its base URL once /hello answers.
+    '''
+    if not path.exists(path.join(workdir, 'schema')):
+        shutil.copytree(path.join(SERVER_DIR, 'schema'),
+                        path.join(workdir, 'schema'))
+    port = free_port()
+    base = 'http://localhost:%d' % port
+    proc = subprocess.Popen([sys.executable, path.join(SERVER_DIR, 'server.py'),
+                             '-p', str(port)] + list(args),
+                            cwd=workdir, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    start = time.perf_counter()
+    while not http_ok(base + '/hello'):
+        if proc.poll() is not None:
+            raise RuntimeError('server.py exited with %d' % proc.returncode)
+        if time.perf_counter() - start > START_TIMEOUT:
+            stop_server(proc)
+            raise RuntimeError('server.py did not answer /hello')
+        time.sleep(POLL_SECONDS)
+    return proc, base
+
+
+def stop_server(proc):
+    proc.terminate()
+    proc.wait()
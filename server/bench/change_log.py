@@ -0,0 +1,91 @@
+# Cost of the change log: ingest time with and without a registered consumer
+# (the triggers only log while one exists), and keeping a derived count of
+# inspections per zip current after a small batch of writes by consuming the
+# log against recounting the tables.
+import argparse
+import tempfile
+import time
+from collections import Counter
+from os import path
+
+from benchutil import ingest, open_db, write_results
+from changes import ChangeConsumer
+from synthetic import Generator
+
+
+def zip_counts(db):
+    c = db.conn.cursor()
+    c.execute('''SELECT zip, count(*) FROM ri_inspections
+                 JOIN ri_restaurants ON ri_restaurants.id = restaurant_id
+                 GROUP BY zip''')
+    return Counter(dict(c.fetchall()))
+
+
+class ZipCounts:
+    """
+    Inspections per zip, kept current from the change log.
+    """
+    def __init__(self):
+        self.counts = Counter()
+
+    def rebuild(self, db):
+        self.counts = zip_counts(db)
+
+    def apply(self, db, changes):
+        inserted = [change.row_id for change in changes
+                    if change.table == 'ri_inspections' and change.op == 'insert']
+        c = db.conn.cursor()
+        for row_id in inserted:
+            c.execute('''SELECT zip FROM ri_inspections
+                         JOIN ri_restaurants ON ri_restaurants.id = restaurant_id
+                         WHERE ri_inspections.rowid = ?''', [row_id])
+            row = c.fetchone()
+            if row is not None:
+                self.counts[row[0]] += 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000",
+                        help="Comma separated inspection counts loaded first")
+    parser.add_argument("--batch", default=100, type=int,
+                        help="Inspections written before each refresh")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("-o", "--out", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_records in [int(n) for n in args.sizes.split(',')]:
+            row = {'inspections': n_records}
+            for logged in (False, True):
+                db = open_db(path.join(tmp, 'changes%d%d.db' % (n_records, logged)))
+                gen = Generator(args.seed)
+                records = gen.records(n_records + args.batch)
+                derived = ZipCounts()
+                consumer = ChangeConsumer('zip_counts', derived.rebuild,
+                                          derived.apply)
+                if logged:
+                    consumer.consume(db)
+                name = 'logged' if logged else 'unlogged'
+                start = time.perf_counter()
+                ingest(db, [next(records) for _ in range(n_records)])
+                row['%s_ingest_seconds' % name] = time.perf_counter() - start
+                if logged:
+                    consumer.consume(db)
+                    ingest(db, [next(records) for _ in range(args.batch)])
+                    start = time.perf_counter()
+                    consumer.consume(db)
+                    row['consume_ms'] = (time.perf_counter() - start) * 1000
+                    start = time.perf_counter()
+                    recount = zip_counts(db)
+                    row['recount_ms'] = (time.perf_counter() - start) * 1000
+                    assert recount == derived.counts
+                    c = db.conn.cursor()
+                    c.execute('SELECT count(*) FROM ri_changes')
+                    row['log_entries_after_compaction'] = c.fetchone()[0]
+                db.conn.close()
+            row['ingest_overhead'] = (row['logged_ingest_seconds']
+                                      / row['unlogged_ingest_seconds'] - 1)
+            results.append(row)
+    write_results("change_log", vars(args), results, args.out)
@@ -0,0 +1,114 @@
+# Cleaning benchmark suite: loads synthetic dirty data in-process and runs
+# clean_all_restaurants and clean_by_block against it, scoring the resulting
+# clusters against the generator's ground truth.
+import argparse
+import multiprocessing
+import resource
+import tempfile
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+
+from benchutil import ingest, open_db, write_results
+from synthetic import Generator
+import clean_restaurants
+
+CLEANERS = {
+    'clean_all_restaurants': clean_restaurants.clean_all_restaurants,
+    'clean_by_block': clean_restaurants.clean_by_block,
+}
+
+
+def pair_count(n):
+    return n * (n - 1) // 2
+
+
+def score_clusters(db, entities):
+    '''
+    Pairwise precision and recall of ri_linked against the ground truth.
+    '''
+    c = db.conn.cursor()
+    c.execute('SELECT primary_rest_id, original_rest_id FROM ri_linked')
+    clusters = defaultdict(list)
+    for primary_id, original_id in c.fetchall():
+        clusters[primary_id].append(original_id)
+
+    predicted = sum(pair_count(len(ids)) for ids in clusters.values())
+    true_positive = sum(pair_count(n) for ids in clusters.values()
+                        for n in Counter(entities[i] for i in ids).values())
+    actual = sum(pair_count(n) for n in Counter(entities.values()).values())
+    return {'predicted_pairs': predicted,
+            'true_pairs': actual,
+            'precision': true_positive / predicted if predicted else 1.0,
+            'recall': true_positive / actual if actual else 1.0}
+
+
+def run_case(method, n_restaurants, seed, dup_rate, typo_rate):
+    '''
+    Runs one (method, size) case. Executed in a fresh process so that the
+    peak RSS reported belongs to this case alone.
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        db = open_db(path.join(tmp, 'clean.db'))
+        gen = Generator(seed, dup_rate, typo_rate=typo_rate)
+        start = time.perf_counter()
+        records = list(gen.records(n_restaurants))
+        entities = {r_id: record['entity'] for record, (_, r_id)
+                    in zip(records, ingest(db, records))}
+        n_records = len(records)
+        load_time = time.perf_counter() - start
+
+        # Count every similarity computation made by the cleaner
+        pairs = [0]
+        get_similarity = clean_restaurants.get_similarity
+        def counting_similarity(fields, i, j):
+            pairs[0] += 1
+            return get_similarity(fields, i, j)
+        clean_restaurants.get_similarity = counting_similarity
+
+        start = time.perf_counter()
+        CLEANERS[method](db)
+        clean_time = time.perf_counter() - start
+
+        result = {'method': method,
+                  'restaurants': n_restaurants,
+                  'records': n_records,
+                  'restaurant_rows': len(entities),
+                  'load_seconds': load_time,
+                  'clean_seconds': clean_time,
+                  'pairs_scored': pairs[0],
+                  # ru_maxrss is reported in kilobytes on Linux
+                  'peak_rss_mb': resource.getrusage(
+                      resource.RUSAGE_SELF).ru_maxrss / 1024}
+        result.update(score_clusters(db, entities))
+        db.conn.close()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="Comma separated restaurant counts, eg 1000,10000,100000,1000000")
+    parser.add_argument("--methods", default=",".join(CLEANERS),
+                        help="Comma separated cleaning functions to run")
+    parser.add_argument("--all-limit", default=10000, type=int,
+                        help="Skip clean_all_restaurants above this size (it is quadratic)")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--dup-rate", default=0.2, type=float)
+    parser.add_argument("--typo-rate", default=0.5, type=float)
+    parser.add_argument("-o", "--out", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        for method in args.methods.split(","):
+            if method == 'clean_all_restaurants' and size > args.all_limit:
+                results.append({'method': method, 'restaurants': size,
+                                'skipped': 'above --all-limit'})
+                continue
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                results.append(pool.submit(run_case, method, size, args.seed,
+                                           args.dup_rate, args.typo_rate).result())
+    write_results("cleaning", vars(args), results, args.out)
@@ -0,0 +1,105 @@
+# Server startup cost of the tweet match index for a growing number of
+# restaurants: rebuilding the index file from the database against mapping a
+# current one, plus per-tweet matching through the index against the SQL
+# lookups it replaces.
+import argparse
+import os
+import random
+import tempfile
+import time
+from os import path
+
+from benchutil import load_restaurants, open_db, time_calls, write_results
+from db import get_all_ngrams
+from match_index import MatchIndex, index_file
+from synthetic import Generator
+
+
+def tweets(records, n_tweets, seed):
+    '''
+    Tweets posted next to random restaurants, half of them naming it.
+    '''
+    rnd = random.Random(seed)
+    out = []
+    for i in range(n_tweets):
+        record = rnd.choice(records)
+        name = record['name'] if i % 2 else 'somewhere'
+        out.append({'key': 'tweet%d' % i,
+                    'lat': record['latitude'],
+                    'long': record['longitude'],
+                    'text': 'Lunch at %s today' % name})
+    return out
+
+
+def startup(db, index_name, rebuild, repeat):
+    '''
+    Median seconds for a server start to get a current index, with the file
+    removed first (rebuild) or left in place (mapped).
+    '''
+    samples = []
+    for _ in range(repeat):
+        if rebuild and path.exists(index_name):
+            os.remove(index_name)
+        index = MatchIndex(index_name)
+        start = time.perf_counter()
+        rebuilt = index.refresh(db)
+        samples.append(time.perf_counter() - start)
+        assert rebuilt == rebuild
+        index.close()
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def lookups(db, index, sample):
+    '''
+    Latency of matching the sample tweets through the index and through SQL,
+    as DB.match_and_add_tweet does without the inserts.
+    '''
+    def indexed():
+        for tweet in sample:
+            if index.is_fresh(db):
+                index.locate(tweet['lat'], tweet['long'])
+                index.match_names(get_all_ngrams(tweet['text']))
+
+    def sql():
+        for tweet in sample:
+            db.check_tweet_location(tweet['lat'], tweet['long'])
+            db.check_tweet_name(tweet['text'])
+
+    return indexed, sql
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="Comma separated restaurant counts")
+    parser.add_argument("--tweets", default=200, type=int,
+                        help="Tweets matched per latency sample")
+    parser.add_argument("--repeat", default=3, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("-o", "--out", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_restaurants in [int(n) for n in args.sizes.split(',')]:
+            db_file = path.join(tmp, 'match%d.db' % n_restaurants)
+            db = open_db(db_file)
+            records = load_restaurants(
+                db, Generator(args.seed).records(n_restaurants))
+            index_name = index_file(db_file)
+            row = {'restaurants': n_restaurants,
+                   'rebuild_seconds': startup(db, index_name, True, args.repeat),
+                   'mapped_seconds': startup(db, index_name, False, args.repeat),
+                   'index_bytes': path.getsize(index_name)}
+            index = MatchIndex(index_name)
+            index.refresh(db)
+            indexed, sql = lookups(db, index,
+                                   tweets(records, args.tweets, args.seed))
+            for name, fn in (('index', indexed), ('sql', sql)):
+                stats = time_calls(fn, args.repeat)
+                row['%s_ms_per_tweet' % name] = stats['p50_ms'] / args.tweets
+            index.close()
+            db.conn.close()
+            results.append(row)
+    write_results("match_index", vars(args), results, args.out)
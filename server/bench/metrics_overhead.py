@@ -0,0 +1,49 @@
+# Cost of leaving /metrics instrumentation on: per-statement SQL timing on
+# the point lookups behind GET /restaurants/<id>, and one route observation.
+import argparse
+import tempfile
+import time
+from os import path
+
+from benchutil import open_db, time_calls, write_results
+from metrics import METRICS, TimedConnection
+from row_decoding import load_restaurant
+
+
+def lookup(db):
+    db.find_restaurant(1)
+    db.find_inspections(1)
+
+
+def observe_request():
+    labels = (('method', 'GET'), ('route', '/restaurants/<restaurant_id:int>'))
+    start = time.perf_counter()
+    METRICS.observe('http_request_duration_seconds', labels,
+                    time.perf_counter() - start)
+    METRICS.inc('http_requests_total', labels + (('status', 200),))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--inspections", default=10, type=int,
+                        help="Inspections of the looked up restaurant")
+    parser.add_argument("--repeat", default=20000, type=int)
+    parser.add_argument("-o", "--out", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = path.join(tmp, 'metrics.db')
+        plain = open_db(db_file)
+        load_restaurant(plain, args.inspections, 400)
+        timed = open_db(db_file, create=False, factory=TimedConnection)
+        results = {
+            'lookup_plain': time_calls(lambda: lookup(plain), args.repeat),
+            'lookup_sql_timing': time_calls(lambda: lookup(timed), args.repeat),
+            'route_observation': time_calls(observe_request, args.repeat),
+        }
+        plain.conn.close()
+        timed.conn.close()
+    results['sql_timing_overhead_pct'] = 100 * (
+        results['lookup_sql_timing']['mean_ms']
+        / results['lookup_plain']['mean_ms'] - 1)
+    write_results("metrics_overhead", vars(args), results, args.out)
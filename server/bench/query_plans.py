@@ -0,0 +1,211 @@
+# Index advisor: runs a representative workload (ingest, tweets, reads,
+# exports and both cleaners) against a synthetic database, records every
+# statement issued from db.py and clean_restaurants.py with the function that
+# issued it, and runs EXPLAIN QUERY PLAN on each. Full scans of large tables
+# are reported. tests/test_query_plans.py fails on a scan in one of HOT_QUERIES.
+import argparse
+import re
+import sqlite3
+import sys
+import tempfile
+from os import path
+
+from benchutil import ingest, open_db, write_results
+from synthetic import Generator
+import clean_restaurants
+import db as db_module
+
+# Functions on the request or ingest path that must never scan a large table
+HOT_QUERIES = ('DB.check_restaurant', 'DB.find_inspection',
+               'DB.find_restaurant', 'DB.find_restaurant_withinspection',
+               'DB.query_inspections', 'DB.check_tweet_location',
+               'DB.check_tweet_name', 'DB.find_tweets',
+               'DB.query_by_restaurant_ids', 'DB.query_zip_rollup',
+               'DB.find_cluster_rollup', 'get_cluster_by_inspection',
+               'create_block')
+# Statements that can have a query plan
+PLANNED = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'CREATE TEMP TABLE')
+SOURCE_FILES = (path.abspath(db_module.__file__),
+                path.abspath(clean_restaurants.__file__))
+TABLE_ALIAS = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?',
+                         re.IGNORECASE)
+SCAN_DETAIL = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: USING (?:COVERING )?INDEX (\w+))?')
+NOT_ALIASES = {'ON', 'WHERE', 'JOIN', 'LEFT', 'INNER', 'GROUP', 'ORDER',
+               'LIMIT', 'USING'}
+
+
+def issuing_function():
+    '''
+    Returns the qualified name of the innermost db.py or clean_restaurants.py
+    function on the stack.
+    '''
+    frame = sys._getframe(2)
+    while frame is not None:
+        if path.abspath(frame.f_code.co_filename) in SOURCE_FILES:
+            return getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+class PlanCursor(sqlite3.Cursor):
+    """
+    Cursor that explains each distinct statement the first time it runs,
+    while the tables it reads (eg temp blocks) still exist.
+    """
+    def execute(self, sql, parameters=()):
+        self.connection.explain(sql, parameters, issuing_function())
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        if seq_of_parameters:
+            self.connection.explain(sql, seq_of_parameters[0],
+                                    issuing_function())
+        return super().executemany(sql, seq_of_parameters)
+
+
+class PlanConnection(sqlite3.Connection):
+    """
+    Connection collecting the query plan of every statement run through its
+    cursors, keyed by issuing function and statement text.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.plans = {}
+
+    def cursor(self, factory=PlanCursor):
+        return super().cursor(factory)
+
+    def explain(self, sql, parameters, function):
+        statement = ' '.join(sql.split())
+        if function is None or (function, statement) in self.plans:
+            return
+        if not statement.upper().startswith(PLANNED):
+            return
+        c = sqlite3.Cursor(self)
+        c.execute('EXPLAIN QUERY PLAN ' + sql, parameters)
+        self.plans[function, statement] = [row[3] for row in c.fetchall()]
+        c.close()
+
+
+def table_names(statement):
+    '''
+    Maps each table name and alias in the statement to its table.
+    '''
+    names = {}
+    for table, alias in TABLE_ALIAS.findall(statement):
+        names[table] = table
+        if alias and alias.upper() not in NOT_ALIASES:
+            names[alias] = table
+    return names
+
+
+def run_workload(db, gen, n_restaurants, n_tweets):
+    '''
+    Exercises the statements the server issues, with real parameters.
+    '''
+    records = list(gen.records(n_restaurants))
+    r_ids = [r_id for _, r_id in ingest(db, records)]
+    # Again, so the duplicate inspection path runs too
+    db.add_inspection_for_restaurant(records[0])
+    for i, record in enumerate(records[:n_tweets]):
+        db.match_and_add_tweet({'key': 'tweet%d' % i,
+                                'lat': record['latitude'],
+                                'long': record['longitude'],
+                                'text': 'Eating at %s' % record['name']})
+    inspection_id = records[0]['inspection_id']
+    r_id = r_ids[0]
+    db.find_restaurant(r_id)
+    db.find_inspections(r_id)
+    db.find_inspections(r_id, limit=10, after=inspection_id, violations=False)
+    list(db.iter_inspections(r_id))
+    db.find_restaurant_withinspection(inspection_id)
+    db.find_tweets(r_id)
+    db.find_restaurants(r_ids[:50])
+    db.find_inspections_by_restaurants(r_ids[:50])
+    db.find_tweets_by_restaurants(r_ids[:50])
+    db.count_inspections()
+    db.get_counters()
+    db.query_zip_rollup(records[0]['zip'], '2015-01', '2016-12')
+    db.find_cluster_rollup(r_id)
+    for args in ((None, None, None, None), (['60601'], '2015-01-01', None, 1)):
+        db.query_export_restaurants(*args)[0].close()
+        db.query_export_inspections(*args + (False,))[0].close()
+        db.query_export_inspections(*args + (True,))[0].close()
+    clean_restaurants.clean_by_block(db)
+    clean_restaurants.clean_all_restaurants(db)
+    clean_restaurants.mark_as_clean(db)
+    clean_restaurants.create_json_output(db, inspection_id)
+
+
+def table_sizes(db):
+    c = db.conn.cursor()
+    c.execute('''SELECT name FROM sqlite_master WHERE type = 'table'
+                 AND name NOT LIKE 'sqlite_%' ''')
+    sizes = {}
+    for (table,) in c.fetchall():
+        c.execute('SELECT COUNT(*) FROM %s' % table)
+        sizes[table] = c.fetchone()[0]
+    return sizes
+
+
+def partial_indexes(db):
+    c = db.conn.cursor()
+    c.execute('''SELECT name FROM sqlite_master WHERE type = 'index'
+                 AND sql LIKE '% WHERE %' ''')
+    return {row[0] for row in c.fetchall()}
+
+
+def advise(plans, sizes, partial, large_rows):
+    '''
+    Returns one entry per statement with the large tables it scans and
+    whether the issuing function is a hot query. Scanning a partial index
+    only reads the rows it covers, so it is not counted.
+    '''
+    report = []
+    for (function, statement), plan in sorted(plans.items()):
+        names = table_names(statement)
+        scans = []
+        for detail in plan:
+            match = SCAN_DETAIL.match(detail)
+            if not match or match.group(2) in partial:
+                continue
+            table = names.get(match.group(1), match.group(1))
+            if sizes.get(table, 0) >= large_rows:
+                scans.append(table)
+        report.append({'function': function,
+                       'hot': function in HOT_QUERIES,
+                       'statement': statement,
+                       'plan': plan,
+                       'large_table_scans': scans})
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--restaurants", default=2000, type=int)
+    parser.add_argument("--tweets", default=1000, type=int,
+                        help="Tweets matched, one near each of the first records")
+    parser.add_argument("--large-rows", default=1000, type=int,
+                        help="Tables with at least this many rows count as large")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("-o", "--out", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = open_db(path.join(tmp, 'plans.db'), factory=PlanConnection)
+        run_workload(db, Generator(args.seed), args.restaurants,
+                     args.tweets)
+        sizes = table_sizes(db)
+        report = advise(db.conn.plans, sizes, partial_indexes(db),
+                        args.large_rows)
+        db.conn.close()
+    flagged = [entry for entry in report if entry['large_table_scans']]
+    write_results("query_plans", vars(args),
+                  {'table_rows': sizes,
+                   'statements': len(report),
+                   'scans': flagged,
+                   'hot_query_scans': [entry for entry in flagged
+                                       if entry['hot']],
+                   'all': report},
+                  args.out)
@@ -0,0 +1,59 @@
+# Time to reset a database file holding a growing number of inspections:
+# re-running create.sql (the previous /reset) against copying the in-memory
+# template over the file with the backup API.
+import argparse
+import tempfile
+import time
+from itertools import islice
+from os import path
+
+from benchutil import in_server_dir, ingest, open_db, write_results
+from db import build_template
+from synthetic import Generator
+
+
+def timed_reset(db, db_file, gen, n_records, reset):
+    '''
+    Loads n_records then times one reset. Returns the file size before the
+    reset and the reset time in milliseconds.
+    '''
+    ingest(db, islice(gen.records(n_records), n_records))
+    size = path.getsize(db_file)
+    start = time.perf_counter()
+    reset()
+    elapsed = (time.perf_counter() - start) * 1000
+    assert db.count_inspections() == 0
+    return size, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="0,1000,10000,50000",
+                        help="Comma separated inspection counts loaded before each reset")
+    parser.add_argument("--repeat", default=3, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("-o", "--out", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    results = []
+    # create.sql is re-run by the timed resets
+    with in_server_dir(), tempfile.TemporaryDirectory() as tmp:
+        template = build_template()
+        db_file = path.join(tmp, 'reset.db')
+        db = open_db(db_file)
+        for n_records in [int(n) for n in args.sizes.split(',')]:
+            row = {'inspections': n_records}
+            for name, reset in (('create_script', db.create_script),
+                                ('restore_template',
+                                 lambda: db.restore_template(template))):
+                samples = []
+                for _ in range(args.repeat):
+                    gen = Generator(args.seed)
+                    size, elapsed = timed_reset(db, db_file, gen, n_records, reset)
+                    samples.append(elapsed)
+                samples.sort()
+                row['db_bytes'] = size
+                row['%s_ms' % name] = samples[len(samples) // 2]
+            results.append(row)
+        db.conn.close()
+    write_results("reset", vars(args), results, args.out)
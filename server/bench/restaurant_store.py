@@ -0,0 +1,115 @@
+# Memory of the cleaning input held as dict rows, tuple rows and a
+# RestaurantStore, reported per million rows, and the previous slicing pair
+# loop against index iteration over the store.
+import argparse
+import tempfile
+import time
+import tracemalloc
+from os import path
+
+from benchutil import load_restaurants, open_db, write_results
+from db import dict_factory
+from restaurant_store import STORE_FIELDS, RestaurantStore
+from synthetic import Generator
+
+QUERY = '''SELECT %s FROM ri_restaurants
+           JOIN ri_restaurant_keys ON restaurant_id = id''' % ', '.join(STORE_FIELDS)
+
+
+def dict_rows(db):
+    c = db.conn.cursor()
+    c.row_factory = dict_factory
+    c.execute(QUERY)
+    return c.fetchall()
+
+
+def tuple_rows(db):
+    c = db.conn.cursor()
+    c.execute(QUERY)
+    return c.fetchall()
+
+
+def store_rows(db):
+    c = db.conn.cursor()
+    c.execute(QUERY)
+    return RestaurantStore.from_cursor(c)
+
+
+def measure(fn, db, n_rows):
+    '''
+    Returns the memory still allocated by fn's result and the load time.
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(db)
+    load_time = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(result) == n_rows
+    del result
+    # A MB per million rows is a byte per row
+    return {'mb_per_million_rows': size / n_rows,
+            'peak_mb': peak / 2 ** 20,
+            'load_seconds': load_time}
+
+
+def slicing_pairs(rows):
+    '''
+    The previous compute_similarities loop, without the scoring.
+    '''
+    pairs = 0
+    for i, record1 in enumerate(rows):
+        for record2 in rows[i+1:]:
+            pairs += 1
+    return pairs
+
+
+def index_pairs(store):
+    pairs = 0
+    n = len(store)
+    for i in range(n):
+        for j in range(i + 1, n):
+            pairs += 1
+    return pairs
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--restaurants", default=100000, type=int)
+    parser.add_argument("--pair-rows", default=3000, type=int,
+                        help="Rows compared pairwise in the loop timings")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("-o", "--out", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = open_db(path.join(tmp, 'store.db'))
+        load_restaurants(db, Generator(args.seed).records(args.restaurants))
+        n_rows = len(tuple_rows(db))
+        memory = {'dict_rows': measure(dict_rows, db, n_rows),
+                  'tuple_rows': measure(tuple_rows, db, n_rows),
+                  'restaurant_store': measure(store_rows, db, n_rows)}
+        store_mb = memory['restaurant_store']['mb_per_million_rows']
+        for name in ('dict_rows', 'tuple_rows'):
+            memory['saving_vs_%s_mb_per_million_rows' % name] = (
+                memory[name]['mb_per_million_rows'] - store_mb)
+
+        rows = tuple_rows(db)[:args.pair_rows]
+        store = RestaurantStore()
+        store.extend(rows)
+        pairs, slicing_time = timed(slicing_pairs, rows)
+        assert (pairs, pairs) == (index_pairs(store), len(rows) * (len(rows) - 1) // 2)
+        _, index_time = timed(index_pairs, store)
+        loops = {'rows': len(rows), 'pairs': pairs,
+                 'slicing_loop_seconds': slicing_time,
+                 'index_loop_seconds': index_time}
+        db.conn.close()
+    write_results("restaurant_store", vars(args),
+                  {'rows': n_rows, 'memory': memory, 'pair_loops': loops},
+                  args.out)
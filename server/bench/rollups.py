@@ -0,0 +1,75 @@
+# Aggregate queries answered from the rollup tables against grouping the
+# inspections themselves: pass/fail counts of a zip by month, and the risk
+# distribution of a restaurant's cluster.
+import argparse
+import random
+import tempfile
+from itertools import islice
+from os import path
+
+from benchutil import ingest, open_db, time_calls, write_results
+from synthetic import Generator
+
+ZIP_SCAN = '''SELECT substr(i.inspection_date_iso, 1, 7), i.results, i.risk,
+                     count(*)
+              FROM ri_inspections i
+              JOIN ri_restaurants r ON r.id = i.restaurant_id
+              WHERE r.zip = ?
+              GROUP BY 1, 2, 3'''
+CLUSTER_SCAN = '''SELECT i.results, i.risk, count(*)
+                  FROM ri_inspections i
+                  WHERE i.restaurant_id IN (
+                      SELECT original_rest_id FROM ri_linked
+                      WHERE primary_rest_id = ?
+                      UNION SELECT ?)
+                  GROUP BY 1, 2'''
+
+
+def load(db, gen, n_records):
+    '''
+    Ingests n_records generated inspections in one transaction and returns
+    the zips and restaurant ids seen.
+    '''
+    records = list(islice(gen.records(n_records), n_records))
+    r_ids = {r_id for _, r_id in ingest(db, records)}
+    r_ids.discard(None)
+    return sorted({record['zip'] for record in records}), sorted(r_ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000",
+                        help="Comma separated inspection counts")
+    parser.add_argument("--repeat", default=200, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("-o", "--out", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_records in [int(n) for n in args.sizes.split(',')]:
+            db = open_db(path.join(tmp, 'rollups%d.db' % n_records))
+            zips, r_ids = load(db, Generator(args.seed), n_records)
+            rnd = random.Random(args.seed)
+            c = db.conn.cursor()
+
+            def zip_scan():
+                c.execute(ZIP_SCAN, [rnd.choice(zips)])
+                c.fetchall()
+
+            def cluster_scan():
+                r_id = rnd.choice(r_ids)
+                c.execute(CLUSTER_SCAN, [r_id, r_id])
+                c.fetchall()
+
+            row = {'inspections': n_records}
+            for name, fn in (
+                    ('zip_rollup', lambda: db.query_zip_rollup(rnd.choice(zips))),
+                    ('zip_scan', zip_scan),
+                    ('cluster_rollup',
+                     lambda: db.find_cluster_rollup(rnd.choice(r_ids))),
+                    ('cluster_scan', cluster_scan)):
+                row[name] = time_calls(fn, args.repeat)
+            db.conn.close()
+            results.append(row)
+    write_results("rollups", vars(args), results, args.out)
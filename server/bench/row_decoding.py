@@ -0,0 +1,94 @@
+# Rows/sec of find_inspections and /restaurants/<id> serialization, comparing
+# the previous dict_factory + json.dumps path with tuple rows encoded directly.
+import argparse
+import json
+import tempfile
+import time
+from os import path
+
+from benchutil import open_db, write_results
+from db import INSPECTION_COLUMNS, dict_factory
+
+
+def load_restaurant(db, n_inspections, violation_chars):
+    '''
+    Loads one restaurant with n_inspections inspections.
+    '''
+    c = db.conn.cursor()
+    c.execute('''INSERT INTO ri_restaurants (name, address, city, state, zip,
+                 latitude, longitude) VALUES ('BIG CHAIN', '1 N STATE ST ',
+                 'CHICAGO', 'IL', '60601', 41.88, -87.62)''')
+    violations = ('38. INSECTS, RODENTS, & ANIMALS NOT PRESENT - Comments: '
+                  * (violation_chars // 56 + 1))[:violation_chars]
+    c.executemany('''INSERT INTO ri_inspections (id, risk, inspection_date,
+                     inspection_type, results, violations, restaurant_id)
+                     VALUES (?, 'Risk 1 (High)', '01/23/2020', 'Canvass',
+                     'Pass', ?, 1)''',
+                  [(str(2000000 + i), violations) for i in range(n_inspections)])
+    db.conn.commit()
+
+
+def dict_inspections(db):
+    c = db.conn.cursor()
+    c.row_factory = dict_factory
+    # The columns the API returns; inspection_date_iso is internal
+    c.execute('SELECT %s FROM ri_inspections WHERE restaurant_id = (?)'
+              % ', '.join(INSPECTION_COLUMNS), ['1'])
+    return c.fetchall()
+
+
+def dict_restaurant_json(db):
+    c = db.conn.cursor()
+    c.row_factory = dict_factory
+    c.execute('SELECT * FROM ri_restaurants WHERE id = (?)', ['1'])
+    output = {'restaurant': c.fetchall(), 'inspections': dict_inspections(db)}
+    return json.dumps(output)
+
+
+def tuple_restaurant_json(db):
+    restaurant = db.find_restaurant(1)
+    inspections = db.find_inspections(1)
+    return '{"restaurant": %s, "inspections": %s}' % (
+        restaurant.to_json(), inspections.to_json())
+
+
+def rows_per_second(fn, rows, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return rows * repeat / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--inspections", default=5000, type=int)
+    parser.add_argument("--violation-chars", default=400, type=int)
+    parser.add_argument("--repeat", default=20, type=int)
+    parser.add_argument("-o", "--out", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = open_db(path.join(tmp, 'rows.db'))
+        load_restaurant(db, args.inspections, args.violation_chars)
+        # The new encoder must produce exactly the same bytes
+        assert tuple_restaurant_json(db) == dict_restaurant_json(db)
+        n = args.inspections
+        results = {
+            'find_inspections': {
+                'before_rows_per_sec': rows_per_second(
+                    lambda: dict_inspections(db), n, args.repeat),
+                'after_rows_per_sec': rows_per_second(
+                    lambda: db.find_inspections(1), n, args.repeat),
+            },
+            'restaurant_json': {
+                'before_rows_per_sec': rows_per_second(
+                    lambda: dict_restaurant_json(db), n, args.repeat),
+                'after_rows_per_sec': rows_per_second(
+                    lambda: tuple_restaurant_json(db), n, args.repeat),
+            },
+        }
+        db.conn.close()
+    for result in results.values():
+        result['speedup'] = (result['after_rows_per_sec']
+                             / result['before_rows_per_sec'])
+    write_results("row_decoding", vars(args), results, args.out)
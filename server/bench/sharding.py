@@ -0,0 +1,126 @@
+# Ingest throughput of one SQLite file against zip-range shards, through the
+# server. Several loader processes each POST the synthetic records of one zip
+# range, with /txn/--txn-size batching. The single-file server handles one
+# request at a time; with --shards it handles them on threads and each shard
+# keeps its own batch and lock, so loaders of different zip ranges do not
+# wait on one another. Optionally times /clean on each layout.
+import argparse
+import multiprocessing
+import sqlite3
+import tempfile
+import time
+from bisect import bisect_right
+from os import path
+
+from benchutil import http_ok, start_server, stop_server, write_results
+from db import DB
+from shards import default_bounds, shard_files
+from synthetic import Generator
+
+
+def loader(base, records, start_event, results):
+    start_event.wait()
+    start = time.perf_counter()
+    failed = sum(not http_ok(base + '/inspections', record)
+                 for record in records)
+    results.put({'records': len(records), 'failed': failed,
+                 'seconds': time.perf_counter() - start})
+
+
+def split_by_zip(records, loaders):
+    '''
+    Gives each loader the records of one zip range, as a feed per area would.
+    '''
+    bounds = default_bounds(loaders)
+    slices = [[] for _ in range(loaders)]
+    for record in records:
+        slices[bisect_right(bounds, record['zip'])].append(record)
+    return slices
+
+
+def count_inspections(db_file):
+    conn = sqlite3.connect(db_file)
+    try:
+        return DB(conn).count_inspections()
+    finally:
+        conn.close()
+
+
+def run_layout(workdir, n_shards, slices, txn_size, clean, scaling):
+    '''
+    Starts a server with n_shards (1 for the single-file layout), ingests
+    each slice from its own process and optionally cleans.
+    '''
+    args = ['--shards', str(n_shards)] if n_shards > 1 else []
+    if scaling:
+        args.append('-s')
+    proc, base = start_server(workdir, args)
+    try:
+        http_ok(base + '/create')
+        http_ok(base + '/txn/%d' % txn_size)
+        context = multiprocessing.get_context('spawn')
+        start_event = context.Event()
+        results = context.Queue()
+        procs = [context.Process(target=loader,
+                                 args=(base, records, start_event, results))
+                 for records in slices]
+        for p in procs:
+            p.start()
+        # Processes are started before timing, so interpreter startup is not counted
+        time.sleep(0.5)
+        start = time.perf_counter()
+        start_event.set()
+        per_loader = [results.get() for _ in procs]
+        http_ok(base + '/commit')
+        elapsed = time.perf_counter() - start
+        for p in procs:
+            p.join()
+        row = {'shards': n_shards,
+               'elapsed_seconds': elapsed,
+               'failed': sum(r['failed'] for r in per_loader)}
+        if clean:
+            start = time.perf_counter()
+            http_ok(base + '/clean')
+            row['clean_seconds'] = time.perf_counter() - start
+    finally:
+        stop_server(proc)
+    files = (shard_files('insp.db', n_shards) if n_shards > 1
+             else ['insp.db'])
+    row['inspections_per_shard'] = [count_inspections(path.join(workdir, f))
+                                    for f in files]
+    count = sum(row['inspections_per_shard'])
+    assert count == sum(len(records) for records in slices)
+    row['records_per_second'] = count / elapsed
+    return row
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--restaurants", default=2000, type=int)
+    parser.add_argument("--shards", default=4, type=int,
+                        help="Shards compared against a single file")
+    parser.add_argument("--loaders", default=4, type=int,
+                        help="Concurrent loader processes, one per zip range")
+    parser.add_argument("--txn-size", default=50, type=int,
+                        help="Records ingested per transaction")
+    parser.add_argument("--clean", default=False, action="store_true",
+                        help="Also time /clean on each layout")
+    parser.add_argument("--scaling", default=False, action="store_true",
+                        help="Clean with clean_by_block")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("-o", "--out", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    records = list(Generator(args.seed).records(args.restaurants))
+    slices = split_by_zip(records, args.loaders)
+    results = {'records': len(records)}
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_shards in (1, args.shards):
+            workdir = path.join(tmp, 'shards%d' % n_shards)
+            results['shards_%d' % n_shards] = run_layout(
+                workdir, n_shards, slices, args.txn_size, args.clean,
+                args.scaling)
+    results['ingest_speedup'] = (
+        results['shards_%d' % args.shards]['records_per_second'] /
+        results['shards_1']['records_per_second'])
+    write_results("sharding", vars(args), results, args.out)
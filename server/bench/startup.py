@@ -0,0 +1,109 @@
+# Server startup cost: the time to import server.py in a fresh interpreter,
+# and the time from launching `python3 server.py` to the first successful
+# /hello and /restaurants/<id>, with and without the background warmup. With
+# --check, an import of server.py over --budget-ms exits non-zero;
+# tests/test_startup.py fails if it is over IMPORT_BUDGET_MS or loads one of
+# LAZY_MODULES.
+import argparse
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+from benchutil import (SERVER_DIR, http_ok, ingest, open_db, start_server,
+                       stop_server, write_results)
+from synthetic import Generator
+
+# Loaded by /clean, /tweet and the profiler on first use, never by the import
+LAZY_MODULES = ('clean_restaurants', 'jellyfish', 'statistics', 'profiling',
+                'pstats', 'cProfile', 'multiprocessing', 'concurrent.futures')
+# Milliseconds importing server.py may take beyond importing bottle
+IMPORT_BUDGET_MS = 40
+
+
+def import_times():
+    '''
+    Imports server.py in a fresh interpreter under -X importtime. Returns the
+    cumulative milliseconds of server, of bottle, and the modules imported.
+    '''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           'import server'],
+                          cwd=SERVER_DIR, capture_output=True, text=True,
+                          check=True)
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, us, name = line.split('|')
+        if us.strip().isdigit():
+            cumulative[name.strip()] = int(us) / 1000
+    return cumulative['server'], cumulative.get('bottle', 0), set(cumulative)
+
+
+def first_requests(workdir, restaurant_id, warmup):
+    '''
+    Launches the server in workdir and polls it. Returns milliseconds from
+    launch to the first 200 from /hello and then from /restaurants/<id>.
+    '''
+    start = time.perf_counter()
+    proc, base = start_server(workdir, [] if warmup else ['--no-warmup'])
+    try:
+        hello = time.perf_counter() - start
+        if not http_ok('%s/restaurants/%d' % (base, restaurant_id)):
+            raise RuntimeError('/restaurants/%d failed' % restaurant_id)
+        restaurant = time.perf_counter() - start
+    finally:
+        stop_server(proc)
+    return hello * 1000, restaurant * 1000
+
+
+def median(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--restaurants", default=1000, type=int,
+                        help="Restaurants in the database the server opens")
+    parser.add_argument("--repeat", default=5, type=int)
+    parser.add_argument("--budget-ms", default=IMPORT_BUDGET_MS, type=float,
+                        help="Import time allowed for server.py beyond bottle")
+    parser.add_argument("--check", default=False, action="store_true",
+                        help="Exit with status 1 if the import is over budget")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("-o", "--out", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    samples = [import_times() for _ in range(args.repeat)]
+    server_ms = median([s[0] for s in samples])
+    bottle_ms = median([s[1] for s in samples])
+    own_ms = median([s[0] - s[1] for s in samples])
+    loaded = sorted(set(LAZY_MODULES) & samples[0][2])
+    results = {'bytecode_cache': not sys.dont_write_bytecode,
+               'import_server_ms': server_ms,
+               'import_bottle_ms': bottle_ms,
+               'import_own_ms': own_ms,
+               'budget_ms': args.budget_ms,
+               'lazy_modules_loaded': loaded}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # server.py reads insp.db from its working directory
+        db = open_db(path.join(tmp, 'insp.db'))
+        ingest(db, Generator(args.seed).records(args.restaurants))
+        c = db.conn.cursor()
+        c.execute('SELECT min(id) FROM ri_restaurants')
+        restaurant_id = c.fetchone()[0]
+        db.conn.close()
+        for warmup in (True, False):
+            runs = [first_requests(tmp, restaurant_id, warmup)
+                    for _ in range(args.repeat)]
+            name = 'warmup' if warmup else 'no_warmup'
+            results[name] = {'first_hello_ms': median([r[0] for r in runs]),
+                             'first_restaurant_ms': median([r[1] for r in runs])}
+    write_results("startup", vars(args), results, args.out)
+    if args.check and own_ms > args.budget_ms:
+        print("Importing server.py took %.1fms beyond bottle, over the "
+              "%.1fms budget" % (own_ms, args.budget_ms), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,160 @@
+# Seeded generator of Chicago-style dirty inspection records with ground truth.
+# Can also be run directly to write a dataset usable by client/loader.py.
+import argparse
+import json
+import random
+
+NAME_WORDS = ['GOLDEN', 'DRAGON', 'PIZZA', 'TACO', 'GRILL', 'KITCHEN', 'CAFE',
+              'DELI', 'EXPRESS', 'HOUSE', 'GARDEN', 'PALACE', 'CHICAGO', 'LUCKY',
+              'STAR', 'BURGER', 'SUSHI', 'THAI', 'GYROS', 'BAKERY', 'MARKET',
+              'FOOD', 'BBQ', 'NOODLE', 'CHICKEN', 'WINGS', 'DONUTS', 'COFFEE',
+              'TAQUERIA', 'PIZZERIA', 'BISTRO', 'TAVERN', 'LOUNGE', 'SUBS',
+              'ORIGINAL', 'FAMOUS', 'FRESH', 'ROYAL', 'GREEN', 'SUNRISE']
+OWNER_NAMES = ["MARIO'S", "JIMMY'S", "LOU'S", "ROSA'S", "AL'S", "MAX'S",
+               "NICK'S", "TONY'S", "ANNA'S", "JOE'S"]
+NAME_SUFFIXES = ['', '', '', ' INC', ' LLC', ' #1', ' #2']
+STREETS = ['STATE', 'CLARK', 'HALSTED', 'ASHLAND', 'WESTERN', 'PULASKI',
+           'CICERO', 'MADISON', 'ROOSEVELT', 'DIVISION', 'CHICAGO', 'NORTH',
+           'FULLERTON', 'BELMONT', 'IRVING PARK', 'LAWRENCE', 'DEVON',
+           '63RD', '79TH', '87TH', '95TH', 'COTTAGE GROVE', 'KEDZIE', 'MILWAUKEE']
+STREET_TYPES = ['ST', 'AVE', 'BLVD', 'RD', 'DR']
+ABBREVIATIONS = {'ST': 'STREET', 'AVE': 'AVENUE', 'BLVD': 'BOULEVARD',
+                 'RD': 'ROAD', 'DR': 'DRIVE', 'N': 'NORTH', 'S': 'SOUTH',
+                 'E': 'EAST', 'W': 'WEST'}
+DIRECTIONS = ['N', 'S', 'E', 'W']
+ZIPS = ['606%02d' % i for i in range(1, 61)]
+RISKS = ['Risk 1 (High)', 'Risk 2 (Medium)', 'Risk 3 (Low)']
+RESULTS = ['Pass', 'Pass w/ Conditions', 'Fail', 'Out of Business', 'No Entry']
+INSPECTION_TYPES = ['Canvass', 'License', 'Complaint', 'Canvass Re-Inspection',
+                    'Short Form Complaint']
+VIOLATIONS = ['', '', '38. INSECTS, RODENTS, & ANIMALS NOT PRESENT - Comments: '
+              'OBSERVED RODENT DROPPINGS IN STORAGE AREA.',
+              '47. FOOD & NON-FOOD CONTACT SURFACES CLEANABLE, PROPERLY '
+              'DESIGNED, CONSTRUCTED & USED - Comments: MUST REPAIR SHELVING.',
+              '18. NO EVIDENCE OF RODENT OR INSECT OUTER OPENINGS PROTECTED - '
+              'Comments: NO HOT WATER AT HAND SINK.']
+LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+def typo(text, rng):
+    '''
+    Applies one random character edit: deletion, insertion, substitution or
+    transposition of adjacent characters.
+    '''
+    if len(text) < 2:
+        return text
+    i = rng.randrange(len(text) - 1)
+    op = rng.randrange(4)
+    if op == 0:
+        return text[:i] + text[i + 1:]
+    if op == 1:
+        return text[:i] + rng.choice(LETTERS) + text[i:]
+    if op == 2:
+        return text[:i] + rng.choice(LETTERS) + text[i + 1:]
+    return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+
+
+def variant(text, rng, typo_rate):
+    '''
+    Produces a dirty variant of a name or address: expanded abbreviations,
+    dropped punctuation, case noise and random typos.
+    '''
+    words = text.split()
+    if rng.random() < 0.3:
+        words = [ABBREVIATIONS.get(w, w) for w in words]
+    out = ' '.join(words)
+    if rng.random() < 0.2:
+        out = out.replace("'", '').replace('#', '')
+    if rng.random() < 0.1:
+        out = out.title()
+    # Typo count is geometric in typo_rate, so most variants have 0-1 edits
+    while rng.random() < typo_rate:
+        out = typo(out, rng)
+    return out
+
+
+class Generator:
+    '''
+    Generates restaurants and dirty duplicate records for them. Every record
+    carries the id of the entity it was generated from as ground truth.
+    '''
+    def __init__(self, seed=0, dup_rate=0.2, max_dups=3, typo_rate=0.5,
+                 zip_error_rate=0.0):
+        self.rng = random.Random(seed)
+        self.dup_rate = dup_rate
+        self.max_dups = max_dups
+        self.typo_rate = typo_rate
+        self.zip_error_rate = zip_error_rate
+        self.next_inspection = 1000000
+
+    def entity(self, entity_id):
+        rng = self.rng
+        if rng.random() < 0.3:
+            name = rng.choice(OWNER_NAMES) + ' ' + rng.choice(NAME_WORDS)
+        else:
+            name = ' '.join(rng.sample(NAME_WORDS, rng.randint(1, 3)))
+        name += rng.choice(NAME_SUFFIXES)
+        address = '%d %s %s %s' % (rng.randint(1, 12000), rng.choice(DIRECTIONS),
+                                   rng.choice(STREETS), rng.choice(STREET_TYPES))
+        return {'entity': entity_id,
+                'name': name,
+                'address': address + ' ',
+                'zip': rng.choice(ZIPS),
+                'latitude': 41.65 + rng.random() * 0.37,
+                'longitude': -87.85 + rng.random() * 0.33}
+
+    def record(self, base, dirty):
+        rng = self.rng
+        self.next_inspection += 1
+        name, address, zip_code = base['name'], base['address'], base['zip']
+        if dirty:
+            name = variant(name, rng, self.typo_rate)
+            address = variant(address, rng, self.typo_rate)
+            if rng.random() < self.zip_error_rate:
+                zip_code = rng.choice(ZIPS)
+        return {
+            'inspection_id': str(self.next_inspection),
+            'name': name,
+            'aka_name': name,
+            'license_number': str(rng.randint(1000000, 2999999)),
+            'facility_type': 'Restaurant',
+            'risk': rng.choice(RISKS),
+            'address': address,
+            'city': 'CHICAGO',
+            'state': 'IL',
+            'zip': zip_code,
+            'date': '%02d/%02d/%d' % (rng.randint(1, 12), rng.randint(1, 28),
+                                      rng.randint(2010, 2021)),
+            'inspection_type': rng.choice(INSPECTION_TYPES),
+            'results': rng.choice(RESULTS),
+            'violations': rng.choice(VIOLATIONS),
+            'latitude': str(base['latitude']),
+            'longitude': str(base['longitude']),
+            'location': '(%s, %s)' % (base['longitude'], base['latitude']),
+            'entity': base['entity'],
+        }
+
+    def records(self, n_restaurants):
+        '''
+        Yields records for n_restaurants entities: one clean record each and,
+        with probability dup_rate, 1..max_dups dirty duplicates.
+        '''
+        for entity_id in range(n_restaurants):
+            base = self.entity(entity_id)
+            yield self.record(base, False)
+            if self.rng.random() < self.dup_rate:
+                for _ in range(self.rng.randint(1, self.max_dups)):
+                    yield self.record(base, True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--restaurants", default=1000, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--dup-rate", default=0.2, type=float)
+    parser.add_argument("--typo-rate", default=0.5, type=float)
+    parser.add_argument("-o", "--out", help="Output json file", required=True)
+    args = parser.parse_args()
+    gen = Generator(args.seed, args.dup_rate, typo_rate=args.typo_rate)
+    with open(args.out, 'w') as f:
+        json.dump(list(gen.records(args.restaurants)), f, indent=1)
@@ -0,0 +1,99 @@
+# Searching inspection violations through the FTS5 index against the
+# LIKE '%...%' scan it replaces: a ranked first page and a count of all
+# matches, for common, phrase and rare terms over a growing number of
+# inspections.
+import argparse
+import random
+import tempfile
+import time
+from os import path
+
+from benchutil import load_restaurants, open_db, time_calls, write_results
+from synthetic import VIOLATIONS, Generator
+
+# Term searched -> the same text for LIKE
+TERMS = (('rodent', 'rodent'),
+         ('"no hot water"', 'no hot water'),
+         ('shelving', 'shelving'),
+         ('mice', 'mice'))
+# Share of inspections mentioning the rare term
+RARE_RATE = 0.001
+RESTAURANTS_PER_INSPECTION = 0.05
+LIKE_PAGE = '''SELECT id, restaurant_id, violations FROM ri_inspections
+               WHERE violations LIKE ? LIMIT 20'''
+LIKE_COUNT = 'SELECT count(*) FROM ri_inspections WHERE violations LIKE ?'
+FTS_COUNT = '''SELECT count(*) FROM ri_inspections_fts
+               WHERE ri_inspections_fts MATCH ?'''
+
+
+def violations_text(rng):
+    parts = [v for v in rng.sample(VIOLATIONS, rng.randint(1, 3)) if v]
+    if rng.random() < RARE_RATE:
+        parts.append('Comments: OBSERVED MICE IN BASEMENT.')
+    return ' | '.join(parts)
+
+
+def load(db, n_inspections, seed):
+    '''
+    Writes restaurants and inspections straight to the tables (the index
+    triggers still run), skipping the ingest path to keep large sizes quick.
+    Returns the load time in seconds.
+    '''
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    records = load_restaurants(db, Generator(seed).records(
+        max(1, int(n_inspections * RESTAURANTS_PER_INSPECTION))))
+    c = db.conn.cursor()
+    c.executemany('''INSERT INTO ri_inspections (id, inspection_date,
+                     inspection_date_iso, results, risk, violations,
+                     restaurant_id) VALUES (?, '01/23/2020', '2020-01-23',
+                     'Pass', 'Risk 1 (High)', ?, ?)''',
+                  ((str(i), violations_text(rng),
+                    rng.randint(1, len(records)))
+                   for i in range(n_inspections)))
+    db.conn.commit()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="100000,1000000",
+                        help="Comma separated inspection counts")
+    parser.add_argument("--repeat", default=5, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("-o", "--out", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_inspections in [int(n) for n in args.sizes.split(',')]:
+            db_file = path.join(tmp, 'search%d.db' % n_inspections)
+            db = open_db(db_file)
+            row = {'inspections': n_inspections,
+                   'load_seconds': load(db, n_inspections, args.seed),
+                   'db_bytes': path.getsize(db_file),
+                   'terms': {}}
+            c = db.conn.cursor()
+            for term, text in TERMS:
+                like = '%' + text + '%'
+                c.execute(FTS_COUNT, [term])
+                fts_matches = c.fetchone()[0]
+                c.execute(LIKE_COUNT, [like])
+                like_matches = c.fetchone()[0]
+                row['terms'][term] = {
+                    'fts_matches': fts_matches,
+                    'like_matches': like_matches,
+                    'fts_page': time_calls(
+                        lambda: db.search_violations(term), args.repeat),
+                    'like_page': time_calls(
+                        lambda: c.execute(LIKE_PAGE, [like]).fetchall(),
+                        args.repeat),
+                    'fts_count': time_calls(
+                        lambda: c.execute(FTS_COUNT, [term]).fetchall(),
+                        args.repeat),
+                    'like_count': time_calls(
+                        lambda: c.execute(LIKE_COUNT, [like]).fetchall(),
+                        args.repeat)}
+            db.conn.close()
+            results.append(row)
+    write_results("violation_search", vars(args), results, args.out)
@@ -0,0 +1,127 @@
+# Bounded LRU cache of serialized GET responses, invalidated by tag on writes
+from collections import OrderedDict, namedtuple
+import hashlib
+import threading
+
+CacheEntry = namedtuple('CacheEntry', ['body', 'etag', 'tags'])
+
+
+def restaurant_tag(restaurant_id):
+    '''
+    Tag for responses built from a restaurant row or its inspections.
+    '''
+    return ('restaurant', int(restaurant_id))
+
+
+def tweets_tag(restaurant_id):
+    '''
+    Tag for responses built from a restaurant's tweet matches.
+    '''
+    return ('tweets', int(restaurant_id))
+
+
+class ResponseCache:
+    """
+    Stores response bytes by key (the request path) together with an ETag and
+    the set of tags the response was built from. Writers call invalidate()
+    with the tags they touched; entries are evicted in LRU order once either
+    max_entries or max_bytes is exceeded.
+
+    Writes inside an open transaction are remembered so that abort() can
+    evict anything cached from uncommitted data. Methods take a lock, as the
+    --shards server handles requests on several threads.
+    """
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.tag_keys = {}
+        self.size = 0
+        self.pending = set()
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        """
+        Returns the entry for key, or None, marking it most recently used.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, tags):
+        """
+        Caches body (bytes) under key and returns the new entry.
+        """
+        etag = '"%s"' % hashlib.blake2b(body, digest_size=8).hexdigest()
+        entry = CacheEntry(body, etag, frozenset(tags))
+        if len(body) > self.max_bytes:
+            return entry
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = entry
+            self.size += len(body)
+            for tag in entry.tags:
+                self.tag_keys.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.discard(next(iter(self.entries)))
+            return entry
+
+    def discard(self, key):
+        """
+        Removes a single key if present.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return
+            self.size -= len(entry.body)
+            for tag in entry.tags:
+                keys = self.tag_keys.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.tag_keys[tag]
+
+    def invalidate(self, *tags):
+        """
+        Evicts every entry built from any of the given tags.
+        """
+        with self.lock:
+            for tag in tags:
+                self.pending.add(tag)
+                for key in list(self.tag_keys.get(tag, ())):
+                    self.discard(key)
+
+    def commit(self, tags=None):
+        """
+        The open transaction committed; its writes are now visible to all.
+        With tags, only the writes to those were committed, as when one
+        shard commits its batch.
+        """
+        with self.lock:
+            if tags is None:
+                self.pending.clear()
+            else:
+                self.pending.difference_update(tags)
+
+    def abort(self):
+        """
+        The open transaction rolled back; evict anything cached since its
+        writes, as it may reflect rows that no longer exist.
+        """
+        with self.lock:
+            pending = list(self.pending)
+            self.invalidate(*pending)
+            self.pending.clear()
+
+    def clear(self):
+        """
+        Drops every entry.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.tag_keys.clear()
+            self.size = 0
+            self.pending.clear()
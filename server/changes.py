@@ -0,0 +1,89 @@
+# In-process consumers of the change log. Triggers append (table, op, rowid,
+# txn) to ri_changes for every row written to ri_restaurants, ri_inspections,
+# ri_linked and ri_tweetmatch, and (table, op, restaurant_id, txn) for
+# ri_restaurant_keys, while any consumer is registered; a consumer
+# tails the log from its cursor in ri_change_cursors, so keeping a derived
+# structure current costs time in the number of changes, not the table sizes.
+from collections import namedtuple
+
+from metrics import METRICS
+
+# Changes read from the log per batch
+CHANGE_BATCH = 1000
+
+Change = namedtuple('Change', ['seq', 'table', 'op', 'row_id', 'txn'])
+
+METRICS.describe('change_log_consumed_total', 'counter',
+                 'Change log entries applied, by consumer.')
+METRICS.describe('change_log_rebuilds_total', 'counter',
+                 'Full rebuilds of change log consumers, by consumer.')
+
+
+class ChangeConsumer:
+    """
+    A named cursor over the change log. `rebuild(db)` recomputes the
+    consumer's state from the tables; `apply(db, changes)` updates it from a
+    batch of Change tuples, oldest first. Rows may have been written again or
+    deleted since a change was logged, so apply should read their current
+    state rather than trust the op. With `tables`, only changes to those
+    tables are passed to apply; the cursor still moves past the others.
+
+    Only committed changes are read: consume() does nothing while a
+    transaction is open on the connection, since its writes could still be
+    rolled back. Entries with the same txn were committed between two reads
+    of the log, so one transaction's changes always share a txn.
+    """
+    def __init__(self, name, rebuild, apply, batch_size=CHANGE_BATCH,
+                 tables=None):
+        self.name = name
+        self.rebuild = rebuild
+        self.apply = apply
+        self.batch_size = batch_size
+        self.tables = tables
+
+    def consume(self, db):
+        '''
+        Applies every change committed since the last call and returns how
+        many there were. Without a cursor (first use, or after /reset) the
+        consumer is registered and rebuilt instead, and None is returned.
+        '''
+        if db.in_transaction():
+            return 0
+        cursor = db.change_cursor(self.name)
+        if cursor is None:
+            db.register_change_consumer(self.name)
+            self.rebuild(db)
+            METRICS.inc('change_log_rebuilds_total', (('consumer', self.name),))
+            return None
+        applied = 0
+        end = db.last_change_seq()
+        while True:
+            changes = [Change(*row)
+                       for row in db.query_changes(cursor, self.batch_size,
+                                                   end, self.tables)]
+            if not changes:
+                break
+            self.apply(db, changes)
+            cursor = changes[-1].seq
+            db.advance_change_cursor(self.name, cursor)
+            applied += len(changes)
+            METRICS.inc('change_log_consumed_total',
+                        (('consumer', self.name),), len(changes))
+        if cursor < end:
+            # Only changes to other tables were left
+            db.advance_change_cursor(self.name, end)
+        return applied
+
+    def backlog(self, db):
+        '''
+        Returns how many entries, of any table, were logged after the
+        consumer's cursor, or 0 if it has none.
+        '''
+        cursor = db.change_cursor(self.name)
+        return 0 if cursor is None else db.last_change_seq() - cursor
+
+    def stop(self, db):
+        '''
+        Drops the consumer's cursor, so its entries can be compacted.
+        '''
+        db.drop_change_consumer(self.name)
@@ -1,37 +1,44 @@
 # Implement cleaning for MS3
 import jellyfish
+import json
 from statistics import mean
-from datetime import date, datetime
+from db import RESTAURANT_COLUMNS, ResultRows, encode_row, encode_rows
+from db import statement_columns
+from metrics import timed_phase
+from restaurant_store import STORE_FIELDS, RestaurantStore
 
 SIM_SCORE_THRESHOLD = 0.9
-SIMILARITY_EQ_INPUTS = {'name': 0.5, 'address': 0.5}
+# Compared on the normalized match keys stored in ri_restaurant_keys
+SIMILARITY_EQ_INPUTS = {'name_norm': 0.5, 'address_norm': 0.5}
 
+@timed_phase('load')
 def get_restaurants(db):
     '''
-    Get all restaurant records.
+    Get all restaurant records as a RestaurantStore.
     '''
     # Load connection
     c = db.conn.cursor()
     # Performing the SQL query
-    query = '''SELECT id, name, address, city, state, zip, clean 
-                FROM ri_restaurants;'''
+    query = '''SELECT %s 
+                FROM ri_restaurants
+                JOIN ri_restaurant_keys ON restaurant_id = id;''' % (
+                ', '.join(STORE_FIELDS))
     c.execute(query)
-    restaurants = c.fetchall()
-    return restaurants
+    return RestaurantStore.from_cursor(c)
 
 
+@timed_phase('load')
 def get_temp_restaurants(db):
     '''
-    Get all temp restaurant records.
+    Get all temp restaurant records as a RestaurantStore.
     '''
     # Load connection
     c = db.conn.cursor()
     # Performing the SQL query
-    query = '''SELECT *
-                FROM restaurant_block;'''
+    query = '''SELECT %s
+                FROM restaurant_block;''' % ', '.join(STORE_FIELDS)
     c.execute(query)
-    restaurants = c.fetchall()
-    return restaurants
+    return RestaurantStore.from_cursor(c)
 
 
 def get_zip_codes(db):
@@ -51,6 +58,7 @@ def get_zip_codes(db):
 def clean_by_block(db):
     '''
     Creates a block of data given an existing list of zip codes.
+    Returns the primary records found across all blocks.
     '''
     # get all unique zip codes
     zips = get_zip_codes(db)
@@ -58,15 +66,18 @@ def clean_by_block(db):
     # Start with blank ri_linked table
     clear_linked_records(db)
 
+    primary_records = {}
     for zip_code in zips:
         # Create temp table on zip blocks (#restaurant_blocks)
-        create_block(db, zip_code['zip'])
+        create_block(db, zip_code[0])
         # Assign index to zip block
         create_index(db)
         # Cleaning temp restaurants
-        clean_all_restaurants(db, True)
+        primary_records.update(clean_all_restaurants(db, True))
+    return primary_records
 
 
+@timed_phase('block')
 def create_block(db, zip_code):
     '''
     Creates a single temp table with all restaurants with a certain zip code.
@@ -76,8 +87,9 @@ def create_block(db, zip_code):
     c.execute(query1)
     query2 = '''
             CREATE TEMP TABLE restaurant_block AS
-            SELECT id, name, address, clean
+            SELECT id, name_norm, address_norm, latitude, longitude, clean
             FROM ri_restaurants
+            JOIN ri_restaurant_keys ON restaurant_id = id
             WHERE zip = ?;
             '''
     params = [zip_code]
@@ -85,33 +97,48 @@ def create_block(db, zip_code):
     db.conn.commit()
 
 
+@timed_phase('block')
 def create_index(db):
     '''
     Create index for block
     '''
     c = db.conn.cursor()
     query = '''
-            CREATE INDEX NameIndex ON restaurant_block(name);
+            CREATE INDEX NameIndex ON restaurant_block(name_norm);
             '''
     c.execute(query)
     db.conn.commit()
 
 
-def get_similarity(record1, record2):
+def similarity_fields(restaurants):
+    """
+    Resolves SIMILARITY_EQ_INPUTS to (column, pct) pairs of a RestaurantStore.
+    """
+    return [(restaurants.column(attr), pct)
+            for attr, pct in SIMILARITY_EQ_INPUTS.items()]
+
+
+def get_similarity(fields, i, j):
     """
     Computes similarity between two records
 
     Args:
-        record1 (tuple): tuple with combination of name, address, city,  state, or zip
-        record2 (tuple): tuple with combination of name, address, city,  state, or zip
-    
-    E.g.,record1 = (NAME, ADDRESS, CITY, STATE, ZIP) 
+        fields (list): (column, pct) pairs from similarity_fields
+        i (int): index of the first record in the RestaurantStore
+        j (int): index of the second record in the RestaurantStore
     """ 
     compound_score = 0
     total_pct = 0
-    sim_attr_dict =  SIMILARITY_EQ_INPUTS
-    for attr, pct in sim_attr_dict.items():
-        score = jellyfish.jaro_winkler_similarity(record1[attr], record2[attr])
+    for column, pct in fields:
+        value1, value2 = column[i], column[j]
+        # Keys are already normalized, so equal strings are a perfect match,
+        # but two missing values say nothing about the pair
+        if not value1 or not value2:
+            score = 0
+        elif value1 == value2:
+            score = 1
+        else:
+            score = jellyfish.jaro_winkler_similarity(value1, value2)
         compound_score += score * pct
         total_pct += pct
         # if first score is low enough, don't check other attributes
@@ -122,26 +149,31 @@ def get_similarity(record1, record2):
     return compound_score
 
 
+@timed_phase('scoring')
 def compute_similarities(db, restaurants):
     """
     Iterates over all restaurant records and computes similarity scores
 
     Args:
-        restaurants (list): [description]
+        restaurants (RestaurantStore): records to compare pairwise
     Returns:
-        list of tuples (id1, id2, similarity score), list of unmatched records (ids)
+        list of tuples (id1, id2, similarity score)
     """    
     sim_scores = []
-
-    for i, record1 in enumerate(restaurants):
-        for record2 in restaurants[i+1:]:
-            sim_score = get_similarity(record1,record2)
+    fields = similarity_fields(restaurants)
+    ids = restaurants.ids
+    n = len(restaurants)
+
+    # Pairs are addressed by index, so no per-row copies of the store
+    for i in range(n):
+        for j in range(i + 1, n):
+            sim_score = get_similarity(fields, i, j)
             if sim_score >= SIM_SCORE_THRESHOLD:  
-                id1, id2 = record1['id'], record2['id']
-                sim_scores.append((id1, id2, sim_score))               
+                sim_scores.append((ids[i], ids[j], sim_score))               
     return sim_scores 
 
 
+@timed_phase('clustering')
 def select_primary_record(sim_scores):
     """
     Given list of all sim scores, create a new dict of the form 
@@ -195,6 +227,7 @@ def select_primary_record(sim_scores):
     return primary_records
 
 
+@timed_phase('write')
 def clear_linked_records(db):
     '''
     Clears all linked records from ri_linked
@@ -206,6 +239,7 @@ def clear_linked_records(db):
     db.conn.commit()
 
 
+@timed_phase('write')
 def insert_linked_record(db, primary_records):
     """
     Insert records into linked inspections table.
@@ -230,6 +264,7 @@ def insert_linked_record(db, primary_records):
     db.conn.commit()
 
 
+@timed_phase('write')
 def update_ri_inspections(db,primary_records):
     '''
     Update the ri_inspections for all linked records to 
@@ -262,23 +297,34 @@ def get_cleaned_records(primary_records):
     return clean_records
     
 
+@timed_phase('write')
 def mark_as_clean(db):
     '''
-    Mark all restaurants as clean
+    Mark all restaurants as clean, returning the ids that were dirty
     '''
     # Load connection
     c = db.conn.cursor()
+    query = '''
+                SELECT id
+                FROM ri_restaurants
+                WHERE clean = 0;
+                '''
+    c.execute(query)
+    dirty_ids = [row[0] for row in c.fetchall()]
     query = '''
                 UPDATE ri_restaurants
-                SET clean = 1;
+                SET clean = 1
+                WHERE clean = 0;
                 '''
     c.execute(query)
     db.conn.commit()
+    return dirty_ids
 
 
 def clean_all_restaurants(db, temp=False):
     '''
-    Cleans all restaurants if any restaurants are dirty
+    Cleans all restaurants if any restaurants are dirty.
+    Returns the primary records that were linked, e.g. {2: {2, 5}}
     '''
     if temp is False:
         restaurants = get_restaurants(db)
@@ -287,80 +333,65 @@ def clean_all_restaurants(db, temp=False):
     else:
         restaurants = get_temp_restaurants(db)
     
-    dirty_restaurants = [r for r in restaurants if not r['clean']]
-    if dirty_restaurants:
+    if not restaurants.all_clean():
         sim_scores = compute_similarities(db, restaurants)
         primary_records = select_primary_record(sim_scores)
         insert_linked_record(db, primary_records)
         update_ri_inspections(db, primary_records)
+        return primary_records
+    return {}
 
 
 # STEP 2 BELOW
-def get_single_restaurant(db,restaurant_id):
-    '''
-    Returns information for single restaurant given an inspection id
+def get_cluster_by_inspection(db, inspection_id):
     '''
-    # Load connection
-    c = db.conn.cursor()
-    params = [restaurant_id['original_rest_id']]
-    query = '''SELECT * 
-                FROM ri_restaurants
-                WHERE id = ?'''
-    c.execute(query,params)
-    return c.fetchall()
-
-def get_linked_restaurants(db,inspection_id):
-    '''
-    Returns all linked ids associated with a restaurant ID
+    Returns the primary restaurant for an inspection followed by all of its
+    linked restaurants, in a single query. Each row starts with an is_linked
+    flag followed by the RESTAURANT_COLUMNS.
     '''
     # Load connection
     c = db.conn.cursor()
-    params = [inspection_id]
-    query = '''SELECT original_rest_id 
-                FROM ri_linked
-                WHERE primary_rest_id IN (
-                    SELECT restaurant_id 
-                    FROM ri_inspections
-                    WHERE id = ?)'''
+    params = [inspection_id, inspection_id]
+    columns = ', '.join('ri_restaurants.' + col for col in RESTAURANT_COLUMNS)
+    query = '''SELECT 0 AS is_linked, %s
+                FROM ri_inspections
+                JOIN ri_restaurants ON ri_restaurants.id = ri_inspections.restaurant_id
+                WHERE ri_inspections.id = ?
+                UNION ALL
+                SELECT 1 AS is_linked, %s
+                FROM ri_inspections
+                JOIN ri_linked ON ri_linked.primary_rest_id = ri_inspections.restaurant_id
+                JOIN ri_restaurants ON ri_restaurants.id = ri_linked.original_rest_id
+                WHERE ri_inspections.id = ?
+                ORDER BY 1, 2''' % (columns, columns)
     c.execute(query,params)
-    return c.fetchall()
-
-def get_primary_rest_id(db,inspection_id):
-    '''
-    Returns data for main restaurant
-    '''
-    # Load connection
-    c = db.conn.cursor()
-    params = [inspection_id]
-    query = '''SELECT * 
-                FROM ri_restaurants
-                WHERE id IN (
-                    SELECT restaurant_id 
-                    FROM ri_inspections
-                    WHERE id = ?)'''
-    c.execute(query,params)
-    return c.fetchall()
+    return ResultRows(statement_columns(query, c), c.fetchall())
 
 def create_json_output(db,inspection_id):
     """
-    Modify the primary_records output so that we have as output:
-    { "primary" : { <primary rest JSON>},
-     "linked" : [ {<rest JSON> }, {<rest JSON>} ],
+    Builds the output for an inspection's restaurant cluster:
+    { "primary" : [ {<primary rest JSON>} ],
+     "linked" : [ [ {<rest JSON>} ], [ {<rest JSON>} ] ],
      "ids" : [ id1, id2, id3]}
     
     Args:
-        db ([type]): [description]
-        primary_records: e.g., {2: {2, 5}, 10: {1, 4, 10}}
+        db (DB): database wrapper
+        inspection_id (str): inspection used to find the primary restaurant
     Returns:
-        [type]: [description]
+        str: the output above as JSON, assembled in one pass over the rows
     """ 
+    rows = get_cluster_by_inspection(db,inspection_id)
+    # Drop the leading is_linked flag from the column names
+    columns = rows.columns[1:]
+    main_restaurant = []
     linked_rests = []
-    ids = []   
-    main_restaurant = get_primary_rest_id(db,inspection_id)
-    linked_ids = get_linked_restaurants(db,inspection_id)
-    # Get linked restaurants
-    for linked_id in linked_ids:
-        rest_linked = get_single_restaurant(db,linked_id)
-        linked_rests.append(rest_linked)
-        ids.append(linked_id['original_rest_id'])
-    return {"primary":main_restaurant,"linked":linked_rests,"ids":ids}
\ No newline at end of file
+    ids = []
+    for row in rows:
+        if row[0]:
+            linked_rests.append('[' + encode_row(columns, row[1:]) + ']')
+            ids.append(row[1])
+        else:
+            main_restaurant.append(row[1:])
+    return '{"primary": %s, "linked": [%s], "ids": %s}' % (
+        encode_rows(columns, main_restaurant), ', '.join(linked_rests),
+        json.dumps(ids))
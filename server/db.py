@@ -1,7 +1,194 @@
 from os import path
+from json.encoder import encode_basestring_ascii
 import json
+import re
 import sqlite3
-import string
+from normalize import match_keys, normalize
+
+# Latest schema version, kept in sync with PRAGMA user_version in create.sql
+SCHEMA_VERSION = 11
+
+# Indexes for the hot predicates found by bench/query_plans.py (migration 4)
+QUERY_INDEXES = {
+    'idx_restaurants_name_address': 'ri_restaurants(name, address)',
+    'idx_restaurants_zip': 'ri_restaurants(zip)',
+    'idx_restaurants_latitude': 'ri_restaurants(latitude)',
+    'idx_tweetmatch_restaurant': 'ri_tweetmatch(restaurant_id)',
+    'idx_linked_original': 'ri_linked(original_rest_id)',
+    # Partial index: only the rows /clean still has to mark
+    'idx_restaurants_dirty': 'ri_restaurants(id) WHERE clean = 0',
+}
+# Half-widths of the tweet location box, in degrees
+TWEET_LAT_DISTANCE = 0.00225001
+TWEET_LON_DISTANCE = 0.00302190
+
+# Writes that change what tweet matching reads bump the match generation in
+# ri_meta, which match_index.py uses to detect a stale index file
+MATCH_GENERATION_TRIGGERS = (
+    ('ri_restaurants_generation_insert', 'INSERT', 'ri_restaurants'),
+    ('ri_restaurants_generation_delete', 'DELETE', 'ri_restaurants'),
+    ('ri_restaurants_generation_update', 'UPDATE OF latitude, longitude',
+     'ri_restaurants'),
+    ('ri_restaurant_keys_generation_insert', 'INSERT', 'ri_restaurant_keys'),
+    ('ri_restaurant_keys_generation_delete', 'DELETE', 'ri_restaurant_keys'),
+    ('ri_restaurant_keys_generation_update', 'UPDATE OF name_norm',
+     'ri_restaurant_keys'),
+)
+# A new database starts at a random generation, so an index file left by
+# another database is not mistaken for a current one
+RANDOM_GENERATION_SQL = 'abs(random() % 1000000000000000)'
+
+# Tables whose row changes are appended to ri_changes (migration 6)
+CHANGE_LOG_TABLES = ('ri_restaurants', 'ri_inspections', 'ri_linked',
+                     'ri_tweetmatch')
+# Tables logged by a key other than their rowid (migration 11) -> that key
+CHANGE_LOG_KEYS = {'ri_restaurant_keys': 'restaurant_id'}
+# Trigger event -> the row whose rowid (or key) is logged
+CHANGE_LOG_EVENTS = (('INSERT', 'new'), ('UPDATE', 'new'), ('DELETE', 'old'))
+
+# Counter name in ri_counters -> table whose rows it counts
+COUNTED_TABLES = {'inspections': 'ri_inspections',
+                  'restaurants': 'ri_restaurants',
+                  'tweet_matches': 'ri_tweetmatch'}
+
+RESTAURANT_COLUMNS = ('id', 'name', 'facility_type', 'address', 'city', 'state',
+                      'zip', 'latitude', 'longitude', 'clean')
+INSPECTION_COLUMNS = ('id', 'risk', 'inspection_date', 'inspection_type',
+                      'results', 'violations', 'restaurant_id')
+INSPECTION_SUMMARY_COLUMNS = tuple(col for col in INSPECTION_COLUMNS
+                                   if col != 'violations')
+# Rows fetched per fetchmany call when streaming results
+STREAM_BATCH_SIZE = 100
+# Ids bound per IN (...) query by the multi-get lookups
+MULTI_GET_CHUNK = 500
+# Rows fetched per fetchmany call by the bulk exports
+EXPORT_BATCH_SIZE = 1000
+# inspection_date is sent as MM/DD/YYYY; ingest also stores it as YYYY-MM-DD
+# in inspection_date_iso (migration 7), so date ranges can use an index
+US_DATE = re.compile(r'([0-9]{2})/([0-9]{2})/([0-9]{4})')
+ISO_DATE = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}')
+# The same conversion in SQL, used to backfill inspection_date_iso
+ISO_DATE_SQL = '''(CASE
+    WHEN %(col)s GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9]'
+    THEN substr(%(col)s, 7, 4) || '-' || substr(%(col)s, 1, 2)
+         || '-' || substr(%(col)s, 4, 2)
+    WHEN %(col)s GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+    THEN %(col)s
+    END)'''
+# Months (YYYY-MM) bounding the /stats rollups
+MONTH = re.compile(r'[0-9]{4}-[0-9]{2}')
+
+# Inspection counts by zip, month, results and risk (ri_rollup_zip) and by
+# the ri_linked primary of the inspection's restaurant (ri_rollup_cluster),
+# kept current by the ROLLUP_TRIGGERS (migration 7). NULL keys count as ''.
+ROLLUP_ZIP_UPSERT = '''
+    INSERT INTO ri_rollup_zip (zip, month, results, risk, inspections)
+    VALUES (coalesce((SELECT zip FROM ri_restaurants
+                      WHERE id = %(row)s.restaurant_id), ''),
+            coalesce(substr(%(row)s.inspection_date_iso, 1, 7), ''),
+            coalesce(%(row)s.results, ''), coalesce(%(row)s.risk, ''),
+            %(sign)s1)
+    ON CONFLICT (zip, month, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;'''
+ROLLUP_CLUSTER_UPSERT = '''
+    INSERT INTO ri_rollup_cluster (restaurant_id, results, risk, inspections)
+    VALUES (coalesce((SELECT min(primary_rest_id) FROM ri_linked
+                      WHERE original_rest_id = %(row)s.restaurant_id),
+                     %(row)s.restaurant_id),
+            coalesce(%(row)s.results, ''), coalesce(%(row)s.risk, ''),
+            %(sign)s1)
+    ON CONFLICT (restaurant_id, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;'''
+# Moves the inspections of a newly (un)linked restaurant between clusters
+ROLLUP_CLUSTER_MOVE = '''
+    INSERT INTO ri_rollup_cluster (restaurant_id, results, risk, inspections)
+    SELECT %(cluster)s, coalesce(results, ''), coalesce(risk, ''),
+           %(sign)scount(*)
+    FROM ri_inspections WHERE restaurant_id = %(restaurant)s
+    GROUP BY 2, 3
+    ON CONFLICT (restaurant_id, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;'''
+
+# Full-text index of inspection violations and restaurant names (migration 8).
+# It reads its text through ri_inspection_text instead of storing a second
+# copy; the FTS_TRIGGERS keep it in step with the rows, so it commits and
+# rolls back with them and /reset empties it with everything else.
+FTS_VIEW_SQL = '''
+    CREATE VIEW IF NOT EXISTS ri_inspection_text AS
+    SELECT i.rowid AS inspection_rowid, i.violations AS violations,
+           r.name AS name
+    FROM ri_inspections i
+    JOIN ri_restaurants r ON r.id = i.restaurant_id;'''
+FTS_TABLE_SQL = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS ri_inspections_fts USING fts5(
+        violations, name,
+        content = 'ri_inspection_text', content_rowid = 'inspection_rowid',
+        tokenize = 'porter unicode61'
+    );'''
+FTS_ADD = '''
+    INSERT INTO ri_inspections_fts (rowid, violations, name)
+    SELECT %(row)s.rowid, %(row)s.violations, name
+    FROM ri_restaurants WHERE id = %(row)s.restaurant_id;'''
+# An external content index is told exactly what it indexed for a row
+FTS_REMOVE = '''
+    INSERT INTO ri_inspections_fts (ri_inspections_fts, rowid, violations, name)
+    SELECT 'delete', %(row)s.rowid, %(row)s.violations, name
+    FROM ri_restaurants WHERE id = %(row)s.restaurant_id;'''
+FTS_RENAME = '''
+    INSERT INTO ri_inspections_fts (ri_inspections_fts, rowid, violations, name)
+    SELECT 'delete', rowid, violations, old.name
+    FROM ri_inspections WHERE restaurant_id = old.id;
+    INSERT INTO ri_inspections_fts (rowid, violations, name)
+    SELECT rowid, violations, new.name
+    FROM ri_inspections WHERE restaurant_id = new.id;'''
+# (name, event, body), as ROLLUP_TRIGGERS
+FTS_TRIGGERS = (
+    ('ri_inspections_fts_insert', 'INSERT ON ri_inspections',
+     FTS_ADD % {'row': 'new'}),
+    ('ri_inspections_fts_delete', 'DELETE ON ri_inspections',
+     FTS_REMOVE % {'row': 'old'}),
+    ('ri_inspections_fts_update',
+     'UPDATE OF violations, restaurant_id ON ri_inspections',
+     FTS_REMOVE % {'row': 'old'} + FTS_ADD % {'row': 'new'}),
+    ('ri_restaurants_fts_update', 'UPDATE OF name ON ri_restaurants',
+     FTS_RENAME),
+)
+# Results per /search/violations page, by default and at most
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+
+def rollup_deltas(row, sign):
+    return ''.join(statement % {'row': row, 'sign': sign}
+                   for statement in (ROLLUP_ZIP_UPSERT, ROLLUP_CLUSTER_UPSERT))
+
+
+def rollup_move(restaurant, source, target):
+    return ''.join(ROLLUP_CLUSTER_MOVE % {'cluster': cluster, 'sign': sign,
+                                          'restaurant': restaurant}
+                   for cluster, sign in ((source, '-'), (target, '')))
+
+
+# (name, event, WHEN clause, body); /clean re-points inspections to their
+# primary and relinks restaurants, which the UPDATE and ri_linked triggers
+# carry over to the cluster rollup
+ROLLUP_TRIGGERS = (
+    ('ri_inspections_rollup_insert', 'INSERT ON ri_inspections', '',
+     rollup_deltas('new', '')),
+    ('ri_inspections_rollup_delete', 'DELETE ON ri_inspections', '',
+     rollup_deltas('old', '-')),
+    ('ri_inspections_rollup_update',
+     'UPDATE OF restaurant_id, results, risk, inspection_date_iso ON ri_inspections',
+     '', rollup_deltas('old', '-') + rollup_deltas('new', '')),
+    ('ri_linked_rollup_insert', 'INSERT ON ri_linked',
+     'WHEN new.primary_rest_id != new.original_rest_id',
+     rollup_move('new.original_rest_id', 'new.original_rest_id',
+                 'new.primary_rest_id')),
+    ('ri_linked_rollup_delete', 'DELETE ON ri_linked',
+     'WHEN old.primary_rest_id != old.original_rest_id',
+     rollup_move('old.original_rest_id', 'old.primary_rest_id',
+                 'old.original_rest_id')),
+)
 
 # Error class for when request data is bad
 class InspError(Exception):
@@ -25,6 +212,93 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
+# Column names per SQL statement text, read from cursor.description once
+STATEMENT_COLUMNS = {}
+# JSON object templates per column tuple, e.g. '{"id": %s, "name": %s}'
+ROW_TEMPLATES = {}
+
+def encode_float(value):
+    # json.dumps spells out NaN/Infinity; finite floats use repr
+    if value != value or value in (float('inf'), float('-inf')):
+        return json.dumps(value)
+    return float.__repr__(value)
+
+# Encoders for the value types SQLite returns, matching json.dumps output
+VALUE_ENCODERS = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    float: encode_float,
+    type(None): lambda value: 'null',
+}
+
+def encode_row(columns, row):
+    '''
+    Encodes a tuple row as the JSON object json.dumps would produce for the
+    equivalent dict, without building that dict.
+    '''
+    template = ROW_TEMPLATES.get(columns)
+    if template is None:
+        template = '{' + ', '.join(encode_basestring_ascii(col) + ': %s'
+                                   for col in columns) + '}'
+        ROW_TEMPLATES[columns] = template
+    encoders = VALUE_ENCODERS
+    return template % tuple([encode_basestring_ascii(value) if type(value) is str
+                             else encoders.get(type(value), json.dumps)(value)
+                             for value in row])
+
+def encode_items(columns, rows):
+    '''
+    Encodes tuple rows as comma separated JSON objects, without brackets.
+    '''
+    return ', '.join([encode_row(columns, row) for row in rows])
+
+def encode_rows(columns, rows):
+    '''
+    Encodes tuple rows as a JSON array of objects.
+    '''
+    return '[' + encode_items(columns, rows) + ']'
+
+class ResultRows(list):
+    '''
+    Tuple rows from an outward-facing query, carrying the statement's column
+    names so they can be encoded to JSON directly.
+    '''
+    def __init__(self, columns, rows=()):
+        list.__init__(self, rows)
+        self.columns = columns
+
+    def value(self, index, column):
+        return self[index][self.columns.index(column)]
+
+    def row_json(self, index):
+        return encode_row(self.columns, self[index])
+
+    def to_json(self):
+        return encode_rows(self.columns, self)
+
+def statement_columns(query, cursor):
+    '''
+    Returns the column names for an executed statement, cached by its text.
+    '''
+    columns = STATEMENT_COLUMNS.get(query)
+    if columns is None:
+        columns = tuple(col[0] for col in cursor.description)
+        STATEMENT_COLUMNS[query] = columns
+    return columns
+
+def build_template(seed=False):
+    '''
+    Returns an in-memory database holding the pristine schema (and seed data
+    if seed is set), to be copied over the live database by /reset.
+    '''
+    # Read by request threads too when the server runs with --shards
+    template = sqlite3.connect(":memory:", check_same_thread=False)
+    db = DB(template)
+    db.create_script()
+    if seed:
+        db.seed_data()
+    return template
+
 """
 Wraps a single connection to the database with higher-level functionality.
 """
@@ -51,13 +325,300 @@ class DB:
 
     def seed_data(self):
         """
-        Calls the schema/seed.sql file
+        Calls the schema/seed.sql file, then computes the match keys of the
+        restaurants it added, which SQL cannot.
         """
         script_file = path.join("schema", "seed.sql")
         if not path.exists(script_file):
             raise InspError("Seed Script not found")
         self.execute_script(script_file)
-    
+        self.add_missing_restaurant_keys()
+        self.conn.commit()
+
+    def restore_template(self, template):
+        """
+        Replaces the whole database with a copy of the template database
+        (see build_template). Copying the template's few pages takes about
+        the same time however much data was loaded, unlike dropping tables.
+        """
+        # Writes still pending are discarded with everything else
+        self.conn.rollback()
+        template.backup(self.conn)
+        c = self.conn.cursor()
+        c.execute('''UPDATE ri_meta SET value = %s
+                  WHERE name = 'match_generation' ''' % RANDOM_GENERATION_SQL)
+        self.conn.commit()
+
+    def schema_version(self):
+        """
+        Returns the schema version recorded in the database file.
+        """
+        c = self.conn.cursor()
+        c.execute("PRAGMA user_version;")
+        return c.fetchone()[0]
+
+    def migrate(self):
+        """
+        Upgrades an existing database to SCHEMA_VERSION, backfilling any
+        derived data. Databases without a schema are left for /create.
+        """
+        c = self.conn.cursor()
+        query = '''SELECT name
+                  FROM sqlite_master
+                  WHERE type = 'table' AND name = 'ri_restaurants' '''
+        c.execute(query)
+        if not c.fetchall():
+            return
+        version = self.schema_version()
+        for target, migration in MIGRATIONS:
+            if version < target:
+                migration(self)
+                c.execute("PRAGMA user_version = %d;" % target)
+                version = target
+        self.conn.commit()
+
+    def migrate_restaurant_keys(self):
+        """
+        Migration 1: adds ri_restaurant_keys and backfills it from
+        ri_restaurants.
+        """
+        c = self.conn.cursor()
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS ri_restaurant_keys (
+            restaurant_id int PRIMARY KEY,
+            name_norm varchar(60),
+            address_norm varchar(60),
+            FOREIGN KEY (restaurant_id) REFERENCES ri_restaurants
+        );''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_restaurant_keys_name
+                  ON ri_restaurant_keys(name_norm);''')
+        self.add_missing_restaurant_keys()
+
+    def add_missing_restaurant_keys(self):
+        """
+        Computes the match keys of every restaurant that has none, ie those
+        written by SQL scripts rather than the ingest path.
+        """
+        c = self.conn.cursor()
+        query = '''SELECT id, name, address
+                  FROM ri_restaurants
+                  WHERE id NOT IN (SELECT restaurant_id FROM ri_restaurant_keys)'''
+        c.execute(query)
+        params = [(r_id,) + match_keys(name, address)
+                  for r_id, name, address in c.fetchall()]
+        query = '''
+        INSERT INTO ri_restaurant_keys (
+            restaurant_id, name_norm, address_norm
+        ) VALUES (?, ?, ?);'''
+        c.executemany(query, params)
+
+    def migrate_inspection_index(self):
+        """
+        Migration 2: indexes inspections by restaurant. ri_linked lookups by
+        primary_rest_id are already served by its primary key.
+        """
+        c = self.conn.cursor()
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_inspections_restaurant
+                  ON ri_inspections(restaurant_id);''')
+
+    def migrate_query_indexes(self):
+        """
+        Migration 4: indexes the lookups that otherwise scan a whole table:
+        restaurants by name and address on ingest, by zip when cleaning in
+        blocks, by latitude for tweets, and tweet matches by restaurant.
+        """
+        c = self.conn.cursor()
+        for name, columns in QUERY_INDEXES.items():
+            c.execute('CREATE INDEX IF NOT EXISTS %s ON %s;' % (name, columns))
+
+    def migrate_counters(self):
+        """
+        Migration 3: adds ri_counters with the INSERT/DELETE triggers that
+        maintain it, seeded from the current row counts.
+        """
+        c = self.conn.cursor()
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS ri_counters (
+            name varchar(30) PRIMARY KEY,
+            value int NOT NULL DEFAULT 0
+        );''')
+        for name, table in COUNTED_TABLES.items():
+            c.execute('''INSERT OR REPLACE INTO ri_counters (name, value)
+                      SELECT ?, count(*) FROM %s''' % table, [name])
+            for op, delta in (('INSERT', '+'), ('DELETE', '-')):
+                c.execute('''
+                CREATE TRIGGER IF NOT EXISTS %s_count_%s AFTER %s ON %s
+                BEGIN
+                    UPDATE ri_counters SET value = value %s 1 WHERE name = '%s';
+                END;''' % (table, op.lower(), op, table, delta, name))
+
+    def migrate_match_generation(self):
+        """
+        Migration 5: adds ri_meta with the match generation and the triggers
+        that bump it.
+        """
+        c = self.conn.cursor()
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS ri_meta (
+            name varchar(30) PRIMARY KEY,
+            value int NOT NULL
+        );''')
+        c.execute('''INSERT OR IGNORE INTO ri_meta (name, value)
+                  VALUES ('match_generation', %s)''' % RANDOM_GENERATION_SQL)
+        for trigger, event, table in MATCH_GENERATION_TRIGGERS:
+            c.execute('''
+            CREATE TRIGGER IF NOT EXISTS %s AFTER %s ON %s
+            BEGIN
+                UPDATE ri_meta SET value = value + 1
+                WHERE name = 'match_generation';
+            END;''' % (trigger, event, table))
+
+    def migrate_change_log(self):
+        """
+        Migration 6: adds the change log, its consumer cursors and the
+        triggers that append to it.
+        """
+        c = self.conn.cursor()
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS ri_changes (
+            seq integer PRIMARY KEY AUTOINCREMENT,
+            tbl varchar(30) NOT NULL,
+            op varchar(6) NOT NULL,
+            row_id int NOT NULL,
+            txn int NOT NULL
+        );''')
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS ri_change_cursors (
+            consumer varchar(30) PRIMARY KEY,
+            seq int NOT NULL
+        );''')
+        c.execute('''INSERT OR IGNORE INTO ri_meta (name, value)
+                  VALUES ('change_txn', 1)''')
+        for table in CHANGE_LOG_TABLES:
+            self.create_change_triggers(table, 'rowid')
+
+    def create_change_triggers(self, table, key):
+        """
+        Creates the triggers that append table's writes to the change log,
+        identifying each row by its key column.
+        """
+        c = self.conn.cursor()
+        for op, row in CHANGE_LOG_EVENTS:
+            c.execute('''
+            CREATE TRIGGER IF NOT EXISTS %s_change_%s AFTER %s ON %s
+            WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+            BEGIN
+                INSERT INTO ri_changes (tbl, op, row_id, txn)
+                SELECT '%s', '%s', %s.%s, value
+                FROM ri_meta WHERE name = 'change_txn';
+            END;''' % (table, op.lower(), op, table, table, op.lower(), row, key))
+
+    def migrate_rollups(self):
+        """
+        Migration 7: stores inspection dates as YYYY-MM-DD in an indexed
+        column and adds the inspection rollups, built from the current rows.
+        """
+        c = self.conn.cursor()
+        c.execute("PRAGMA table_info(ri_inspections);")
+        if 'inspection_date_iso' not in [row[1] for row in c.fetchall()]:
+            c.execute('''ALTER TABLE ri_inspections
+                      ADD COLUMN inspection_date_iso char(10)''')
+        c.execute('''UPDATE ri_inspections SET inspection_date_iso = %s'''
+                  % ISO_DATE_SQL % {'col': 'inspection_date'})
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_inspections_date_iso
+                  ON ri_inspections(inspection_date_iso);''')
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS ri_rollup_zip (
+            zip char(5) NOT NULL,
+            month char(7) NOT NULL,
+            results varchar(50) NOT NULL,
+            risk varchar(30) NOT NULL,
+            inspections int NOT NULL,
+            PRIMARY KEY (zip, month, results, risk)
+        );''')
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS ri_rollup_cluster (
+            restaurant_id int NOT NULL,
+            results varchar(50) NOT NULL,
+            risk varchar(30) NOT NULL,
+            inspections int NOT NULL,
+            PRIMARY KEY (restaurant_id, results, risk)
+        );''')
+        for trigger, event, when, body in ROLLUP_TRIGGERS:
+            c.execute('''CREATE TRIGGER IF NOT EXISTS %s AFTER %s %s
+                      BEGIN %s
+                      END;''' % (trigger, event, when, body))
+        self.rebuild_rollups()
+
+    def rebuild_rollups(self):
+        """
+        Recomputes both rollups from ri_inspections, eg after restaurants
+        were edited by hand (the triggers only follow inspections and
+        ri_linked).
+        """
+        c = self.conn.cursor()
+        c.execute("DELETE FROM ri_rollup_zip;")
+        c.execute('''
+        INSERT INTO ri_rollup_zip (zip, month, results, risk, inspections)
+        SELECT coalesce(r.zip, ''), coalesce(substr(i.inspection_date_iso, 1, 7), ''),
+               coalesce(i.results, ''), coalesce(i.risk, ''), count(*)
+        FROM ri_inspections i
+        LEFT JOIN ri_restaurants r ON r.id = i.restaurant_id
+        GROUP BY 1, 2, 3, 4''')
+        c.execute("DELETE FROM ri_rollup_cluster;")
+        c.execute('''
+        INSERT INTO ri_rollup_cluster (restaurant_id, results, risk, inspections)
+        SELECT coalesce((SELECT min(primary_rest_id) FROM ri_linked
+                         WHERE original_rest_id = i.restaurant_id),
+                        i.restaurant_id),
+               coalesce(i.results, ''), coalesce(i.risk, ''), count(*)
+        FROM ri_inspections i
+        GROUP BY 1, 2, 3''')
+        self.conn.commit()
+
+    def migrate_violation_search(self):
+        """
+        Migration 8: adds the full-text index of violations and restaurant
+        names with its triggers, and indexes the current rows.
+        """
+        c = self.conn.cursor()
+        c.execute(FTS_VIEW_SQL)
+        c.execute(FTS_TABLE_SQL)
+        for trigger, event, body in FTS_TRIGGERS:
+            c.execute('''CREATE TRIGGER IF NOT EXISTS %s AFTER %s
+                      BEGIN %s
+                      END;''' % (trigger, event, body))
+        c.execute('''INSERT INTO ri_inspections_fts (ri_inspections_fts)
+                  VALUES ('rebuild')''')
+
+    def migrate_seeded_restaurant_keys(self):
+        """
+        Migration 9: computes the keys of restaurants added by /seed before it
+        did so itself.
+        """
+        self.add_missing_restaurant_keys()
+
+    def migrate_drop_unused_keys(self):
+        """
+        Migration 10: drops the name_phonetic and name_signature keys, which
+        nothing matched on.
+        """
+        c = self.conn.cursor()
+        c.execute("PRAGMA table_info(ri_restaurant_keys);")
+        columns = [row[1] for row in c.fetchall()]
+        for column in ('name_phonetic', 'name_signature'):
+            if column in columns:
+                c.execute('ALTER TABLE ri_restaurant_keys DROP COLUMN %s'
+                          % column)
+
+    def migrate_log_restaurant_keys(self):
+        """
+        Migration 11: appends ri_restaurant_keys writes to the change log,
+        by restaurant id, so consumers of match keys can follow them.
+        """
+        for table, key in CHANGE_LOG_KEYS.items():
+            self.create_change_triggers(table, key)
+
     def begin_transaction(self):
         """
         Begins the transaction.
@@ -79,6 +640,36 @@ class DB:
         """
         self.conn.rollback()
 
+    def in_transaction(self):
+        """
+        Returns True if a transaction is open on the connection.
+        """
+        return self.conn.in_transaction
+
+    def savepoint(self, name):
+        """
+        Opens a savepoint inside the current transaction.
+        """
+        c = self.conn.cursor()
+        c.execute("SAVEPOINT %s;" % name)
+        c.close()
+
+    def release_savepoint(self, name):
+        """
+        Keeps the writes made since the savepoint and closes it.
+        """
+        c = self.conn.cursor()
+        c.execute("RELEASE SAVEPOINT %s;" % name)
+        c.close()
+
+    def rollback_to_savepoint(self, name):
+        """
+        Undoes the writes made since the savepoint, leaving it open.
+        """
+        c = self.conn.cursor()
+        c.execute("ROLLBACK TO SAVEPOINT %s;" % name)
+        c.close()
+
     def find_restaurant(self, restaurant_id):
         """
         Searches for the restaurant with the given ID. Returns None if the
@@ -89,11 +680,11 @@ class DB:
         
         # Performing the SQL query
         params = [str(restaurant_id)]
-        query = '''SELECT * 
+        query = '''SELECT %s 
                   FROM ri_restaurants 
-                  WHERE id = (?)'''
+                  WHERE id = (?)''' % ', '.join(RESTAURANT_COLUMNS)
         c.execute(query,params)
-        restaurant = c.fetchall()
+        restaurant = ResultRows(statement_columns(query, c), c.fetchall())
 
         if not restaurant:
             return None
@@ -108,16 +699,16 @@ class DB:
         c = self.conn.cursor()
         params = [str(inspection_id)]
         query = '''
-                SELECT * 
+                SELECT %s 
                 FROM ri_restaurants
                 WHERE ri_restaurants.id IN (
                     SELECT restaurant_id 
                     FROM ri_inspections
                     WHERE ri_inspections.id = (?)
                 )
-                '''
+                ''' % ', '.join(RESTAURANT_COLUMNS)
         c.execute(query, params)
-        rest_inspections = c.fetchall()
+        rest_inspections = ResultRows(statement_columns(query, c), c.fetchall())
         
         if not rest_inspections:
             return None
@@ -125,20 +716,227 @@ class DB:
     
     def count_inspections(self):
         """
-        Counts the number of records in the r_i inspections table.
+        Counts the number of records in the r_i inspections table, read in
+        constant time from the trigger-maintained counter.
         """
         # Load connection
         c = self.conn.cursor()
         
         # Performing the SQL query
-        query = '''SELECT count(*) 
-                FROM ri_inspections
+        query = '''SELECT value 
+                FROM ri_counters
+                WHERE name = 'inspections'
                 '''
         c.execute(query)
-        cnt = c.fetchall()
+        cnt = c.fetchone()[0]
         c.close()
         return cnt         
 
+    def get_counters(self):
+        """
+        Returns every counter in ri_counters as a dict of name to value.
+        """
+        # Load connection
+        c = self.conn.cursor()
+        query = '''SELECT name, value 
+                FROM ri_counters
+                ORDER BY name
+                '''
+        c.execute(query)
+        return dict(c.fetchall())
+
+    def register_change_consumer(self, consumer):
+        """
+        Stores a cursor for consumer at the end of the change log, so it is
+        given the changes made from now on. Returns the cursor.
+        """
+        # Load connection
+        c = self.conn.cursor()
+        query = '''INSERT OR REPLACE INTO ri_change_cursors (consumer, seq)
+                  SELECT ?, coalesce(max(seq), 0) FROM ri_changes'''
+        c.execute(query, [consumer])
+        self.conn.commit()
+        return self.change_cursor(consumer)
+
+    def change_cursor(self, consumer):
+        """
+        Returns the last change seq consumer has applied, or None if it has
+        no cursor (it never registered, or the database was reset).
+        """
+        # Load connection
+        c = self.conn.cursor()
+        query = '''SELECT seq
+                  FROM ri_change_cursors
+                  WHERE consumer = ?'''
+        c.execute(query, [consumer])
+        row = c.fetchone()
+        return row[0] if row else None
+
+    def last_change_seq(self):
+        """
+        Returns the seq of the last change logged, compacted or not, or 0
+        if none was.
+        """
+        # Load connection
+        c = self.conn.cursor()
+        c.execute('''SELECT coalesce(max(seq), 0)
+                  FROM sqlite_sequence
+                  WHERE name = 'ri_changes' ''')
+        return c.fetchone()[0]
+
+    def query_changes(self, after, limit, until=None, tables=None):
+        """
+        Returns up to limit (seq, tbl, op, row_id, txn) rows of the change
+        log after seq, oldest first, optionally only up to seq until and
+        only those of the given tables.
+        """
+        # Load connection
+        c = self.conn.cursor()
+        params = [after]
+        query = '''SELECT seq, tbl, op, row_id, txn
+                  FROM ri_changes
+                  WHERE seq > ? '''
+        if until is not None:
+            query += 'AND seq <= ? '
+            params.append(until)
+        if tables is not None:
+            query += 'AND tbl IN (%s) ' % ', '.join('?' * len(tables))
+            params.extend(tables)
+        query += 'ORDER BY seq LIMIT ?'
+        params.append(limit)
+        c.execute(query, params)
+        return c.fetchall()
+
+    def advance_change_cursor(self, consumer, seq):
+        """
+        Moves consumer's cursor to seq, starts a new change txn and drops
+        the entries every consumer has now applied.
+        """
+        # Load connection
+        c = self.conn.cursor()
+        c.execute('''UPDATE ri_change_cursors SET seq = ?
+                  WHERE consumer = ?''', [seq, consumer])
+        # Writes after this read get a txn of their own
+        c.execute('''UPDATE ri_meta SET value = value + 1
+                  WHERE name = 'change_txn' ''')
+        self.compact_changes()
+        self.conn.commit()
+
+    def drop_change_consumer(self, consumer):
+        """
+        Removes consumer's cursor. Once no consumer is left nothing more is
+        logged and the log is emptied.
+        """
+        # Load connection
+        c = self.conn.cursor()
+        c.execute('''DELETE FROM ri_change_cursors
+                  WHERE consumer = ?''', [consumer])
+        self.compact_changes()
+        self.conn.commit()
+
+    def compact_changes(self):
+        """
+        Deletes the change log entries at or before the lowest cursor, or
+        every entry if there is no consumer.
+        """
+        # Load connection
+        c = self.conn.cursor()
+        query = '''DELETE FROM ri_changes
+                  WHERE seq <= coalesce(
+                      (SELECT min(seq) FROM ri_change_cursors),
+                      (SELECT max(seq) FROM ri_changes))'''
+        c.execute(query)
+        return c.rowcount
+
+    def query_zip_rollup(self, zip_code, month_from=None, month_to=None):
+        """
+        Returns the inspection counts of a zip by month (YYYY-MM), results
+        and risk, optionally between two months inclusive.
+        """
+        # Load connection
+        c = self.conn.cursor()
+        params = [zip_code]
+        query = '''SELECT month, results, risk, inspections
+                  FROM ri_rollup_zip
+                  WHERE zip = ? AND inspections > 0 '''
+        if month_from is not None:
+            query += 'AND month >= ? '
+            params.append(month_from)
+        if month_to is not None:
+            query += 'AND month <= ? '
+            params.append(month_to)
+        query += 'ORDER BY month, results, risk'
+        c.execute(query, params)
+        return ResultRows(statement_columns(query, c), c.fetchall())
+
+    def find_cluster_rollup(self, restaurant_id):
+        """
+        Returns the primary restaurant of the given restaurant's cluster and
+        the cluster's inspection counts by results and risk, or None if
+        there is no such restaurant.
+        """
+        # Load connection
+        c = self.conn.cursor()
+        query = '''SELECT coalesce((SELECT min(primary_rest_id) FROM ri_linked
+                                   WHERE original_rest_id = id), id)
+                  FROM ri_restaurants
+                  WHERE id = ?'''
+        c.execute(query, [restaurant_id])
+        row = c.fetchone()
+        if row is None:
+            return None
+        query = '''SELECT results, risk, inspections
+                  FROM ri_rollup_cluster
+                  WHERE restaurant_id = ? AND inspections > 0
+                  ORDER BY results, risk'''
+        c.execute(query, [row[0]])
+        return row[0], ResultRows(statement_columns(query, c), c.fetchall())
+
+    def search_violations(self, query, zips=None, date_from=None,
+                          date_to=None, clean=None, limit=SEARCH_PAGE_SIZE,
+                          offset=0):
+        """
+        Returns a page of the inspections whose violations or restaurant
+        name match an FTS5 query, best bm25 score first, with a snippet of
+        the matching violations. Filters are as for the exports. Raises
+        InspError if the query is not valid FTS5 syntax.
+        """
+        # Load connection
+        c = self.conn.cursor()
+        conditions, params = export_filters(zips, date_from, date_to, clean)
+        # The page is ranked first and only its rows get a snippet; the
+        # filters' joins are only made when there are filters
+        page = '''SELECT ri_inspections_fts.rowid AS fts_rowid, rank AS fts_rank
+                   FROM ri_inspections_fts '''
+        if conditions:
+            page += '''JOIN ri_inspections i ON i.rowid = ri_inspections_fts.rowid
+                       JOIN ri_restaurants r ON r.id = i.restaurant_id '''
+        page += 'WHERE ri_inspections_fts MATCH ? '
+        for condition in conditions:
+            page += 'AND %s ' % condition
+        page += 'ORDER BY rank LIMIT ? OFFSET ?'
+        params = [query] + params + [limit, offset, query]
+        sql = '''WITH page AS (%s)
+                  SELECT i.id AS inspection_id, i.restaurant_id, r.name, r.zip,
+                         i.inspection_date, i.results,
+                         -page.fts_rank AS score,
+                         snippet(ri_inspections_fts, 0, '[', ']', '...', 16)
+                             AS snippet
+                  FROM page
+                  JOIN ri_inspections_fts ON ri_inspections_fts.rowid = page.fts_rowid
+                  JOIN ri_inspections i ON i.rowid = page.fts_rowid
+                  JOIN ri_restaurants r ON r.id = i.restaurant_id
+                  WHERE ri_inspections_fts MATCH ?
+                  ORDER BY page.fts_rank, page.fts_rowid''' % page
+        try:
+            c.execute(sql, params)
+        except sqlite3.OperationalError as e:
+            # With the schema in place, the query text is what failed
+            if str(e).startswith('no such table'):
+                raise
+            raise InspError("Bad search query: %s" % e)
+        return ResultRows(statement_columns(sql, c), c.fetchall())
+
     def find_inspection(self, inspection_id):
         """
         Searches for the inspection with the given ID. Returns None if the
@@ -149,36 +947,68 @@ class DB:
         
         # Performing the SQL query
         params = [str(inspection_id)]
-        query = '''SELECT * 
+        query = '''SELECT id 
                   FROM ri_inspections 
                   WHERE id = (?)'''
         c.execute(query, params)
-        inspection = c.fetchall()
+        inspection = c.fetchone()
         
         if not inspection:
             return None
         return inspection
  
-    def find_inspections(self, restaurant_id):
+    def query_inspections(self, restaurant_id, limit=None, after=None,
+                          violations=True):
         """
-        Searches for all inspections associated with the given restaurant.
-        Returns an empty list if no matching inspections are found.
+        Executes the inspections query for a restaurant and returns the open
+        cursor together with its column names. With limit or after the rows are paged in inspection id order,
+        starting after the given id. violations=False leaves out the large
+        violations text.
         """
         # Load connection
         c = self.conn.cursor()
-        
-        # Performing the SQL query
+
+        columns = INSPECTION_COLUMNS if violations else INSPECTION_SUMMARY_COLUMNS
         params = [str(restaurant_id)]
-        query = '''SELECT * 
+        query = '''SELECT %s 
                   FROM ri_inspections 
                   WHERE restaurant_id = (?)
-                  '''
+                  ''' % ', '.join(columns)
+        if after is not None:
+            query += "AND id > ? "
+            params.append(str(after))
+        if limit is not None or after is not None:
+            query += "ORDER BY id "
+        if limit is not None:
+            query += "LIMIT ?"
+            params.append(limit)
         c.execute(query, params)
-        inspections = c.fetchall()
-        
-        if not inspections:
-            return []
-        return inspections
+        return c, statement_columns(query, c)
+
+    def find_inspections(self, restaurant_id, limit=None, after=None,
+                         violations=True):
+        """
+        Searches for all inspections associated with the given restaurant.
+        Returns an empty list if no matching inspections are found.
+        """
+        c, columns = self.query_inspections(restaurant_id, limit, after,
+                                            violations)
+        return ResultRows(columns, c.fetchall())
+
+    def iter_inspections(self, restaurant_id, limit=None, after=None,
+                         violations=True, batch_size=STREAM_BATCH_SIZE):
+        """
+        Yields a restaurant's inspections in ResultRows batches read with
+        fetchmany, so the full result set is never held in memory.
+        """
+        c, columns = self.query_inspections(restaurant_id, limit, after,
+                                            violations)
+        while True:
+            batch = c.fetchmany(batch_size)
+            if not batch:
+                break
+            yield ResultRows(columns, batch)
+        c.close()
 
     def check_restaurant(self, inspection):
         '''
@@ -199,7 +1029,8 @@ class DB:
 
     def insert_restaurant(self, inspection):
         '''
-        Inserts new restaurant into restaurant table
+        Inserts new restaurant and its normalized match keys.
+        Returns the new restaurant id.
         '''
         # Load connection
         c = self.conn.cursor()
@@ -218,7 +1049,19 @@ class DB:
         ) VALUES (?, ?, ?, ?, ?, ?, ?, ?);
         '''
         c.execute(query, params)
-    
+        r_id = c.lastrowid
+
+        # Normalize once here so matching never has to redo it
+        params = [r_id] + list(match_keys(inspection['name'],
+                                          inspection['address']))
+        query = '''
+        INSERT INTO ri_restaurant_keys (
+            restaurant_id, name_norm, address_norm
+        ) VALUES (?, ?, ?);
+        '''
+        c.execute(query, params)
+        return r_id
+
     def insert_inspection(self, inspection, r_id):
         '''
         Inserts new inspection into inspections table
@@ -232,12 +1075,13 @@ class DB:
                   inspection['inspection_type'],
                   inspection['results'],
                   inspection['violations'],
-                  r_id] 
+                  r_id,
+                  iso_date(inspection['date'])]
         query = '''
         INSERT INTO ri_inspections (
             id, risk, inspection_date, inspection_type, results, violations,
-            restaurant_id
-        ) VALUES (?, ?, ?, ?, ?, ?, ?);'''
+            restaurant_id, inspection_date_iso
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?);'''
         c.execute(query, params)
 
     def add_inspection_for_restaurant(self, inspection):
@@ -250,12 +1094,11 @@ class DB:
             # Check if restuarant is in db
             rest_id = self.check_restaurant(inspection)
             if not rest_id:
-                self.insert_restaurant(inspection)
-                rest_id = self.check_restaurant(inspection)
+                r_id = self.insert_restaurant(inspection)
                 response_code = 201
             else:
+                r_id = rest_id[0][0]
                 response_code = 200
-            r_id = rest_id[0]['id']
             
             # Insert new inspection associated with rest_id
             self.insert_inspection(inspection, r_id)
@@ -273,16 +1116,20 @@ class DB:
         # Load connection
         c = self.conn.cursor()
 
-        params = [tweet_lat, tweet_lon]
+        params = [tweet_lat, tweet_lon, tweet_lat, tweet_lat]
 
+        # The BETWEEN (slightly wider than the box) lets the latitude index
+        # narrow the rows; the ABS tests keep the exact bounds
         query = '''
         SELECT id FROM ri_restaurants 
-        WHERE ABS(latitude - ?)  <= 0.00225001 
-        AND ABS(longitude - ?) <= 0.00302190 
-        ;'''
+        WHERE ABS(latitude - ?)  <= %(lat)s 
+        AND ABS(longitude - ?) <= %(lon)s 
+        AND latitude BETWEEN ? - %(wide)s AND ? + %(wide)s
+        ;''' % {'lat': TWEET_LAT_DISTANCE, 'lon': TWEET_LON_DISTANCE,
+                 'wide': TWEET_LAT_DISTANCE * 1.0001}
         c.execute(query, params)
         
-        return [dict['id'] for dict in c.fetchall()]
+        return [row[0] for row in c.fetchall()]
 
     def check_tweet_name(self, tweet_text):
         '''
@@ -295,14 +1142,14 @@ class DB:
         ngram_list = get_all_ngrams(tweet_text)
 
         questionmarks = '?' * len(ngram_list)
-        query = '''SELECT id 
-                    FROM ri_restaurants 
-                    WHERE name in (%s)''' % (",").join(questionmarks)
+        query = '''SELECT restaurant_id AS id 
+                    FROM ri_restaurant_keys 
+                    WHERE name_norm in (%s)''' % (",").join(questionmarks)
 
         params = ngram_list
         c.execute(query, params)
         
-        return [dict['id'] for dict in c.fetchall()]
+        return [row[0] for row in c.fetchall()]
 
 
     def insert_tweet_match(self, tkey, r_id, match):
@@ -320,13 +1167,113 @@ class DB:
         c.execute(query, params)
         self.conn.commit() 
 
-    def match_and_add_tweet(self, tweet):
+    def match_generation(self):
+        """
+        Returns the generation that writes to restaurant names and
+        coordinates bump, or None before /create has made the schema.
+        """
+        # Load connection
+        c = self.conn.cursor()
+        query = '''SELECT value
+                  FROM ri_meta
+                  WHERE name = 'match_generation' '''
+        try:
+            c.execute(query)
+        except sqlite3.OperationalError:
+            return None
+        row = c.fetchone()
+        return row[0] if row else None
+
+    def query_match_points(self, after=None, limit=None):
+        '''
+        Returns (id, latitude, longitude) of the restaurants with both
+        coordinates in id order, optionally paged as query_inspections.
+        "+ 0.0" reads text coordinates as the location match does.
+        '''
+        # Load connection
+        c = self.conn.cursor()
+        params = []
+        query = '''SELECT id, latitude + 0.0, longitude + 0.0
+                  FROM ri_restaurants
+                  WHERE latitude IS NOT NULL AND longitude IS NOT NULL '''
+        if after is not None:
+            query += "AND id > ? "
+            params.append(after)
+        query += "ORDER BY id "
+        if limit is not None:
+            query += "LIMIT ?"
+            params.append(limit)
+        c.execute(query, params)
+        return c.fetchall()
+
+    def query_match_names(self, after=None, limit=None):
+        '''
+        Returns (restaurant_id, name_norm) of the restaurants with a name key
+        in id order, optionally paged as query_inspections.
+        '''
+        # Load connection
+        c = self.conn.cursor()
+        params = []
+        query = '''SELECT restaurant_id, name_norm
+                  FROM ri_restaurant_keys
+                  WHERE name_norm IS NOT NULL '''
+        if after is not None:
+            query += "AND restaurant_id > ? "
+            params.append(after)
+        query += "ORDER BY restaurant_id "
+        if limit is not None:
+            query += "LIMIT ?"
+            params.append(limit)
+        c.execute(query, params)
+        return c.fetchall()
+
+    def find_match_points(self, restaurant_ids):
+        '''
+        Returns a dict of id to (latitude, longitude) for the given
+        restaurants that exist and have both coordinates.
+        '''
+        query = '''SELECT id, latitude + 0.0, longitude + 0.0
+                  FROM ri_restaurants
+                  WHERE id IN (%s)
+                  AND latitude IS NOT NULL AND longitude IS NOT NULL'''
+        _, grouped = self.query_by_restaurant_ids(query, restaurant_ids)
+        return {r_id: rows[0] for r_id, rows in grouped.items()}
+
+    def find_match_names(self, restaurant_ids):
+        '''
+        Returns a dict of restaurant id to name_norm for the given
+        restaurants that have a name key.
+        '''
+        query = '''SELECT restaurant_id, name_norm
+                  FROM ri_restaurant_keys
+                  WHERE restaurant_id IN (%s) AND name_norm IS NOT NULL'''
+        _, grouped = self.query_by_restaurant_ids(query, restaurant_ids)
+        return {r_id: rows[0][0] for r_id, rows in grouped.items()}
+
+    def file_name(self):
+        '''
+        Returns the path of the database file, or '' for an in-memory one.
+        '''
+        # Load connection
+        c = self.conn.cursor()
+        c.execute("PRAGMA database_list;")
+        return c.fetchone()[2]
+
+    def match_and_add_tweet(self, tweet, index=None):
         '''
         Checks tweet for matching restaurant, adds tweets to DB, and returns
-        list of corresponding restaurant_ids.
+        list of corresponding restaurant_ids. A MatchIndex is used for the
+        lookups once it has caught up with the restaurant changes; until
+        then, as while it is rebuilt, they are made with SQL.
         '''
-        loc_match_list = self.check_tweet_location(tweet['lat'], tweet['long'])
-        name_match_list = self.check_tweet_name(tweet['text'])
+        loc_match_list = None
+        if index is not None and index.catch_up(self):
+            loc_match_list = index.locate(tweet['lat'], tweet['long'])
+            name_match_list = index.match_names(get_all_ngrams(tweet['text']))
+        else:
+            name_match_list = self.check_tweet_name(tweet['text'])
+        if loc_match_list is None:
+            loc_match_list = self.check_tweet_location(tweet['lat'], tweet['long'])
 
         # Combine lists to dictionary with correct labels
         tweet_match_dict = {r_id:  'geo' for r_id in loc_match_list}
@@ -344,28 +1291,189 @@ class DB:
 
     def find_tweets(self, restaurant_id):
         """
-        Searches for all tweets associated with the given restaurant.
-        Returns an empty dict if no matching tweets are found.
+        Returns the first tweet (tkey and match) associated with the given
+        restaurant. The result is empty if no matching tweets are found.
         """
         # Load connection
         c = self.conn.cursor()
         
         # Performing the SQL query
         params = [str(restaurant_id)]
-        query = '''SELECT * 
+        query = '''SELECT tkey, match 
                   FROM ri_tweetmatch 
                   WHERE restaurant_id = (?)
+                  LIMIT 1
                   '''
         c.execute(query, params)
-        tweets = c.fetchall()
-        if tweets:
-            return {key: val for key, val in tweets[0].items() 
-                        if key != 'restaurant_id'}
-        return {}
+        return ResultRows(statement_columns(query, c), c.fetchall())
+
+    def query_by_restaurant_ids(self, query, restaurant_ids):
+        """
+        Runs query, which has one IN (%s) placeholder and a restaurant id as
+        its first column, for restaurant_ids in chunks. Returns the column
+        names (without the id) and the rows grouped by id in one pass.
+        """
+        c = self.conn.cursor()
+        columns = None
+        grouped = {}
+        restaurant_ids = list(restaurant_ids)
+        for start in range(0, len(restaurant_ids), MULTI_GET_CHUNK):
+            chunk = restaurant_ids[start:start + MULTI_GET_CHUNK]
+            chunk_query = query % ', '.join('?' * len(chunk))
+            c.execute(chunk_query, chunk)
+            if columns is None:
+                columns = statement_columns(chunk_query, c)[1:]
+            for row in c.fetchall():
+                grouped.setdefault(row[0], []).append(row[1:])
+        return columns, grouped
+
+    def find_restaurants(self, restaurant_ids):
+        """
+        Set-based find_restaurant: returns a dict of id to ResultRows for the
+        ids that exist.
+        """
+        query = '''SELECT id, %s
+                  FROM ri_restaurants
+                  WHERE id IN (%%s)''' % ', '.join(RESTAURANT_COLUMNS)
+        columns, grouped = self.query_by_restaurant_ids(query, restaurant_ids)
+        return {r_id: ResultRows(columns, rows) for r_id, rows in grouped.items()}
+
+    def find_inspections_by_restaurants(self, restaurant_ids):
+        """
+        Set-based find_inspections: returns a dict of restaurant id to
+        ResultRows. Restaurants without inspections are left out.
+        """
+        query = '''SELECT restaurant_id, %s
+                  FROM ri_inspections
+                  WHERE restaurant_id IN (%%s)
+                  ORDER BY restaurant_id, rowid''' % ', '.join(INSPECTION_COLUMNS)
+        columns, grouped = self.query_by_restaurant_ids(query, restaurant_ids)
+        return {r_id: ResultRows(columns, rows) for r_id, rows in grouped.items()}
+
+    def find_tweets_by_restaurants(self, restaurant_ids):
+        """
+        Set-based find_tweets: returns a dict of restaurant id to ResultRows
+        holding that restaurant's first tweet.
+        """
+        query = '''SELECT restaurant_id, tkey, match
+                  FROM ri_tweetmatch
+                  WHERE restaurant_id IN (%s)
+                  ORDER BY rowid'''
+        columns, grouped = self.query_by_restaurant_ids(query, restaurant_ids)
+        return {r_id: ResultRows(columns, rows[:1])
+                for r_id, rows in grouped.items()}
+
+    def query_export_restaurants(self, zips=None, date_from=None,
+                                 date_to=None, clean=None):
+        """
+        Executes the restaurant export in id order and returns the open
+        cursor and its column names. A date range keeps the restaurants with
+        an inspection in that range.
+        """
+        # Load connection
+        c = self.conn.cursor()
+
+        conditions, params = export_filters(zips, None, None, clean)
+        if date_from is not None or date_to is not None:
+            date_conditions, date_params = export_filters(
+                date_from=date_from, date_to=date_to)
+            conditions.append('''EXISTS (SELECT 1 FROM ri_inspections i
+                                 WHERE i.restaurant_id = r.id AND %s)'''
+                              % ' AND '.join(date_conditions))
+            params.extend(date_params)
+        query = '''SELECT %s
+                  FROM ri_restaurants r
+                  ''' % ', '.join('r.' + col for col in RESTAURANT_COLUMNS)
+        if conditions:
+            query += 'WHERE ' + ' AND '.join(conditions) + ' '
+        query += 'ORDER BY r.id'
+        c.execute(query, params)
+        return c, statement_columns(query, c)
+
+    def query_export_inspections(self, zips=None, date_from=None,
+                                 date_to=None, clean=None, resolve=False):
+        """
+        Executes the inspection export in load order and returns the open
+        cursor and its column names. With resolve, restaurant_id is the
+        ri_linked primary of the inspection's restaurant (when it has one)
+        and the zip/clean filters apply to that primary.
+        """
+        # Load connection
+        c = self.conn.cursor()
+
+        columns = ['i.' + col for col in INSPECTION_COLUMNS]
+        if resolve:
+            restaurant_id = 'COALESCE(l.primary_rest_id, i.restaurant_id)'
+            columns[INSPECTION_COLUMNS.index('restaurant_id')] = (
+                restaurant_id + ' AS restaurant_id')
+            joins = '''LEFT JOIN (SELECT original_rest_id,
+                                    MIN(primary_rest_id) AS primary_rest_id
+                                 FROM ri_linked GROUP BY original_rest_id) l
+                        ON l.original_rest_id = i.restaurant_id
+                      '''
+        else:
+            restaurant_id = 'i.restaurant_id'
+            joins = ''
+        conditions, params = export_filters(zips, date_from, date_to, clean)
+        if zips or clean is not None:
+            joins += 'JOIN ri_restaurants r ON r.id = %s ' % restaurant_id
+        query = '''SELECT %s
+                  FROM ri_inspections i
+                  %s''' % (', '.join(columns), joins)
+        if conditions:
+            query += 'WHERE ' + ' AND '.join(conditions) + ' '
+        query += 'ORDER BY i.rowid'
+        c.execute(query, params)
+        return c, statement_columns(query, c)
+
+def export_filters(zips=None, date_from=None, date_to=None, clean=None):
+    '''
+    Builds the WHERE conditions and parameters shared by the exports. The
+    restaurant is aliased r and its inspections i; dates are YYYY-MM-DD.
+    '''
+    conditions = []
+    params = []
+    if zips:
+        conditions.append('r.zip IN (%s)' % ', '.join('?' * len(zips)))
+        params.extend(zips)
+    if clean is not None:
+        conditions.append('r.clean = ?')
+        params.append(int(clean))
+    if date_from is not None:
+        conditions.append('i.inspection_date_iso >= ?')
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append('i.inspection_date_iso <= ?')
+        params.append(date_to)
+    return conditions, params
+
+def iso_date(value):
+    '''
+    Returns an MM/DD/YYYY (or already YYYY-MM-DD) date as YYYY-MM-DD, or
+    None if it is neither, as ISO_DATE_SQL does.
+    '''
+    if not isinstance(value, str):
+        return None
+    match = US_DATE.fullmatch(value)
+    if match:
+        return '%s-%s-%s' % (match.group(3), match.group(1), match.group(2))
+    if ISO_DATE.fullmatch(value):
+        return value
+    return None
+
+def fetch_batches(cursor, batch_size=EXPORT_BATCH_SIZE):
+    '''
+    Yields the rows of an executed cursor in fetchmany batches, then closes it.
+    '''
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        yield batch
+    cursor.close()
 
 def ngrams(tweet, n):
-    single_word = tweet.translate(str.maketrans('', '', 
-                                            string.punctuation)).upper().split()
+    single_word = normalize(tweet).split()
     output = []
     for i in range(len(single_word) - n + 1):
         output.append(' '.join(single_word[i:i + n]))
@@ -376,3 +1484,18 @@ def get_all_ngrams(tweet, max_n=4):
     for n in range(1, max_n+1):
         ngrams_list.extend(ngrams(tweet, n))
     return ngrams_list
+
+# Ordered (version, migration) pairs applied by DB.migrate
+MIGRATIONS = [
+    (1, DB.migrate_restaurant_keys),
+    (2, DB.migrate_inspection_index),
+    (3, DB.migrate_counters),
+    (4, DB.migrate_query_indexes),
+    (5, DB.migrate_match_generation),
+    (6, DB.migrate_change_log),
+    (7, DB.migrate_rollups),
+    (8, DB.migrate_violation_search),
+    (9, DB.migrate_seeded_restaurant_keys),
+    (10, DB.migrate_drop_unused_keys),
+    (11, DB.migrate_log_restaurant_keys),
+]
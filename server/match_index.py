@@ -0,0 +1,391 @@
+# Tweet matching index persisted next to the database in a flat binary file
+# that is mmap'ed at startup instead of being rebuilt from ri_restaurants.
+#
+# Layout (little-endian, every array 8-byte aligned):
+#   header  HEADER: magic, format version, generation, points, names, blob size
+#   lat     float64[points]   restaurant latitudes, ascending
+#   lon     float64[points]   longitude of the same restaurant
+#   ids     int64[points]     id of the same restaurant
+#   offsets uint64[names + 1] start of each name_norm in blob
+#   name_id int64[names]      restaurant id of each name, ordered by (name, id)
+#   blob    utf-8 name_norm values, concatenated in byte order
+#
+# Restaurants written after the file was built are overlaid in memory: the
+# index follows the change log (changes.py) as consumer 'match_index', and the
+# current point and name of each changed restaurant replace those in the file.
+# The file is rebuilt on a background thread once the overlay grows too big,
+# or when the log cannot be followed (first use, /reset).
+from bisect import bisect_left, bisect_right, insort
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import threading
+
+from changes import ChangeConsumer
+from db import DB, TWEET_LAT_DISTANCE, TWEET_LON_DISTANCE
+
+MAGIC = b'RMIX'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sIQQQQ')
+HEADER_SIZE = HEADER.size + (-HEADER.size % 8)
+# Same widening as the BETWEEN in DB.check_tweet_location
+LAT_WINDOW = TWEET_LAT_DISTANCE * 1.0001
+# Coordinates SQLite and float() read alike; anything else goes to SQL
+NUMBER = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$')
+# Tables whose changes can move a restaurant in or out of a match
+MATCH_TABLES = ('ri_restaurants', 'ri_restaurant_keys')
+# Changed restaurants overlaid before the file is rebuilt
+OVERLAY_LIMIT = 10000
+# Log entries of other tables left unread before the cursor is moved past
+# them, so tweets alone do not grow the log
+MAX_BACKLOG = 10000
+# Rows read per statement by a build, so that it never keeps writers out of
+# the database for long
+BUILD_PAGE = 10000
+INF = float('inf')
+
+
+def index_file(db_name):
+    '''
+    Returns the index file kept next to a database, eg insp.db -> insp.match
+    '''
+    stem, dot, _ = db_name.rpartition('.')
+    return '%s.match' % (stem if dot else db_name)
+
+
+def coordinate(value):
+    '''
+    Returns a tweet coordinate as a float, or None if it is not a plain
+    number (eg "" or null), in which case the SQL match is used.
+    '''
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str) and NUMBER.match(value):
+        return float(value)
+    return None
+
+
+def padded(data):
+    return data + b'\0' * (-len(data) % 8)
+
+
+def paged(query):
+    '''
+    Returns every row of a query(after, limit) paged by its first column.
+    '''
+    rows = []
+    after = None
+    while True:
+        page = query(after, BUILD_PAGE)
+        rows.extend(page)
+        if len(page) < BUILD_PAGE:
+            return rows
+        after = page[-1][0]
+
+
+def build_index(db, file_name):
+    '''
+    Writes the index of the database's current restaurants to file_name,
+    replacing any previous file in one step. Restaurants written while it
+    reads may or may not be included; the change log has them.
+    '''
+    generation = db.match_generation()
+    points = sorted((lat, r_id, lon)
+                    for r_id, lat, lon in paged(db.query_match_points))
+    encoded = sorted((name.encode('utf-8'), r_id)
+                     for r_id, name in paged(db.query_match_names))
+    offsets = [0]
+    for name, _ in encoded:
+        offsets.append(offsets[-1] + len(name))
+
+    tmp_name = file_name + '.tmp'
+    with open(tmp_name, 'wb') as f:
+        f.write(padded(HEADER.pack(MAGIC, FORMAT_VERSION, generation,
+                                   len(points), len(encoded), offsets[-1])))
+        for column, code in ((0, 'd'), (2, 'd'), (1, 'q')):
+            f.write(struct.pack('<%d%s' % (len(points), code),
+                                *[row[column] for row in points]))
+        f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+        f.write(struct.pack('<%dq' % len(encoded), *[r_id for _, r_id in encoded]))
+        f.write(padded(b''.join(name for name, _ in encoded)))
+    os.replace(tmp_name, file_name)
+
+
+def build_from_file(db_file, file_name):
+    '''
+    build_index over a connection of its own, for a background thread.
+    '''
+    conn = sqlite3.connect(db_file)
+    try:
+        build_index(DB(conn), file_name)
+    finally:
+        conn.close()
+
+
+class MatchIndex:
+    """
+    The index file, mapped read-only, plus the overlay of the restaurants
+    changed since it was built. The file's arrays are memoryviews straight
+    over the mapping, so loading costs a header read however many
+    restaurants are indexed, and pages are only read as lookups touch them.
+
+    The database's match generation (see ri_meta) is bumped by every write
+    to restaurant names or coordinates. The index is current while its
+    generation is the database's; catch_up() applies the logged changes to
+    make it so, and lookups go to SQL while it cannot.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.map = None
+        self.generation = None
+        self.builder = None
+        self.build_error = None
+        self.consumer = ChangeConsumer('match_index', self.build_in_background,
+                                       self.apply, tables=MATCH_TABLES)
+        self.clear_overlay()
+
+    def clear_overlay(self):
+        # Restaurants whose entries in the file are out of date
+        self.changed = set()
+        # (latitude, id, longitude) of the changed ones, sorted
+        self.points = []
+        self.point_of = {}
+        # name_norm -> ids of the changed ones, and back
+        self.names = {}
+        self.name_of = {}
+
+    def load(self):
+        '''
+        Maps the file. Raises ValueError if it is of another format.
+        '''
+        with open(self.file_name, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, generation, n_points, n_names, blob_size = (
+            HEADER.unpack_from(self.map))
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.close()
+            raise ValueError('Not a version %d match index' % FORMAT_VERSION)
+        self.view = memoryview(self.map)
+        pos = HEADER_SIZE
+        arrays = []
+        for length, code in ((n_points, 'd'), (n_points, 'd'), (n_points, 'q'),
+                             (n_names + 1, 'Q'), (n_names, 'q')):
+            arrays.append(self.view[pos:pos + 8 * length].cast(code))
+            pos += 8 * length
+        self.lat, self.lon, self.ids, self.offsets, self.name_ids = arrays
+        self.blob_start = pos
+        self.generation = generation
+
+    def close(self):
+        if self.map is None:
+            return
+        if self.generation is not None:
+            for array in (self.lat, self.lon, self.ids, self.offsets,
+                          self.name_ids, self.view):
+                array.release()
+        self.map.close()
+        self.map = None
+        self.generation = None
+
+    def is_fresh(self, db):
+        return self.generation is not None and (
+            self.generation == db.match_generation())
+
+    def refresh(self, db):
+        '''
+        Makes the index current now: maps the file if it matches the
+        database, otherwise rebuilds it from the database first, and starts
+        following the change log. Returns True if it was rebuilt. Without a
+        schema the index stays unloaded. For startup; requests catch_up().
+        '''
+        if self.builder is not None:
+            self.builder.join()
+            self.builder = None
+        self.close()
+        self.clear_overlay()
+        if db.match_generation() is None:
+            # Nothing to index until the schema exists
+            return False
+        db.register_change_consumer(self.consumer.name)
+        try:
+            self.load()
+            if self.is_fresh(db):
+                return False
+            self.close()
+        except (OSError, ValueError, struct.error):
+            self.close()
+        build_index(db, self.file_name)
+        self.load()
+        return True
+
+    def catch_up(self, db):
+        '''
+        Applies the restaurant changes committed since the index was last
+        current and returns whether it is current now. It is not while a
+        rebuild runs, nor while uncommitted changes are pending, and tweets
+        are then matched with SQL.
+        '''
+        if self.builder is not None and not self.builder.is_alive():
+            self.finish_build()
+        if self.is_fresh(db):
+            if (self.builder is None and not db.in_transaction()
+                    and self.consumer.backlog(db) > MAX_BACKLOG):
+                # Only other tables were written; move past their entries
+                self.consumer.consume(db)
+            return True
+        generation = db.match_generation()
+        if (self.builder is not None or generation is None
+                or db.in_transaction()):
+            return False
+        if self.generation is None:
+            # Never loaded, or the last build failed
+            self.rebuild(db)
+            return False
+        if self.consumer.consume(db) is None:
+            # The cursor was lost (/reset); a rebuild has been started
+            return False
+        self.generation = generation
+        if len(self.changed) > OVERLAY_LIMIT:
+            # Still current: the new file replaces this one once built
+            self.rebuild(db)
+        return True
+
+    def rebuild(self, db):
+        '''
+        Starts rebuilding the file in the background, following the change
+        log from now on. The index is used as it is until the new file is
+        loaded, as long as it stays current. Returns whether a rebuild was
+        started: none is while one runs or a transaction is open.
+        '''
+        if self.builder is not None or db.in_transaction():
+            return False
+        self.consumer.stop(db)
+        self.consumer.consume(db)
+        return True
+
+    def build_in_background(self, db):
+        # The consumer's rebuild: its cursor was just set to the log's end
+        db_file = db.file_name()
+        if not db_file:
+            # An in-memory database cannot be opened from another thread
+            build_index(db, self.file_name)
+            self.finish_build()
+            return
+        self.build_error = None
+        self.builder = threading.Thread(target=self.build, args=(db_file,),
+                                        name="match-index", daemon=True)
+        self.builder.start()
+
+    def build(self, db_file):
+        try:
+            build_from_file(db_file, self.file_name)
+        except Exception as e:
+            self.build_error = e
+
+    def finish_build(self):
+        '''
+        Swaps in the file a finished build wrote, with an empty overlay.
+        '''
+        self.builder = None
+        self.close()
+        self.clear_overlay()
+        if self.build_error is not None:
+            logging.warning("Tweet match index build failed: %s",
+                            self.build_error)
+            return
+        try:
+            self.load()
+        except (OSError, ValueError, struct.error) as e:
+            logging.warning("Tweet match index not loaded: %s", e)
+            self.close()
+
+    def apply(self, db, changes):
+        '''
+        Overlays the current point and name of the changed restaurants.
+        '''
+        ids = {change.row_id for change in changes}
+        points = db.find_match_points(ids)
+        names = db.find_match_names(ids)
+        for r_id in ids:
+            old = self.point_of.pop(r_id, None)
+            if old is not None:
+                del self.points[bisect_left(self.points, old)]
+            if r_id in points:
+                point = (points[r_id][0], r_id, points[r_id][1])
+                insort(self.points, point)
+                self.point_of[r_id] = point
+            old = self.name_of.pop(r_id, None)
+            if old is not None:
+                self.names[old].discard(r_id)
+                if not self.names[old]:
+                    del self.names[old]
+            if r_id in names:
+                self.name_of[r_id] = names[r_id]
+                self.names.setdefault(names[r_id], set()).add(r_id)
+        self.changed.update(ids)
+
+    def locate(self, tweet_lat, tweet_lon):
+        '''
+        Ids of restaurants inside the tweet's location box, as
+        DB.check_tweet_location, or None if a coordinate is not a number.
+        '''
+        tweet_lat, tweet_lon = coordinate(tweet_lat), coordinate(tweet_lon)
+        if tweet_lat is None or tweet_lon is None:
+            return None
+        low, high = tweet_lat - LAT_WINDOW, tweet_lat + LAT_WINDOW
+        start = bisect_left(self.lat, low)
+        end = bisect_right(self.lat, high)
+        lat, lon, ids = self.lat, self.lon, self.ids
+        inside = [i for i in range(start, end)
+                  if abs(lat[i] - tweet_lat) <= TWEET_LAT_DISTANCE
+                  and abs(lon[i] - tweet_lon) <= TWEET_LON_DISTANCE]
+        if not self.changed:
+            return [ids[i] for i in inside]
+        # Merged with the overlay in the file's (latitude, id) order
+        found = [(lat[i], ids[i]) for i in inside
+                 if ids[i] not in self.changed]
+        found.extend((p_lat, r_id) for p_lat, r_id, p_lon in
+                     self.points[bisect_left(self.points, (low,)):
+                                 bisect_right(self.points, (high, INF))]
+                     if abs(p_lat - tweet_lat) <= TWEET_LAT_DISTANCE
+                     and abs(p_lon - tweet_lon) <= TWEET_LON_DISTANCE)
+        found.sort()
+        return [r_id for _, r_id in found]
+
+    def name_at(self, i):
+        return self.map[self.blob_start + self.offsets[i]:
+                        self.blob_start + self.offsets[i + 1]]
+
+    def lookup_name(self, name):
+        '''
+        Ids of restaurants whose name_norm is exactly name.
+        '''
+        key = name.encode('utf-8')
+        low, high = 0, len(self.name_ids)
+        while low < high:
+            mid = (low + high) // 2
+            if self.name_at(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        ids = []
+        while low < len(self.name_ids) and self.name_at(low) == key:
+            if self.name_ids[low] not in self.changed:
+                ids.append(self.name_ids[low])
+            low += 1
+        if name in self.names:
+            ids = sorted(ids + list(self.names[name]))
+        return ids
+
+    def match_names(self, names):
+        '''
+        Ids of restaurants whose name_norm is any of names, as
+        DB.check_tweet_name.
+        '''
+        return [r_id for name in sorted(set(names))
+                for r_id in self.lookup_name(name)]
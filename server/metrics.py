@@ -0,0 +1,257 @@
+# In-process metrics rendered in the Prometheus text format at /metrics:
+# per-route request counts and latency, per-statement SQL timings and
+# cleaning phase timers
+from bisect import bisect_left
+import functools
+import re
+import sqlite3
+import threading
+import time
+
+from bottle import HTTPResponse, response
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Upper bounds (seconds) of the latency histogram buckets, +Inf is implied
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Bounds the memo of SQL text to statement label
+MAX_STATEMENT_LABELS = 1024
+# IN (?, ?, ?) lists of any length share one label
+PLACEHOLDER_LIST = re.compile(r'\?(\s*,\s*\?)+')
+
+
+class Histogram:
+    """
+    Per-bucket (not cumulative) counts and the sum of observed values.
+    """
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self, n_buckets):
+        self.counts = [0] * (n_buckets + 1)
+        self.sum = 0.0
+
+
+class Registry:
+    """
+    Counters and histograms keyed by metric name and a tuple of
+    (label, value) pairs. Observing is a dict lookup, a bisect and two
+    additions so it is cheap enough to stay on for every request. Updates
+    take a lock, as the --shards server handles requests on several threads.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, help_text):
+        '''
+        Registers a metric; kind is 'counter' or 'histogram'.
+        '''
+        self.metrics[name] = (kind, help_text, {})
+
+    def inc(self, name, labels, amount=1):
+        series = self.metrics[name][2]
+        with self.lock:
+            series[labels] = series.get(labels, 0) + amount
+
+    def observe(self, name, labels, value):
+        series = self.metrics[name][2]
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            hist = series.get(labels)
+            if hist is None:
+                hist = series[labels] = Histogram(len(self.buckets))
+            hist.counts[bucket] += 1
+            hist.sum += value
+
+    def clear(self):
+        with self.lock:
+            for _, _, series in self.metrics.values():
+                series.clear()
+
+    def render(self):
+        '''
+        Returns every metric in the Prometheus text exposition format.
+        '''
+        bounds = [format_value(b) for b in self.buckets] + ['+Inf']
+        lines = []
+        for name, (kind, help_text, series) in self.metrics.items():
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            with self.lock:
+                snapshot = sorted((labels, value if kind == 'counter'
+                                   else (list(value.counts), value.sum))
+                                  for labels, value in series.items())
+            for labels, value in snapshot:
+                if kind == 'counter':
+                    lines.append('%s%s %s' % (name, format_labels(labels),
+                                              format_value(value)))
+                    continue
+                counts, value_sum = value
+                total = 0
+                for bound, count in zip(bounds, counts):
+                    total += count
+                    lines.append('%s_bucket%s %d' % (
+                        name, format_labels(labels + (('le', bound),)), total))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels),
+                                              format_value(value_sum)))
+                lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                                total))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels)
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+METRICS = Registry()
+METRICS.describe('http_requests_total', 'counter',
+                 'Requests handled, by route and response status.')
+METRICS.describe('http_request_duration_seconds', 'histogram',
+                 'Time spent in the route handler.')
+METRICS.describe('sql_statement_duration_seconds', 'histogram',
+                 'Time spent in execute()/executemany(), by statement.')
+METRICS.describe('sql_fetch_seconds_total', 'counter',
+                 'Time spent fetching rows, by statement.')
+METRICS.describe('cleaning_phase_duration_seconds', 'histogram',
+                 'Time spent in each phase of /clean.')
+
+
+class RouteMetrics:
+    """
+    Bottle plugin recording a request count (by status) and a latency
+    observation for every route. Routes are labelled by their rule, eg
+    /restaurants/<restaurant_id:int>, so the number of series stays fixed.
+    Streamed responses are timed until the handler returns its generator.
+    """
+    name = 'route_metrics'
+    api = 2
+
+    def __init__(self, registry=METRICS):
+        self.registry = registry
+
+    def apply(self, callback, route):
+        labels = (('method', route.method), ('route', route.rule))
+        registry = self.registry
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            status = 500
+            try:
+                body = callback(*args, **kwargs)
+                status = response.status_code
+                return body
+            except HTTPResponse as e:
+                status = e.status_code
+                raise
+            finally:
+                registry.observe('http_request_duration_seconds', labels,
+                                 time.perf_counter() - start)
+                registry.inc('http_requests_total',
+                             labels + (('status', status),))
+        return wrapper
+
+
+STATEMENT_LABELS = {}
+
+def statement_label(sql):
+    '''
+    Collapses whitespace and placeholder lists so every call site of a
+    statement shares one label.
+    '''
+    label = STATEMENT_LABELS.get(sql)
+    if label is None:
+        label = PLACEHOLDER_LIST.sub('?, ...', ' '.join(sql.split()))
+        if len(STATEMENT_LABELS) < MAX_STATEMENT_LABELS:
+            STATEMENT_LABELS[sql] = label
+    return label
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursor that times each execute()/executemany() and the fetches that
+    follow it. The sqlite3 trace callback only reports the statement text and
+    the progress handler only fires every N VM steps, so neither can give a
+    duration per statement; timing the calls themselves can.
+    """
+    statement = ()
+
+    def execute(self, sql, parameters=()):
+        self.statement = (('statement', statement_label(sql)),)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            METRICS.observe('sql_statement_duration_seconds', self.statement,
+                            time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.statement = (('statement', statement_label(sql)),)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            METRICS.observe('sql_statement_duration_seconds', self.statement,
+                            time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            METRICS.inc('sql_fetch_seconds_total', self.statement,
+                        time.perf_counter() - start)
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            if size is None:
+                return super().fetchmany()
+            return super().fetchmany(size)
+        finally:
+            METRICS.inc('sql_fetch_seconds_total', self.statement,
+                        time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            METRICS.inc('sql_fetch_seconds_total', self.statement,
+                        time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Connection whose cursors are TimedCursors. Pass it as the factory to
+    sqlite3.connect() to turn SQL timing on.
+    """
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+
+def timed_phase(phase):
+    '''
+    Decorator recording the duration of each call as a cleaning phase.
+    '''
+    labels = (('phase', phase),)
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                METRICS.observe('cleaning_phase_duration_seconds', labels,
+                                time.perf_counter() - start)
+        return wrapper
+    return decorate
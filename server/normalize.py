@@ -0,0 +1,21 @@
+# Normalized match keys computed once at ingest time
+import string
+
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+
+def normalize(text):
+    '''
+    Uppercases text, strips punctuation and collapses whitespace.
+    '''
+    if not text:
+        return ''
+    return ' '.join(text.translate(PUNCTUATION_TABLE).upper().split())
+
+
+def match_keys(name, address):
+    '''
+    Computes the stored match keys for a restaurant, in the column order of
+    ri_restaurant_keys: (name_norm, address_norm)
+    '''
+    return normalize(name), normalize(address)
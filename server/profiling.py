@@ -0,0 +1,104 @@
+# On-demand cProfile of single requests, kept in a ring buffer and served
+# under /debug/profiles. cProfile and pstats are imported when a request is
+# first profiled or reported, so they cost nothing at startup.
+from collections import deque, namedtuple
+import io
+import itertools
+import time
+
+from bottle import HTTPResponse, request, response
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_QUERY_FLAG = 'profile'
+SORT_KEYS = ('cumulative', 'tottime', 'calls')
+
+Profile = namedtuple('Profile', ['id', 'method', 'route', 'path', 'status',
+                                 'seconds', 'timestamp', 'stats'])
+
+
+class RequestProfiler:
+    """
+    Bottle plugin that runs a request under cProfile when it carries an
+    X-Profile: 1 header or a ?profile=1 query flag. Only routes whose rule
+    is in `routes` (eg /tweet, /clean) are wrapped at all, so every other
+    route, and the whole app when the profiler is not installed, pays
+    nothing. The last `keep` profiles are kept in memory.
+    """
+    name = 'request_profiler'
+    api = 2
+
+    def __init__(self, routes=(), keep=20):
+        self.routes = set(routes)
+        self.profiles = deque(maxlen=keep)
+        self.ids = itertools.count(1)
+
+    def apply(self, callback, route):
+        if route.rule not in self.routes:
+            return callback
+
+        def wrapper(*args, **kwargs):
+            flag = (request.get_header(PROFILE_HEADER)
+                    or request.query.get(PROFILE_QUERY_FLAG))
+            if not flag or flag.lower() in ('0', 'false', 'no'):
+                return callback(*args, **kwargs)
+            import cProfile
+            profile_id = next(self.ids)
+            profiler = cProfile.Profile()
+            status = 500
+            start = time.perf_counter()
+            try:
+                body = profiler.runcall(callback, *args, **kwargs)
+                status = response.status_code
+                response.set_header('X-Profile-Id', str(profile_id))
+                return body
+            except HTTPResponse as e:
+                status = e.status_code
+                e.set_header('X-Profile-Id', str(profile_id))
+                raise
+            finally:
+                seconds = time.perf_counter() - start
+                profiler.create_stats()
+                self.profiles.append(Profile(
+                    profile_id, route.method, route.rule, request.path,
+                    status, seconds, time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    profiler.stats))
+        return wrapper
+
+    def get(self, profile_id):
+        for profile in self.profiles:
+            if profile.id == profile_id:
+                return profile
+        return None
+
+    def listing(self):
+        '''
+        Returns the stored profiles, newest first, without their stats.
+        '''
+        return [{key: value for key, value in profile._asdict().items()
+                 if key != 'stats'}
+                for profile in reversed(self.profiles)]
+
+
+def summary(profile, sort='cumulative', limit=30):
+    '''
+    Returns the pstats report of a profile, its top `limit` functions
+    ordered by `sort`.
+    '''
+    import pstats
+    out = io.StringIO()
+    out.write('Profile %d: %s %s (%s) -> %s in %.6fs at %s\n\n' % (
+        profile.id, profile.method, profile.path, profile.route,
+        profile.status, profile.seconds, profile.timestamp))
+    stats = pstats.Stats(stream=out)
+    stats.stats = profile.stats
+    stats.get_top_level_stats()
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+def dump(profile):
+    '''
+    Returns the profile in the .pstats file format read by pstats.Stats.
+    '''
+    import marshal
+    return marshal.dumps(profile.stats)
@@ -0,0 +1,92 @@
+# Compact column-oriented copy of the restaurant attributes used by cleaning:
+# one array or list per attribute instead of one tuple (or dict) per row
+from array import array
+import sys
+
+# Rows fetched per fetchmany() call while loading
+LOAD_BATCH_SIZE = 1000
+STRING_FIELDS = ('name_norm', 'address_norm')
+# Column order the store is loaded from, eg SELECT id, name_norm, ...
+STORE_FIELDS = ('id',) + STRING_FIELDS + ('latitude', 'longitude', 'clean')
+
+
+class RestaurantStore:
+    """
+    Parallel columns indexed by position: ids and coordinates in typed
+    arrays (8 bytes per value, NaN for a missing coordinate), the normalized
+    match keys as lists of interned strings so repeated names and addresses
+    share one object, and the clean flags as a bitset.
+
+    Rows are addressed by index (0 <= i < len(store)), so callers loop with
+    range() and never copy or slice the columns.
+    """
+    def __init__(self):
+        self.ids = array('q')
+        self.strings = {field: [] for field in STRING_FIELDS}
+        self.latitude = array('d')
+        self.longitude = array('d')
+        self.clean_bits = bytearray()
+        self.size = 0
+
+    @classmethod
+    def from_cursor(cls, cursor, batch_size=LOAD_BATCH_SIZE):
+        '''
+        Loads an executed cursor whose columns are laid out as STORE_FIELDS,
+        batch_size rows at a time.
+        '''
+        store = cls()
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            store.extend(rows)
+            rows = cursor.fetchmany(batch_size)
+        return store
+
+    def extend(self, rows):
+        '''
+        Appends rows laid out as STORE_FIELDS.
+        '''
+        intern = sys.intern
+        nan = float('nan')
+        name_norm, address_norm = (self.strings[field]
+                                   for field in STRING_FIELDS)
+        for r_id, name, address, latitude, longitude, clean in rows:
+            index = self.size
+            self.ids.append(r_id)
+            name_norm.append(intern(name or ''))
+            address_norm.append(intern(address or ''))
+            self.latitude.append(nan if latitude is None else latitude)
+            self.longitude.append(nan if longitude is None else longitude)
+            if index & 7 == 0:
+                self.clean_bits.append(0)
+            if clean:
+                self.clean_bits[index >> 3] |= 1 << (index & 7)
+            self.size = index + 1
+
+    def __len__(self):
+        return self.size
+
+    def column(self, field):
+        '''
+        Returns the whole column for a STORE_FIELDS name (not a copy).
+        '''
+        if field == 'id':
+            return self.ids
+        if field in ('latitude', 'longitude'):
+            return getattr(self, field)
+        return self.strings[field]
+
+    def is_clean(self, index):
+        return bool(self.clean_bits[index >> 3] & (1 << (index & 7)))
+
+    def all_clean(self):
+        return (int.from_bytes(self.clean_bits, 'little').bit_count()
+                == self.size)
+
+    def record(self, index):
+        '''
+        Returns row `index` as a tuple laid out as STORE_FIELDS.
+        '''
+        return ((self.ids[index],)
+                + tuple(self.strings[field][index] for field in STRING_FIELDS)
+                + (self.latitude[index], self.longitude[index],
+                   int(self.is_clean(index))))
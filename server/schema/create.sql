@@ -2,6 +2,15 @@ DROP TABLE IF EXISTS ri_inspections;
 DROP TABLE IF EXISTS ri_restaurants;
 DROP TABLE IF EXISTS ri_tweetmatch;
 DROP TABLE IF EXISTS ri_linked;
+DROP TABLE IF EXISTS ri_restaurant_keys;
+DROP TABLE IF EXISTS ri_counters;
+DROP TABLE IF EXISTS ri_meta;
+DROP TABLE IF EXISTS ri_changes;
+DROP TABLE IF EXISTS ri_change_cursors;
+DROP TABLE IF EXISTS ri_rollup_zip;
+DROP TABLE IF EXISTS ri_rollup_cluster;
+DROP VIEW IF EXISTS ri_inspection_text;
+DROP TABLE IF EXISTS ri_inspections_fts;
 
 
 CREATE TABLE ri_restaurants (
@@ -25,6 +34,7 @@ CREATE TABLE ri_inspections (
     results varchar(50),
     violations text,
     restaurant_id int NOT NULL,
+    inspection_date_iso char(10),
     PRIMARY KEY (id),
     FOREIGN KEY (restaurant_id) REFERENCES ri_restaurants
 );
@@ -44,3 +54,390 @@ CREATE TABLE ri_linked (
     FOREIGN KEY (primary_rest_id) REFERENCES ri_restaurants,
     FOREIGN KEY (original_rest_id) REFERENCES ri_restaurants
 );
+
+CREATE TABLE ri_restaurant_keys (
+    restaurant_id int PRIMARY KEY,
+    name_norm varchar(60),
+    address_norm varchar(60),
+    FOREIGN KEY (restaurant_id) REFERENCES ri_restaurants
+);
+
+CREATE INDEX idx_restaurant_keys_name ON ri_restaurant_keys(name_norm);
+CREATE INDEX idx_inspections_restaurant ON ri_inspections(restaurant_id);
+CREATE INDEX idx_inspections_date_iso ON ri_inspections(inspection_date_iso);
+CREATE INDEX idx_restaurants_name_address ON ri_restaurants(name, address);
+CREATE INDEX idx_restaurants_zip ON ri_restaurants(zip);
+CREATE INDEX idx_restaurants_latitude ON ri_restaurants(latitude);
+CREATE INDEX idx_tweetmatch_restaurant ON ri_tweetmatch(restaurant_id);
+CREATE INDEX idx_linked_original ON ri_linked(original_rest_id);
+-- Partial index: only the rows /clean still has to mark
+CREATE INDEX idx_restaurants_dirty ON ri_restaurants(id) WHERE clean = 0;
+
+-- Row counters kept transactionally consistent by the triggers below
+CREATE TABLE ri_counters (
+    name varchar(30) PRIMARY KEY,
+    value int NOT NULL DEFAULT 0
+);
+
+INSERT INTO ri_counters (name, value) VALUES
+    ('inspections', 0), ('restaurants', 0), ('tweet_matches', 0);
+
+CREATE TRIGGER ri_inspections_count_insert AFTER INSERT ON ri_inspections
+BEGIN
+    UPDATE ri_counters SET value = value + 1 WHERE name = 'inspections';
+END;
+CREATE TRIGGER ri_inspections_count_delete AFTER DELETE ON ri_inspections
+BEGIN
+    UPDATE ri_counters SET value = value - 1 WHERE name = 'inspections';
+END;
+
+CREATE TRIGGER ri_restaurants_count_insert AFTER INSERT ON ri_restaurants
+BEGIN
+    UPDATE ri_counters SET value = value + 1 WHERE name = 'restaurants';
+END;
+CREATE TRIGGER ri_restaurants_count_delete AFTER DELETE ON ri_restaurants
+BEGIN
+    UPDATE ri_counters SET value = value - 1 WHERE name = 'restaurants';
+END;
+
+CREATE TRIGGER ri_tweetmatch_count_insert AFTER INSERT ON ri_tweetmatch
+BEGIN
+    UPDATE ri_counters SET value = value + 1 WHERE name = 'tweet_matches';
+END;
+CREATE TRIGGER ri_tweetmatch_count_delete AFTER DELETE ON ri_tweetmatch
+BEGIN
+    UPDATE ri_counters SET value = value - 1 WHERE name = 'tweet_matches';
+END;
+
+-- Bumped by writes to restaurant names and coordinates, so a persisted
+-- tweet match index can tell it is stale; starts at a random value
+CREATE TABLE ri_meta (
+    name varchar(30) PRIMARY KEY,
+    value int NOT NULL
+);
+
+INSERT INTO ri_meta (name, value) VALUES
+    ('match_generation', abs(random() % 1000000000000000)),
+    ('change_txn', 1);
+
+CREATE TRIGGER ri_restaurants_generation_insert AFTER INSERT ON ri_restaurants
+BEGIN
+    UPDATE ri_meta SET value = value + 1 WHERE name = 'match_generation';
+END;
+CREATE TRIGGER ri_restaurants_generation_delete AFTER DELETE ON ri_restaurants
+BEGIN
+    UPDATE ri_meta SET value = value + 1 WHERE name = 'match_generation';
+END;
+CREATE TRIGGER ri_restaurants_generation_update
+AFTER UPDATE OF latitude, longitude ON ri_restaurants
+BEGIN
+    UPDATE ri_meta SET value = value + 1 WHERE name = 'match_generation';
+END;
+
+CREATE TRIGGER ri_restaurant_keys_generation_insert AFTER INSERT ON ri_restaurant_keys
+BEGIN
+    UPDATE ri_meta SET value = value + 1 WHERE name = 'match_generation';
+END;
+CREATE TRIGGER ri_restaurant_keys_generation_delete AFTER DELETE ON ri_restaurant_keys
+BEGIN
+    UPDATE ri_meta SET value = value + 1 WHERE name = 'match_generation';
+END;
+CREATE TRIGGER ri_restaurant_keys_generation_update
+AFTER UPDATE OF name_norm ON ri_restaurant_keys
+BEGIN
+    UPDATE ri_meta SET value = value + 1 WHERE name = 'match_generation';
+END;
+
+-- Change log: (table, op, rowid, txn) of every row written, by restaurant_id
+-- for ri_restaurant_keys, appended only while some consumer has a cursor
+-- (see changes.py). Entries with the same
+-- txn were committed between two reads of the log.
+CREATE TABLE ri_changes (
+    seq integer PRIMARY KEY AUTOINCREMENT,
+    tbl varchar(30) NOT NULL,
+    op varchar(6) NOT NULL,
+    row_id int NOT NULL,
+    txn int NOT NULL
+);
+
+CREATE TABLE ri_change_cursors (
+    consumer varchar(30) PRIMARY KEY,
+    seq int NOT NULL
+);
+
+CREATE TRIGGER ri_restaurants_change_insert AFTER INSERT ON ri_restaurants
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_restaurants', 'insert', new.rowid, value FROM ri_meta WHERE name = 'change_txn';
+END;
+CREATE TRIGGER ri_restaurants_change_update AFTER UPDATE ON ri_restaurants
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_restaurants', 'update', new.rowid, value FROM ri_meta WHERE name = 'change_txn';
+END;
+CREATE TRIGGER ri_restaurants_change_delete AFTER DELETE ON ri_restaurants
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_restaurants', 'delete', old.rowid, value FROM ri_meta WHERE name = 'change_txn';
+END;
+
+CREATE TRIGGER ri_inspections_change_insert AFTER INSERT ON ri_inspections
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_inspections', 'insert', new.rowid, value FROM ri_meta WHERE name = 'change_txn';
+END;
+CREATE TRIGGER ri_inspections_change_update AFTER UPDATE ON ri_inspections
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_inspections', 'update', new.rowid, value FROM ri_meta WHERE name = 'change_txn';
+END;
+CREATE TRIGGER ri_inspections_change_delete AFTER DELETE ON ri_inspections
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_inspections', 'delete', old.rowid, value FROM ri_meta WHERE name = 'change_txn';
+END;
+
+CREATE TRIGGER ri_linked_change_insert AFTER INSERT ON ri_linked
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_linked', 'insert', new.rowid, value FROM ri_meta WHERE name = 'change_txn';
+END;
+CREATE TRIGGER ri_linked_change_update AFTER UPDATE ON ri_linked
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_linked', 'update', new.rowid, value FROM ri_meta WHERE name = 'change_txn';
+END;
+CREATE TRIGGER ri_linked_change_delete AFTER DELETE ON ri_linked
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_linked', 'delete', old.rowid, value FROM ri_meta WHERE name = 'change_txn';
+END;
+
+CREATE TRIGGER ri_tweetmatch_change_insert AFTER INSERT ON ri_tweetmatch
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_tweetmatch', 'insert', new.rowid, value FROM ri_meta WHERE name = 'change_txn';
+END;
+CREATE TRIGGER ri_tweetmatch_change_update AFTER UPDATE ON ri_tweetmatch
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_tweetmatch', 'update', new.rowid, value FROM ri_meta WHERE name = 'change_txn';
+END;
+CREATE TRIGGER ri_tweetmatch_change_delete AFTER DELETE ON ri_tweetmatch
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_tweetmatch', 'delete', old.rowid, value FROM ri_meta WHERE name = 'change_txn';
+END;
+
+CREATE TRIGGER ri_restaurant_keys_change_insert AFTER INSERT ON ri_restaurant_keys
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_restaurant_keys', 'insert', new.restaurant_id, value FROM ri_meta WHERE name = 'change_txn';
+END;
+CREATE TRIGGER ri_restaurant_keys_change_update AFTER UPDATE ON ri_restaurant_keys
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_restaurant_keys', 'update', new.restaurant_id, value FROM ri_meta WHERE name = 'change_txn';
+END;
+CREATE TRIGGER ri_restaurant_keys_change_delete AFTER DELETE ON ri_restaurant_keys
+WHEN EXISTS (SELECT 1 FROM ri_change_cursors)
+BEGIN
+    INSERT INTO ri_changes (tbl, op, row_id, txn)
+    SELECT 'ri_restaurant_keys', 'delete', old.restaurant_id, value FROM ri_meta WHERE name = 'change_txn';
+END;
+
+-- Inspection counts by zip, month, results and risk, and by the ri_linked
+-- primary of each inspection's restaurant, served by /stats; NULL keys
+-- count as ''
+CREATE TABLE ri_rollup_zip (
+    zip char(5) NOT NULL,
+    month char(7) NOT NULL,
+    results varchar(50) NOT NULL,
+    risk varchar(30) NOT NULL,
+    inspections int NOT NULL,
+    PRIMARY KEY (zip, month, results, risk)
+);
+
+CREATE TABLE ri_rollup_cluster (
+    restaurant_id int NOT NULL,
+    results varchar(50) NOT NULL,
+    risk varchar(30) NOT NULL,
+    inspections int NOT NULL,
+    PRIMARY KEY (restaurant_id, results, risk)
+);
+
+CREATE TRIGGER ri_inspections_rollup_insert AFTER INSERT ON ri_inspections
+BEGIN
+    INSERT INTO ri_rollup_zip (zip, month, results, risk, inspections)
+    VALUES (coalesce((SELECT zip FROM ri_restaurants
+                      WHERE id = new.restaurant_id), ''),
+            coalesce(substr(new.inspection_date_iso, 1, 7), ''),
+            coalesce(new.results, ''), coalesce(new.risk, ''),
+            1)
+    ON CONFLICT (zip, month, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;
+    INSERT INTO ri_rollup_cluster (restaurant_id, results, risk, inspections)
+    VALUES (coalesce((SELECT min(primary_rest_id) FROM ri_linked
+                      WHERE original_rest_id = new.restaurant_id),
+                     new.restaurant_id),
+            coalesce(new.results, ''), coalesce(new.risk, ''),
+            1)
+    ON CONFLICT (restaurant_id, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;
+END;
+CREATE TRIGGER ri_inspections_rollup_delete AFTER DELETE ON ri_inspections
+BEGIN
+    INSERT INTO ri_rollup_zip (zip, month, results, risk, inspections)
+    VALUES (coalesce((SELECT zip FROM ri_restaurants
+                      WHERE id = old.restaurant_id), ''),
+            coalesce(substr(old.inspection_date_iso, 1, 7), ''),
+            coalesce(old.results, ''), coalesce(old.risk, ''),
+            -1)
+    ON CONFLICT (zip, month, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;
+    INSERT INTO ri_rollup_cluster (restaurant_id, results, risk, inspections)
+    VALUES (coalesce((SELECT min(primary_rest_id) FROM ri_linked
+                      WHERE original_rest_id = old.restaurant_id),
+                     old.restaurant_id),
+            coalesce(old.results, ''), coalesce(old.risk, ''),
+            -1)
+    ON CONFLICT (restaurant_id, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;
+END;
+CREATE TRIGGER ri_inspections_rollup_update
+AFTER UPDATE OF restaurant_id, results, risk, inspection_date_iso ON ri_inspections
+BEGIN
+    INSERT INTO ri_rollup_zip (zip, month, results, risk, inspections)
+    VALUES (coalesce((SELECT zip FROM ri_restaurants
+                      WHERE id = old.restaurant_id), ''),
+            coalesce(substr(old.inspection_date_iso, 1, 7), ''),
+            coalesce(old.results, ''), coalesce(old.risk, ''),
+            -1)
+    ON CONFLICT (zip, month, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;
+    INSERT INTO ri_rollup_cluster (restaurant_id, results, risk, inspections)
+    VALUES (coalesce((SELECT min(primary_rest_id) FROM ri_linked
+                      WHERE original_rest_id = old.restaurant_id),
+                     old.restaurant_id),
+            coalesce(old.results, ''), coalesce(old.risk, ''),
+            -1)
+    ON CONFLICT (restaurant_id, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;
+    INSERT INTO ri_rollup_zip (zip, month, results, risk, inspections)
+    VALUES (coalesce((SELECT zip FROM ri_restaurants
+                      WHERE id = new.restaurant_id), ''),
+            coalesce(substr(new.inspection_date_iso, 1, 7), ''),
+            coalesce(new.results, ''), coalesce(new.risk, ''),
+            1)
+    ON CONFLICT (zip, month, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;
+    INSERT INTO ri_rollup_cluster (restaurant_id, results, risk, inspections)
+    VALUES (coalesce((SELECT min(primary_rest_id) FROM ri_linked
+                      WHERE original_rest_id = new.restaurant_id),
+                     new.restaurant_id),
+            coalesce(new.results, ''), coalesce(new.risk, ''),
+            1)
+    ON CONFLICT (restaurant_id, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;
+END;
+
+CREATE TRIGGER ri_linked_rollup_insert AFTER INSERT ON ri_linked
+WHEN new.primary_rest_id != new.original_rest_id
+BEGIN
+    INSERT INTO ri_rollup_cluster (restaurant_id, results, risk, inspections)
+    SELECT new.original_rest_id, coalesce(results, ''), coalesce(risk, ''),
+           -count(*)
+    FROM ri_inspections WHERE restaurant_id = new.original_rest_id
+    GROUP BY 2, 3
+    ON CONFLICT (restaurant_id, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;
+    INSERT INTO ri_rollup_cluster (restaurant_id, results, risk, inspections)
+    SELECT new.primary_rest_id, coalesce(results, ''), coalesce(risk, ''),
+           count(*)
+    FROM ri_inspections WHERE restaurant_id = new.original_rest_id
+    GROUP BY 2, 3
+    ON CONFLICT (restaurant_id, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;
+END;
+CREATE TRIGGER ri_linked_rollup_delete AFTER DELETE ON ri_linked
+WHEN old.primary_rest_id != old.original_rest_id
+BEGIN
+    INSERT INTO ri_rollup_cluster (restaurant_id, results, risk, inspections)
+    SELECT old.primary_rest_id, coalesce(results, ''), coalesce(risk, ''),
+           -count(*)
+    FROM ri_inspections WHERE restaurant_id = old.original_rest_id
+    GROUP BY 2, 3
+    ON CONFLICT (restaurant_id, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;
+    INSERT INTO ri_rollup_cluster (restaurant_id, results, risk, inspections)
+    SELECT old.original_rest_id, coalesce(results, ''), coalesce(risk, ''),
+           count(*)
+    FROM ri_inspections WHERE restaurant_id = old.original_rest_id
+    GROUP BY 2, 3
+    ON CONFLICT (restaurant_id, results, risk)
+    DO UPDATE SET inspections = inspections + excluded.inspections;
+END;
+
+-- Full-text index of violations and restaurant names for /search/violations.
+-- Its text is read through the view rather than stored twice; the triggers
+-- below keep it in step with the rows
+CREATE VIEW ri_inspection_text AS
+SELECT i.rowid AS inspection_rowid, i.violations AS violations,
+       r.name AS name
+FROM ri_inspections i
+JOIN ri_restaurants r ON r.id = i.restaurant_id;
+
+CREATE VIRTUAL TABLE ri_inspections_fts USING fts5(
+    violations, name,
+    content = 'ri_inspection_text', content_rowid = 'inspection_rowid',
+    tokenize = 'porter unicode61'
+);
+
+CREATE TRIGGER ri_inspections_fts_insert AFTER INSERT ON ri_inspections
+BEGIN
+    INSERT INTO ri_inspections_fts (rowid, violations, name)
+    SELECT new.rowid, new.violations, name
+    FROM ri_restaurants WHERE id = new.restaurant_id;
+END;
+CREATE TRIGGER ri_inspections_fts_delete AFTER DELETE ON ri_inspections
+BEGIN
+    INSERT INTO ri_inspections_fts (ri_inspections_fts, rowid, violations, name)
+    SELECT 'delete', old.rowid, old.violations, name
+    FROM ri_restaurants WHERE id = old.restaurant_id;
+END;
+CREATE TRIGGER ri_inspections_fts_update
+AFTER UPDATE OF violations, restaurant_id ON ri_inspections
+BEGIN
+    INSERT INTO ri_inspections_fts (ri_inspections_fts, rowid, violations, name)
+    SELECT 'delete', old.rowid, old.violations, name
+    FROM ri_restaurants WHERE id = old.restaurant_id;
+    INSERT INTO ri_inspections_fts (rowid, violations, name)
+    SELECT new.rowid, new.violations, name
+    FROM ri_restaurants WHERE id = new.restaurant_id;
+END;
+
+CREATE TRIGGER ri_restaurants_fts_update AFTER UPDATE OF name ON ri_restaurants
+BEGIN
+    INSERT INTO ri_inspections_fts (ri_inspections_fts, rowid, violations, name)
+    SELECT 'delete', rowid, violations, old.name
+    FROM ri_inspections WHERE restaurant_id = old.id;
+    INSERT INTO ri_inspections_fts (rowid, violations, name)
+    SELECT rowid, violations, new.name
+    FROM ri_inspections WHERE restaurant_id = new.id;
+END;
+
+PRAGMA user_version = 11;
@@ -1,2 +1,11 @@
 DROP TABLE IF EXISTS ri_inspections;
 DROP TABLE IF EXISTS ri_restaurants;
+DROP TABLE IF EXISTS ri_restaurant_keys;
+DROP TABLE IF EXISTS ri_counters;
+DROP TABLE IF EXISTS ri_meta;
+DROP TABLE IF EXISTS ri_changes;
+DROP TABLE IF EXISTS ri_change_cursors;
+DROP TABLE IF EXISTS ri_rollup_zip;
+DROP TABLE IF EXISTS ri_rollup_cluster;
+DROP VIEW IF EXISTS ri_inspection_text;
+DROP TABLE IF EXISTS ri_inspections_fts;
@@ -25,7 +25,8 @@ INSERT INTO ri_inspections (
     inspection_type,
     results,
     violations,
-    restaurant_id
+    restaurant_id,
+    inspection_date_iso
 ) VALUES (
     '1751552',
     'Risk 1 (High)',
@@ -33,6 +34,7 @@ INSERT INTO ri_inspections (
     'License',
     'Pass',
     '32. FOOD AND NON-FOOD CONTACT SURFACES PROPERLY DESIGNED, CONSTRUCTED AND MAINTAINED - Comments: OBSERVED RUSTED FOOD STORAGE SHELVING INSIDE WALK-IN COOLER LOCATED AT THE ROOFTOP. MUST REPAINT OR REPLACE. | 38. VENTILATION: ROOMS AND EQUIPMENT VENTED AS REQUIRED: PLUMBING: INSTALLED AND MAINTAINED - Comments: OBSERVED EXPOSED HAND WASHING DRAINING SLOW IN KITCHEN FOOD PREP AREA LOCATED AT THE ROOFTOP. MUST REPAIR AND MAINTAIN. \nVENTILATION NOT WORKING AT THE ROOFTOP WASHROOMS. MUST REPAIR AND MAINTAIN.',
-    1
+    1,
+    '2016-04-13'
 );
 
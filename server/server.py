@@ -1,25 +1,130 @@
-from bottle import Bottle, post, get, HTTPResponse, request, response
+from bottle import Bottle, HTTPResponse, request, response
 import argparse
-import os
-import sys
 import sqlite3
 import logging
+import time
+import threading
 import json
+import csv
+import io
+from contextlib import nullcontext
+from datetime import date, datetime
 from db import DB
-from db import dict_factory
 from db import InspError
-import clean_restaurants
-from datetime import datetime
+from db import encode_items
+from db import INSPECTION_COLUMNS, ResultRows
+from db import encode_row, fetch_batches
+from db import build_template
+from db import MONTH, SEARCH_MAX_PAGE_SIZE, SEARCH_PAGE_SIZE
+from cache import ResponseCache, restaurant_tag, tweets_tag
+from metrics import METRICS, PROMETHEUS_CONTENT_TYPE
+from metrics import RouteMetrics, TimedConnection
+from shards import SerialRequests, ShardedDB, default_bounds, shard_files
+from sessions import SESSION_DEADLINE, SESSION_SIZE, SessionManager
+from match_index import MatchIndex, index_file
 
 DB_NAME = "insp.db"
 logging.basicConfig(level=logging.INFO)
 
 app = Bottle()
+# Per-route request counts and latency histograms, served at /metrics
+app.install(RouteMetrics())
 
 # Adding default values
 app.config.setdefault('myapp.txnsize', 1)
 app.config.setdefault('myapp.counter', 0)
 
+def get_db():
+    '''
+    Returns the database for this request: the ShardedDB router when the
+    server runs with --shards, otherwise a DB on the single connection.
+    '''
+    if app.shards is not None:
+        return app.shards
+    return DB(app.db_connection)
+
+def exclusive():
+    '''
+    Holds the database for work spanning requests or shards: every shard's
+    lock with --shards, whose server handles requests on several threads,
+    and nothing otherwise, as the single-file server handles one at a time.
+    '''
+    if app.shards is not None:
+        return app.shards.exclusive()
+    return nullcontext()
+
+def cached_response(build):
+    '''
+    Serves the current GET from the response cache, keyed by request path
+    and query string.
+    On a miss, build() returns the JSON body and the cache tags it was built
+    from (or raises HTTPResponse). Honors If-None-Match with a 304.
+    '''
+    key = request.path
+    if request.query_string:
+        key += '?' + request.query_string
+    entry = app.cache.get(key)
+    if entry is None:
+        body, tags = build()
+        entry = app.cache.put(key, body.encode('utf-8'), tags)
+    etags = [t.strip().replace('W/', '', 1)
+             for t in request.get_header('If-None-Match', '').split(',')]
+    if entry.etag in etags or '*' in etags:
+        raise HTTPResponse(status=304, headers={'ETag': entry.etag})
+    response.set_header('ETag', entry.etag)
+    response.content_type = 'application/json'
+    return entry.body
+
+def restaurant_body(restaurant, inspections):
+    '''
+    JSON body of GET /restaurants/<id> for a restaurant and its inspections.
+    '''
+    return '{"restaurant": %s, "inspections": %s}' % (
+        restaurant.to_json(), inspections.to_json())
+
+def request_ids():
+    '''
+    Reads the ids of a multi-get: ?ids=1,2,3 on GET, or a JSON body of
+    {"ids": [1, 2, 3]} (or a bare list) on POST.
+    '''
+    if request.method == 'POST':
+        body = request.json
+        ids = body.get('ids') if isinstance(body, dict) else body
+    else:
+        ids = request.query.get('ids', '').split(',')
+    if not isinstance(ids, list):
+        raise HTTPResponse(status=400)
+    try:
+        return [int(r_id) for r_id in ids if str(r_id).strip()]
+    except ValueError:
+        raise HTTPResponse(status=400)
+
+def multi_get(ids, path_format, fetch):
+    '''
+    Answers a multi-get with one entry per requested id, in request order:
+    {"id": 1, "status": 200, "body": <single endpoint body>} or
+    {"id": 7, "status": 404}. Bodies come from the response cache where
+    possible; fetch(missing_ids) returns {id: (body, tags)} for the rest,
+    which are cached under the single endpoint's path.
+    '''
+    bodies = {}
+    missing = []
+    for r_id in dict.fromkeys(ids):
+        entry = app.cache.get(path_format % r_id)
+        if entry is None:
+            missing.append(r_id)
+        else:
+            bodies[r_id] = entry.body.decode('utf-8')
+    if missing:
+        for r_id, (body, tags) in fetch(missing).items():
+            app.cache.put(path_format % r_id, body.encode('utf-8'), tags)
+            bodies[r_id] = body
+    items = ['{"id": %d, "status": 200, "body": %s}' % (r_id, bodies[r_id])
+             if r_id in bodies else '{"id": %d, "status": 404}' % r_id
+             for r_id in ids]
+    response.content_type = 'application/json'
+    return '[' + ', '.join(items) + ']'
+
 @app.get("/hello")
 def hello():
     return "Hello, World!"
@@ -27,52 +132,250 @@ def hello():
 @app.get("/reset")
 @app.get("/create")
 def create():
-    db = DB(app.db_connection)
-    db.create_script()
+    db = get_db()
+    # Copy the pristine template over the database rather than re-running
+    # create.sql, whose DROPs take longer the more data was loaded
+    db.restore_template(app.template)
+    app.cache.clear()
+    app.sessions.drop_uncommitted()
     return "Created"
 
 
 @app.get("/seed")
 def seed():
-    db = DB(app.db_connection)
+    db = get_db()
     db.seed_data()
+    app.cache.clear()
     return "Seeded"
 
+def query_flag(name, default):
+    '''
+    Reads a boolean query parameter such as ?stream=1 or ?violations=false.
+    '''
+    value = request.query.get(name)
+    if value is None:
+        return default
+    return value.lower() not in ('0', 'false', 'no', '')
+
+def stream_restaurant(db, restaurant, restaurant_id, limit, after, violations):
+    '''
+    Yields the /restaurants/<id> JSON in chunks, one per fetchmany batch.
+    '''
+    yield '{"restaurant": %s, "inspections": [' % restaurant.to_json()
+    separator = ''
+    for batch in db.iter_inspections(restaurant_id, limit, after, violations):
+        yield separator + encode_items(batch.columns, batch)
+        separator = ', '
+    yield ']}'
+
+def export_params():
+    '''
+    Reads the export filters: zip=60601,60602, from/to=YYYY-MM-DD (inclusive)
+    and clean=1/0. Raises a 400 for malformed dates.
+    '''
+    zips = [z.strip() for z in request.query.get('zip', '').split(',')
+            if z.strip()]
+    dates = []
+    for name in ('from', 'to'):
+        value = request.query.get(name)
+        if value is not None:
+            try:
+                value = date.fromisoformat(value).isoformat()
+            except ValueError:
+                raise HTTPResponse(status=400)
+        dates.append(value)
+    return zips, dates[0], dates[1], query_flag('clean', None)
+
+def stream_export(cursor, columns, export_format):
+    '''
+    Yields an export as CSV (with a header row) or NDJSON, one chunk per
+    fetchmany batch, so memory stays constant whatever the row count.
+    '''
+    if export_format == 'ndjson':
+        for batch in fetch_batches(cursor):
+            yield ''.join([encode_row(columns, row) + '\n' for row in batch])
+        return
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for batch in fetch_batches(cursor):
+        writer.writerows(batch)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    if out.tell():
+        yield out.getvalue()
+
+def export_response(name, cursor, columns):
+    '''
+    Streams an export in the requested format (csv by default, or
+    format=ndjson). No Content-Length is set, so HTTP/1.1 servers send the
+    body with chunked transfer encoding.
+    '''
+    export_format = request.query.get('format', 'csv')
+    if export_format == 'csv':
+        response.content_type = 'text/csv; charset=utf-8'
+    else:
+        response.content_type = 'application/x-ndjson'
+    response.set_header('Content-Disposition',
+                        'attachment; filename="%s.%s"' % (name, export_format))
+    return stream_export(cursor, columns, export_format)
+
+@app.get("/export/restaurants")
+def export_restaurants():
+    """
+    Streams all restaurants as CSV or NDJSON.
+    Optional query parameters:
+      format=csv|ndjson
+      zip      - comma separated zip codes
+      from, to - only restaurants inspected in this date range (YYYY-MM-DD)
+      clean=1  - only clean (or with clean=0, dirty) restaurants
+    """
+    if request.query.get('format', 'csv') not in ('csv', 'ndjson'):
+        raise HTTPResponse(status=400)
+    zips, date_from, date_to, clean = export_params()
+    db = get_db()
+    cursor, columns = db.query_export_restaurants(zips, date_from, date_to,
+                                                  clean)
+    return export_response('restaurants', cursor, columns)
+
+@app.get("/export/inspections")
+def export_inspections():
+    """
+    Streams all inspections as CSV or NDJSON.
+    Optional query parameters:
+      format=csv|ndjson
+      resolve=1 - report restaurant_id as the ri_linked primary restaurant
+      zip       - comma separated zip codes of the restaurant
+      from, to  - inspection date range (YYYY-MM-DD, inclusive)
+      clean=1   - only inspections of clean (or with clean=0, dirty) restaurants
+    """
+    if request.query.get('format', 'csv') not in ('csv', 'ndjson'):
+        raise HTTPResponse(status=400)
+    zips, date_from, date_to, clean = export_params()
+    db = get_db()
+    cursor, columns = db.query_export_inspections(
+        zips, date_from, date_to, clean, query_flag('resolve', False))
+    return export_response('inspections', cursor, columns)
+
+@app.get("/search/violations")
+def search_violations():
+    """
+    Full-text search of inspection violations and restaurant names, best
+    match (bm25) first, eg ?q=rodent or ?q="no hot water" or ?q=name:deli.
+    Optional query parameters:
+      limit, offset - page through the results (default 20, at most 100);
+                      "next" is the offset of the following page, or null
+      zip=60601,60602, from, to (YYYY-MM-DD), clean=1|0 - as for the exports
+    """
+    query = request.query.get('q', '').strip()
+    limit = request.query.get('limit', str(SEARCH_PAGE_SIZE))
+    offset = request.query.get('offset', '0')
+    if not query or not limit.isdigit() or not offset.isdigit():
+        raise HTTPResponse(status=400)
+    limit, offset = int(limit), int(offset)
+    if not 0 < limit <= SEARCH_MAX_PAGE_SIZE:
+        raise HTTPResponse(status=400)
+    zips, date_from, date_to, clean = export_params()
+    db = get_db()
+    try:
+        results = db.search_violations(query, zips, date_from, date_to, clean,
+                                       limit, offset)
+    except InspError as e:
+        raise HTTPResponse(status=e.error_code, body=json.dumps(e.to_dict()))
+    next_offset = offset + limit if len(results) == limit else None
+    response.content_type = 'application/json'
+    return '{"results": %s, "next": %s}' % (results.to_json(),
+                                            json.dumps(next_offset))
+
 @app.get("/restaurants/<restaurant_id:int>")
 def find_restaurant(restaurant_id):
     """
     Returns a restaurant and all of its associated inspections.
+    Optional query parameters:
+      limit, after - page inspections in id order; the response then has a
+                     "next" cursor to pass as after (null on the last page)
+      violations=0 - leave out the violations text
+      stream=1     - stream the response straight from the cursor
     """
-    db = DB(app.db_connection)
-    output = {}
-    restaurant = db.find_restaurant(restaurant_id)
-    output['restaurant'] = restaurant
-    
-    if not restaurant:
-        raise HTTPResponse(status=404)
-    inspections = db.find_inspections(restaurant_id)
-    output['inspections'] = inspections
-    response.content_type = 'application/json'
-    return json.dumps(output)
+    limit = request.query.get('limit')
+    if limit is not None:
+        if not limit.isdigit() or int(limit) == 0:
+            raise HTTPResponse(status=400)
+        limit = int(limit)
+    after = request.query.get('after')
+    violations = query_flag('violations', True)
+
+    if query_flag('stream', False):
+        db = get_db()
+        restaurant = db.find_restaurant(restaurant_id)
+        if not restaurant:
+            raise HTTPResponse(status=404)
+        response.content_type = 'application/json'
+        return stream_restaurant(db, restaurant, restaurant_id, limit, after,
+                                 violations)
+
+    def build():
+        db = get_db()
+        restaurant = db.find_restaurant(restaurant_id)
+        
+        if not restaurant:
+            raise HTTPResponse(status=404)
+        inspections = db.find_inspections(restaurant_id, limit, after, violations)
+        output = restaurant_body(restaurant, inspections)
+        if limit is not None:
+            full_page = len(inspections) == limit
+            next_after = inspections.value(-1, 'id') if full_page else None
+            output = output[:-1] + ', "next": %s}' % json.dumps(next_after)
+        return output, [restaurant_tag(restaurant_id)]
+    return cached_response(build)
+
+@app.get("/restaurants")
+@app.post("/restaurants")
+def find_restaurants():
+    """
+    Multi-get of restaurants and their inspections, e.g. ?ids=1,2,3 or a
+    POST body of {"ids": [...]}. Looks up all ids with two set-based
+    queries; each entry matches GET /restaurants/<id>.
+    """
+    def fetch(restaurant_ids):
+        db = get_db()
+        restaurants = db.find_restaurants(restaurant_ids)
+        inspections = db.find_inspections_by_restaurants(list(restaurants))
+        empty = ResultRows(INSPECTION_COLUMNS)
+        return {r_id: (restaurant_body(restaurant,
+                                       inspections.get(r_id, empty)),
+                       [restaurant_tag(r_id)])
+                for r_id, restaurant in restaurants.items()}
+    return multi_get(request_ids(), '/restaurants/%d', fetch)
 
 @app.get("/restaurants/by-inspection/<inspection_id>")
 def find_restaurant_by_inspection_id(inspection_id):
     """
     Returns a restaurant associated with a given inspection.
     """
-    db = DB(app.db_connection)
-    rest = db.find_restaurant_withinspection(inspection_id)
-    if rest is None:
-        raise HTTPResponse(status=404)
-    response.content_type = 'application/json'
-    return json.dumps(rest[0])
+    def build():
+        db = get_db()
+        rest = db.find_restaurant_withinspection(inspection_id)
+        if rest is None:
+            raise HTTPResponse(status=404)
+        return rest.row_json(0), [restaurant_tag(rest.value(0, 'id'))]
+    return cached_response(build)
 
 @app.post("/inspections")
 def load_inspection():
     """
     Loads a new inspection (and possibly a new restaurant) into the database.
+    With a session token (?txn=<token> or an X-Txn header) the inspection is
+    queued in that session instead, see POST /txn.
     """
-    db = DB(app.db_connection)
+    db = get_db()
+    token = request.query.get('txn') or request.get_header('X-Txn')
+    if token:
+        with exclusive():
+            return queue_inspection(db, token)
+    if app.shards is not None:
+        return load_sharded_inspection(db)
     
     # Get current values
     transaction_size = app.config['myapp.txnsize']
@@ -80,6 +383,9 @@ def load_inspection():
     
     # If first operation, begin the transactions
     if curr_counter == 0:
+        # Batches flushed by sessions are committed first, as they are not
+        # applied while this batch is open
+        app.sessions.commit(db, 'global')
         db.begin_transaction()
     curr_counter += 1
     app.config['myapp.counter'] = curr_counter
@@ -89,6 +395,7 @@ def load_inspection():
     response_code, r_id = db.add_inspection_for_restaurant(request.json)
     
     if response_code:
+        app.cache.invalidate(restaurant_tag(r_id))
         response.status = response_code    
         # Checking if max size exceeded
         if curr_counter == transaction_size:
@@ -96,8 +403,107 @@ def load_inspection():
             app.config['myapp.counter'] = 0
             # Committing active transactions
             db.commit_active()
+            app.cache.commit()
         return json.dumps({'restaurant_id': r_id})
 
+def load_sharded_inspection(db):
+    '''
+    With --shards each shard keeps its own /txn batch, committed once it
+    holds myapp.txnsize inspections, and only the shard written is locked,
+    so loaders of different zip ranges do not wait on one another.
+    '''
+    if not request.json:
+        raise HTTPResponse(status=400)
+    (response_code, r_id), committed = db.add_to_batch(
+        request.json, app.config['myapp.txnsize'])
+    if response_code:
+        app.cache.invalidate(restaurant_tag(r_id))
+    if committed is not None:
+        app.cache.commit([restaurant_tag(r) for r in committed])
+    if response_code:
+        response.status = response_code
+        return json.dumps({'restaurant_id': r_id})
+
+def queue_inspection(db, token):
+    session = txn_session(token)
+    if not isinstance(request.json, dict):
+        raise HTTPResponse(status=400)
+    app.sessions.add(db, session, request.json)
+    response.status = 202
+    response.content_type = 'application/json'
+    return json.dumps(dict(session.status(), results=session.drain()))
+
+def txn_session(token):
+    session = app.sessions.get(token)
+    if session is None:
+        raise HTTPResponse(status=404)
+    return session
+
+@app.hook('before_request')
+def sweep_sessions():
+    # Flush sessions past their deadline and commit a waiting group
+    if app.sessions.sessions or app.sessions.ready:
+        with exclusive():
+            app.sessions.sweep(get_db())
+
+@app.post("/txn")
+def open_txn_session():
+    """
+    Opens a transaction session. The optional body {"size": n, "deadline":
+    seconds} sets how many queued inspections, or how old the oldest one,
+    flushes the session. Returns the session token.
+    """
+    params = request.json or {}
+    try:
+        size = int(params.get('size', SESSION_SIZE))
+        deadline = float(params.get('deadline', SESSION_DEADLINE))
+    except (AttributeError, TypeError, ValueError):
+        raise HTTPResponse(status=400)
+    if size < 1 or deadline <= 0:
+        raise HTTPResponse(status=400)
+    session = app.sessions.open(size, deadline)
+    response.status = 201
+    response.content_type = 'application/json'
+    return json.dumps(session.status())
+
+@app.get("/txn/<token>/commit")
+@app.post("/txn/<token>/commit")
+def commit_txn_session(token):
+    """
+    Flushes the session and commits it, with every batch other sessions
+    have flushed. Returns the results of the session's inspections, or 409
+    while a global /txn batch is open; the flushed batches then wait for it.
+    """
+    session = txn_session(token)
+    results = app.sessions.commit_session(get_db(), session)
+    if results is None:
+        raise HTTPResponse(status=409)
+    response.content_type = 'application/json'
+    return json.dumps(dict(session.status(), results=results))
+
+@app.get("/txn/<token>/abort")
+@app.post("/txn/<token>/abort")
+def abort_txn_session(token):
+    """
+    Drops the inspections the session has not committed.
+    """
+    session = txn_session(token)
+    aborted = app.sessions.abort_session(session)
+    response.content_type = 'application/json'
+    return json.dumps(dict(session.status(), aborted=aborted,
+                           results=session.drain()))
+
+@app.delete("/txn/<token>")
+def close_txn_session(token):
+    """
+    Ends the session, dropping anything it has not committed.
+    """
+    session = txn_session(token)
+    aborted = app.sessions.close(session)
+    response.content_type = 'application/json'
+    return json.dumps(dict(session.status(), aborted=aborted,
+                           results=session.drain()))
+
 @app.get("/txn/<txnsize:int>")
 def set_transaction_size(txnsize):
     app.config['myapp.txnsize'] = txnsize
@@ -106,9 +512,10 @@ def set_transaction_size(txnsize):
 @app.get("/commit")
 def commit_txn():
     logging.info("Committing active transactions")
-    db = DB(app.db_connection)
+    db = get_db()
     try:
         db.commit_active()
+        app.cache.commit()
         logging.info("Success!")
         response.status = 200
     except:
@@ -118,9 +525,10 @@ def commit_txn():
 @app.get("/abort")
 def abort_txn():
     logging.info("Aborting/rolling back active transactions")
-    db = DB(app.db_connection)
+    db = get_db()
     try:
         db.rollback_active() 
+        app.cache.abort()
         response.status = 200
         logging.info("Success!")
     except:
@@ -130,19 +538,118 @@ def abort_txn():
 @app.get("/count")
 def count_insp():
     logging.info("Counting Inspections")
-    db = DB(app.db_connection)
-    cnt = db.count_inspections()[0]['count(*)'] 
+    db = get_db()
+    cnt = db.count_inspections()
     if cnt>=0:
         response.status = 200
         logging.info("Found {} inspections".format(cnt))
         return json.dumps(cnt)
     raise HTTPResponse(status=501)
 
+@app.get("/stats")
+def stats():
+    """
+    Returns all row counters (inspections, restaurants, tweet matches).
+    """
+    db = get_db()
+    response.content_type = 'application/json'
+    return json.dumps(db.get_counters())
+
+@app.get("/stats/zips/<zip_code>")
+def zip_stats(zip_code):
+    """
+    Returns a zip's inspection counts by month, results and risk, read from
+    the rollup rather than the inspections.
+    Optional query parameters:
+      from, to - month range (YYYY-MM, inclusive)
+    """
+    months = []
+    for name in ('from', 'to'):
+        value = request.query.get(name)
+        if value is not None and not MONTH.fullmatch(value):
+            raise HTTPResponse(status=400)
+        months.append(value)
+    db = get_db()
+    rollup = db.query_zip_rollup(zip_code, months[0], months[1])
+    response.content_type = 'application/json'
+    return '{"zip": %s, "rollup": %s}' % (json.dumps(zip_code),
+                                          rollup.to_json())
+
+@app.get("/stats/clusters/<restaurant_id:int>")
+def cluster_stats(restaurant_id):
+    """
+    Returns the inspection counts by results and risk of the restaurant's
+    cluster: its ri_linked primary and every restaurant linked to it.
+    """
+    db = get_db()
+    found = db.find_cluster_rollup(restaurant_id)
+    if found is None:
+        raise HTTPResponse(status=404)
+    primary_id, rollup = found
+    response.content_type = 'application/json'
+    return '{"restaurant_id": %d, "rollup": %s}' % (primary_id,
+                                                    rollup.to_json())
+
+@app.get("/metrics")
+def get_metrics():
+    """
+    Returns request, SQL and cleaning timings in the Prometheus text format.
+    """
+    response.content_type = PROMETHEUS_CONTENT_TYPE
+    return METRICS.render()
+
+@app.get("/debug/profiles")
+def list_profiles():
+    """
+    Lists the requests profiled with X-Profile: 1 or ?profile=1, newest first.
+    """
+    response.content_type = 'application/json'
+    if app.profiler is None:
+        return json.dumps([])
+    return json.dumps(app.profiler.listing())
+
+def find_profile(profile_id):
+    profile = app.profiler.get(profile_id) if app.profiler else None
+    if profile is None:
+        raise HTTPResponse(status=404)
+    return profile
+
+@app.get("/debug/profiles/<profile_id:int>")
+def get_profile(profile_id):
+    """
+    Returns a top-N summary of a profiled request.
+    Optional query parameters:
+      sort  - cumulative (default), tottime or calls
+      limit - number of functions shown (default 30)
+    """
+    import profiling
+    profile = find_profile(profile_id)
+    sort = request.query.get('sort', 'cumulative')
+    limit = request.query.get('limit', '30')
+    if sort not in profiling.SORT_KEYS or not limit.isdigit():
+        raise HTTPResponse(status=400)
+    response.content_type = 'text/plain; charset=utf-8'
+    return profiling.summary(profile, sort, int(limit))
+
+@app.get("/debug/profiles/<profile_id:int>.pstats")
+def download_profile(profile_id):
+    """
+    Returns a profiled request as a .pstats file, eg for snakeviz or
+    python3 -m pstats.
+    """
+    import profiling
+    profile = find_profile(profile_id)
+    response.content_type = 'application/octet-stream'
+    response.set_header('Content-Disposition',
+                        'attachment; filename="profile-%d.pstats"' % profile_id)
+    return profiling.dump(profile)
+
 @app.post("/tweet")
 def tweet():
     logging.info("Checking Tweet")
-    db = DB(app.db_connection)
-    rest_id_list = db.match_and_add_tweet(request.json)
+    db = get_db()
+    rest_id_list = db.match_and_add_tweet(request.json, app.match_index)
+    app.cache.invalidate(*[tweets_tag(r_id) for r_id in rest_id_list])
     rest_id_list.sort()
     response.status = 201 # Change to 201 no matter what
     return json.dumps({'matches': rest_id_list})
@@ -153,12 +660,37 @@ def find_restaurant_tweets(restaurant_id):
     Returns a restaurant's associated tweets (tkey and match).
     """
     logging.info("Checking tweets matching restaurant")
-    db = DB(app.db_connection)
-    tweets = db.find_tweets(restaurant_id)
-    if tweets:
-        response.status = 200
-        return json.dumps([tweets])
-    raise HTTPResponse(status=404)
+    def build():
+        db = get_db()
+        tweets = db.find_tweets(restaurant_id)
+        if not tweets:
+            raise HTTPResponse(status=404)
+        return tweets.to_json(), [tweets_tag(restaurant_id)]
+    return cached_response(build)
+
+@app.get("/tweets")
+@app.post("/tweets")
+def find_restaurants_tweets():
+    """
+    Multi-get of restaurants' tweets, e.g. ?ids=1,2,3 or a POST body of
+    {"ids": [...]}; each entry matches GET /tweets/<id>.
+    """
+    def fetch(restaurant_ids):
+        db = get_db()
+        tweets = db.find_tweets_by_restaurants(restaurant_ids)
+        return {r_id: (rows.to_json(), [tweets_tag(r_id)])
+                for r_id, rows in tweets.items()}
+    return multi_get(request_ids(), '/tweets/%d', fetch)
+
+def warm_up():
+    '''
+    Imports the cleaning and name matching modules in the background after
+    startup, so the first /clean or /tweet does not pay for them. Touches no
+    database connection, which belongs to the serving thread.
+    '''
+    start = time.perf_counter()
+    import clean_restaurants
+    logging.info("Warmed up in %.3fs", time.perf_counter() - start)
 
 @app.get("/clean")
 def clean():
@@ -166,14 +698,31 @@ def clean():
     Clean all restaurant records by matching any duplicates in ri_linked table.
     '''
     logging.info("Cleaning Restaurants")
-    db = DB(app.db_connection)
+    # Imported on first use, unless the startup warmup got there first
+    import clean_restaurants
+    db = get_db()
     # Uses blocking by zip code if app.scaling is True, otherwise all restaurants
     start_time = datetime.now()
-    if app.scaling:
-        clean_restaurants.clean_by_block(db)
+    if app.shards is not None:
+        # Shards never share a restaurant, so they are cleaned in parallel
+        primary_records, dirty_ids = db.clean_parallel(app.scaling)
+    elif app.scaling:
+        primary_records = clean_restaurants.clean_by_block(db)
+        dirty_ids = clean_restaurants.mark_as_clean(db)
     else:
-        clean_restaurants.clean_all_restaurants(db)
-    clean_restaurants.mark_as_clean(db)
+        primary_records = clean_restaurants.clean_all_restaurants(db)
+        dirty_ids = clean_restaurants.mark_as_clean(db)
+    # Inspections were re-pointed within each group, and dirty rows flipped
+    changed_ids = set(dirty_ids)
+    for linked_set in primary_records.values():
+        changed_ids.update(linked_set)
+    app.cache.invalidate(*[restaurant_tag(r_id) for r_id in changed_ids])
+    app.cache.commit()
+    # Merges rewrite restaurants wholesale; rebuild the tweet match index
+    # rather than overlay them, matching with SQL meanwhile
+    if (app.match_index is not None and not app.match_index.is_fresh(db)
+            and app.match_index.rebuild(db)):
+        logging.info("Rebuilding the tweet match index")
     end_time = datetime.now()
     logging.info(f'Cleaning time: {end_time - start_time}')
     raise HTTPResponse(status=200)
@@ -181,12 +730,16 @@ def clean():
 @app.get("/restaurants/all-by-inspection/<inspection_id>")
 def find_all_restaurants_by_inspection_id(inspection_id):
     logging.info("Getting all restaurants for the inspection_id:{}".format(inspection_id))
-    db = DB(app.db_connection)
+    import clean_restaurants
+    db = get_db()
+    if app.shards is not None:
+        # A cluster lives in the shard that holds the inspection
+        db = db.shard_for_inspection(inspection_id) or db.shards[0]
     output = clean_restaurants.create_json_output(db,inspection_id)
     if output:
         response.status = 200
         response.content_type = 'application/json'
-        return json.dumps(output)
+        return output
     else:
         raise HTTPResponse(status=404)
 
@@ -209,19 +762,152 @@ if __name__ == "__main__":
         default=False,
         action="store_true"
     )
+    parser.add_argument(
+        "--cache-entries",
+        help="Maximum cached GET responses (default 1024)",
+        default=1024,
+        type=int
+    )
+    parser.add_argument(
+        "--cache-mb",
+        help="Maximum size of cached GET responses in MB (default 16)",
+        default=16,
+        type=int
+    )
+    parser.add_argument(
+        "--seed-template",
+        help="Include schema/seed.sql in the database restored by /reset and /create",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--group-commit",
+        help="Commit batches flushed by transaction sessions once this many inspections are waiting (default 500)",
+        default=500,
+        type=int
+    )
+    parser.add_argument(
+        "--group-commit-ms",
+        help="Commit batches flushed by transaction sessions once the oldest has waited this long (default 100)",
+        default=100,
+        type=float
+    )
+    parser.add_argument(
+        "--no-match-index",
+        help="Match tweets with SQL only, without the persisted match index",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--shards",
+        help="Partition restaurants by zip range across this many database files (default 1, unsharded)",
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        "--shard-bounds",
+        help="Comma separated lowest zip of shards 1..N-1 (default: split 60601-60661 evenly)",
+        default=""
+    )
+    parser.add_argument(
+        "--no-sql-timing",
+        help="Do not time SQL statements for /metrics",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--profile-routes",
+        help="Comma separated routes that may be profiled on request, eg /tweet,/clean",
+        default=""
+    )
+    parser.add_argument(
+        "--profile-keep",
+        help="Number of request profiles kept (default 20)",
+        default=20,
+        type=int
+    )
+    parser.add_argument(
+        "--no-warmup",
+        help="Import the cleaning and matching modules on first use instead of in the background after startup",
+        default=False,
+        action="store_true"
+    )
 
     # Create the parser argument object
     args = parser.parse_args()
     # Create the database connection and store it in the app object
-    app.db_connection = sqlite3.connect(DB_NAME)
-    # See https://stackoverflow.com/questions/3300464/how-can-i-get-dict-from-sqlite-query
-    app.db_connection.row_factory = dict_factory
-    app.scaling = False
+    # Rows are plain tuples; outward-facing queries carry their column names
+    # in db.ResultRows and are encoded to JSON without building dicts
+    # SQL statements are timed per statement unless --no-sql-timing is set
+    factory = sqlite3.Connection if args.no_sql_timing else TimedConnection
+    if args.shards > 1:
+        files = shard_files(DB_NAME, args.shards)
+        bounds = ([b.strip() for b in args.shard_bounds.split(",")]
+                  if args.shard_bounds else default_bounds(args.shards))
+        if len(bounds) != args.shards - 1:
+            parser.error("--shard-bounds needs %d zips" % (args.shards - 1))
+        # Requests are handled on threads; ShardedDB locks each connection
+        connections = [sqlite3.connect(f, factory=factory,
+                                       check_same_thread=False)
+                       for f in files]
+        app.shards = ShardedDB(connections, bounds, files)
+        app.db_connection = connections[0]
+        logging.info("Sharding by zip across %s, bounds %s", files, bounds)
+    else:
+        app.shards = None
+        app.db_connection = sqlite3.connect(DB_NAME, factory=factory)
+    # Bring databases created by older versions up to date
+    try:
+        get_db().migrate()
+    except InspError as e:
+        parser.error(e.message)
+    if args.shards > 1 or args.no_match_index:
+        app.match_index = None
+    else:
+        # Mapped from disk if it is current, otherwise rebuilt and saved
+        app.match_index = MatchIndex(index_file(DB_NAME))
+        start = time.perf_counter()
+        rebuilt = app.match_index.refresh(get_db())
+        logging.info("%s the tweet match index in %.3fs",
+                     "Rebuilt" if rebuilt else "Mapped",
+                     time.perf_counter() - start)
+    app.template = build_template(args.seed_template)
+    app.cache = ResponseCache(args.cache_entries, args.cache_mb * 1024 * 1024)
+    app.sessions = SessionManager(app.cache, args.group_commit,
+                                  args.group_commit_ms / 1000)
+    # Only allowlisted routes are wrapped; the rest never see the profiler,
+    # which is not even imported without --profile-routes
+    profile_routes = [rule for rule in args.profile_routes.split(",") if rule]
+    profiler = None
+    if profile_routes:
+        from profiling import RequestProfiler
+        profiler = RequestProfiler(profile_routes, args.profile_keep)
+        app.install(profiler)
+    app.profiler = profiler
+    # Bottle apps only allow an attribute to be set once
+    app.scaling = args.scaling
     if args.scaling:
         logging.info("Set to use large scale cleaning")
-        app.scaling = True
+    run_options = {}
+    if app.shards is not None:
+        # Ingest locks only the shard it writes, everything else all of them
+        app.install(SerialRequests(app.shards, [('POST', '/inspections')]))
+        from socketserver import ThreadingMixIn
+        from wsgiref.simple_server import WSGIServer
+        class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+        run_options['server_class'] = ThreadingWSGIServer
+    # Serving starts without the cleaning and matching modules loaded
+    if not args.no_warmup:
+        threading.Thread(target=warm_up, name="warmup", daemon=True).start()
     try:
         logging.info("Starting Inspection Service")
-        app.run(host=args.host, port=args.port, debug=True)
+        app.run(host=args.host, port=args.port, debug=True, **run_options)
     finally:
-        app.db_connection.close()
+        if app.shards is not None:
+            for shard in app.shards.shards:
+                shard.conn.close()
+        else:
+            app.db_connection.close()
+        if app.match_index is not None:
+            app.match_index.close()
@@ -0,0 +1,244 @@
+# Per-client transaction sessions. Each session buffers its own inspection
+# writes; batches flushed by any session wait in memory and are applied and
+# committed together (group commit) in a transaction of their own.
+import secrets
+import sqlite3
+import time
+
+from cache import restaurant_tag
+from db import InspError
+from metrics import METRICS
+
+# Used when POST /txn does not give a size or deadline
+SESSION_SIZE = 100
+SESSION_DEADLINE = 1.0
+# Sessions that make no request for this many seconds are aborted
+SESSION_IDLE_TIMEOUT = 300
+# Groups are applied one at a time, so the savepoint names can be fixed
+BATCH_SAVEPOINT = 'txn_batch'
+RECORD_SAVEPOINT = 'txn_record'
+# Errors that fail a single record rather than the whole batch
+RECORD_ERRORS = (InspError, LookupError, TypeError, ValueError,
+                 sqlite3.IntegrityError)
+
+METRICS.describe('txn_group_commits_total', 'counter',
+                 'Commits of batches flushed by transaction sessions, by trigger.')
+METRICS.describe('txn_session_records_total', 'counter',
+                 'Inspections applied by transaction session flushes.')
+
+
+class TxnSession:
+    """
+    One client's buffered writes. Results of committed records are kept
+    until they are returned in the session's next response.
+    """
+    def __init__(self, token, size, deadline):
+        self.token = token
+        self.size = size
+        self.deadline = deadline
+        self.pending = []
+        self.first_pending = None
+        self.flushed = 0
+        self.results = []
+        self.last_seen = time.monotonic()
+
+    def overdue(self, now):
+        return bool(self.pending) and now - self.first_pending >= self.deadline
+
+    def drain(self):
+        results, self.results = self.results, []
+        return results
+
+    def status(self):
+        return {'token': self.token, 'size': self.size,
+                'deadline': self.deadline, 'queued': len(self.pending),
+                'flushed': self.flushed}
+
+
+class SessionManager:
+    """
+    Open sessions and the group commit of their flushed batches. A session
+    flushes when it holds `size` writes, when its oldest write is `deadline`
+    seconds old, or on commit. Flushed batches wait in memory, where their
+    session can still abort them, until the group is committed: when a
+    session commits, once `group_size` records or `group_delay` seconds of
+    flushed batches are waiting, or before a global /txn batch begins. The
+    group is applied in a transaction of its own, a SAVEPOINT per batch and
+    a nested one per record so a bad record fails alone, and committed at
+    once, so loaders share one commit instead of paying one each.
+
+    Nothing is applied while a global /txn batch is open, so a global
+    /abort never undoes a session's writes and the group commit never
+    commits global ones. The group waits for the global batch to end.
+
+    Deadlines are checked by sweep() at the start of every request.
+    """
+    def __init__(self, cache, group_size=500, group_delay=0.1):
+        self.cache = cache
+        self.group_size = group_size
+        self.group_delay = group_delay
+        self.sessions = {}
+        self.ready = []
+        self.ready_records = 0
+        self.oldest_flush = None
+
+    def open(self, size=SESSION_SIZE, deadline=SESSION_DEADLINE):
+        token = secrets.token_hex(8)
+        session = TxnSession(token, size, deadline)
+        self.sessions[token] = session
+        return session
+
+    def get(self, token):
+        session = self.sessions.get(token)
+        if session is not None:
+            session.last_seen = time.monotonic()
+        return session
+
+    def add(self, db, session, inspection):
+        '''
+        Buffers an inspection, flushing the session once it is full.
+        '''
+        if not session.pending:
+            session.first_pending = time.monotonic()
+        session.pending.append(inspection)
+        if len(session.pending) >= session.size:
+            self.flush(db, session)
+
+    def apply(self, db, inspection, tags):
+        db.savepoint(RECORD_SAVEPOINT)
+        try:
+            response_code, r_id = db.add_inspection_for_restaurant(inspection)
+        except RECORD_ERRORS as e:
+            db.rollback_to_savepoint(RECORD_SAVEPOINT)
+            db.release_savepoint(RECORD_SAVEPOINT)
+            return {'inspection_id': inspection.get('inspection_id'),
+                    'status': getattr(e, 'error_code', 400),
+                    'error': getattr(e, 'message', str(e))}
+        db.release_savepoint(RECORD_SAVEPOINT)
+        if r_id is not None:
+            tags.append(restaurant_tag(r_id))
+        # A duplicate inspection is not an error, as for a plain POST
+        return {'inspection_id': inspection['inspection_id'],
+                'status': response_code or 200,
+                'restaurant_id': r_id}
+
+    def apply_batch(self, db, batch, tags):
+        '''
+        Applies one session's batch under a savepoint. A database error
+        undoes the batch and fails each of its records.
+        '''
+        db.savepoint(BATCH_SAVEPOINT)
+        batch_tags = []
+        try:
+            results = [self.apply(db, inspection, batch_tags)
+                       for inspection in batch]
+        except sqlite3.Error as e:
+            db.rollback_to_savepoint(BATCH_SAVEPOINT)
+            db.release_savepoint(BATCH_SAVEPOINT)
+            return [{'inspection_id': inspection.get('inspection_id'),
+                     'status': 500, 'error': str(e)} for inspection in batch]
+        db.release_savepoint(BATCH_SAVEPOINT)
+        tags.extend(batch_tags)
+        return results
+
+    def flush(self, db, session):
+        '''
+        Hands the session's buffered writes to the group commit.
+        '''
+        if not session.pending:
+            return
+        batch, session.pending = session.pending, []
+        session.first_pending = None
+        session.flushed += len(batch)
+        self.ready.append((session, batch))
+        self.ready_records += len(batch)
+        if self.oldest_flush is None:
+            self.oldest_flush = time.monotonic()
+        if self.ready_records >= self.group_size:
+            self.commit(db, 'size')
+
+    def commit(self, db, trigger='session'):
+        '''
+        Applies and commits every flushed batch, whichever session flushed
+        it. Returns False, leaving the batches waiting, while a global /txn
+        batch is open.
+        '''
+        if not self.ready:
+            return True
+        if db.in_transaction():
+            return False
+        group, tags = self.ready, []
+        db.begin_transaction()
+        try:
+            results = [(session, self.apply_batch(db, batch, tags))
+                       for session, batch in group]
+            db.commit_active()
+        except sqlite3.Error:
+            db.rollback_active()
+            raise
+        self.cache.invalidate(*tags)
+        self.cache.commit(tags)
+        for session, batch_results in results:
+            session.flushed -= len(batch_results)
+            session.results.extend(batch_results)
+        METRICS.inc('txn_group_commits_total', (('trigger', trigger),))
+        METRICS.inc('txn_session_records_total', (), self.ready_records)
+        self.ready = []
+        self.ready_records = 0
+        self.oldest_flush = None
+        return True
+
+    def commit_session(self, db, session):
+        '''
+        Flushes the session and commits the group. Returns the session's
+        results, or None while a global /txn batch is open.
+        '''
+        self.flush(db, session)
+        if not self.commit(db):
+            return None
+        return session.drain()
+
+    def abort_session(self, session):
+        '''
+        Drops the writes the session has not committed, queued or flushed.
+        '''
+        aborted = len(session.pending) + session.flushed
+        session.pending = []
+        session.first_pending = None
+        session.flushed = 0
+        self.ready = [(s, batch) for s, batch in self.ready if s is not session]
+        self.ready_records = sum(len(batch) for _, batch in self.ready)
+        if not self.ready:
+            self.oldest_flush = None
+        return aborted
+
+    def close(self, session):
+        self.sessions.pop(session.token, None)
+        return self.abort_session(session)
+
+    def sweep(self, db):
+        '''
+        Flushes sessions past their deadline, aborts idle ones and commits
+        the group once its delay has passed.
+        '''
+        if not self.sessions and not self.ready:
+            return
+        now = time.monotonic()
+        for session in list(self.sessions.values()):
+            if now - session.last_seen >= SESSION_IDLE_TIMEOUT:
+                self.close(session)
+            elif session.overdue(now):
+                self.flush(db, session)
+        if self.ready and now - self.oldest_flush >= self.group_delay:
+            self.commit(db, 'delay')
+
+    def drop_uncommitted(self):
+        '''
+        Drops every session's queued and flushed writes when the database
+        is reset. The sessions stay open.
+        '''
+        for session in self.sessions.values():
+            self.abort_session(session)
+        self.ready = []
+        self.ready_records = 0
+        self.oldest_flush = None
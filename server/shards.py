@@ -0,0 +1,431 @@
+# Optional storage mode that partitions restaurants (with their inspections,
+# keys, links and tweet matches) across several SQLite files by zip range
+from bisect import bisect_right
+from contextlib import contextmanager
+import sqlite3
+import threading
+from types import GeneratorType
+
+from db import DB, InspError, ResultRows, SEARCH_PAGE_SIZE, STREAM_BATCH_SIZE
+
+# Restaurant ids of shard k start after k * SHARD_ID_SPAN, so an id names
+# its shard and shard 0 keeps the ids of the unsharded layout
+SHARD_ID_SPAN = 10 ** 9
+# Refuses restaurant ids outside the shard's span, so they never name
+# another shard
+SHARD_ID_TRIGGER = '''
+CREATE TRIGGER IF NOT EXISTS ri_restaurants_shard_ids AFTER INSERT ON ri_restaurants
+WHEN NEW.id <= %(low)d OR NEW.id > %(high)d
+BEGIN
+    SELECT RAISE(ABORT, 'restaurant id outside shard %(shard)d');
+END;'''
+# Zip range split evenly when no explicit bounds are given (Chicago)
+DEFAULT_ZIP_RANGE = (60601, 60661)
+
+
+def shard_files(db_name, n_shards):
+    '''
+    Returns the file of each shard, eg insp.db -> insp.shard0.db, ...
+    '''
+    stem, dot, ext = db_name.rpartition('.')
+    if not dot:
+        stem, ext = db_name, 'db'
+    return ['%s.shard%d.%s' % (stem, k, ext) for k in range(n_shards)]
+
+
+def default_bounds(n_shards, zip_range=DEFAULT_ZIP_RANGE):
+    '''
+    Splits zip_range into n_shards ranges, returning the n_shards - 1 lower
+    bounds of shards 1..n-1 as zip strings.
+    '''
+    low, high = zip_range
+    step = (high - low + 1) / n_shards
+    return ['%05d' % round(low + step * k) for k in range(1, n_shards)]
+
+
+def clean_shard(db_file, scaling):
+    '''
+    Cleans one shard in a worker process. Returns the primary records and
+    the ids that were dirty, as the /clean endpoint needs them.
+    '''
+    import clean_restaurants
+    conn = sqlite3.connect(db_file)
+    try:
+        db = DB(conn)
+        if scaling:
+            primary_records = clean_restaurants.clean_by_block(db)
+        else:
+            primary_records = clean_restaurants.clean_all_restaurants(db)
+        return primary_records, clean_restaurants.mark_as_clean(db)
+    finally:
+        conn.close()
+
+
+class ChainedCursor:
+    """
+    Reads the cursors of every shard one after the other, for exports.
+    Shards hold consecutive id ranges, so id order is preserved.
+    """
+    def __init__(self, cursors):
+        self.cursors = list(cursors)
+
+    def fetchmany(self, size):
+        while self.cursors:
+            rows = self.cursors[0].fetchmany(size)
+            if rows:
+                return rows
+            self.cursors.pop(0).close()
+        return []
+
+    def close(self):
+        for c in self.cursors:
+            c.close()
+        self.cursors = []
+
+
+class ShardedDB:
+    """
+    Routes DB calls over zip-range shards: ingest by the inspection's zip,
+    point reads by the shard encoded in the restaurant id, and scatter-gather
+    for counts, tweet matching and lookups by inspection id. Each shard is a
+    plain DB, so per-shard work (eg cleaning) reuses the single-file code.
+
+    Restaurants are only ever compared within a shard, like the zip blocks of
+    clean_by_block, and inspection ids are unique per shard.
+    """
+    def __init__(self, connections, bounds, files=None):
+        self.shards = [DB(conn) for conn in connections]
+        self.bounds = list(bounds)
+        self.files = files
+        # Held while a shard's connection is in use, see exclusive()
+        self.locks = [threading.Lock() for _ in self.shards]
+        # Inspections in each shard's open /txn batch, and their restaurants
+        self.batch_sizes = [0] * len(self.shards)
+        self.batch_ids = [set() for _ in self.shards]
+
+    def shard_index(self, zip_code):
+        return bisect_right(self.bounds, str(zip_code or ''))
+
+    def shard_for_zip(self, zip_code):
+        return self.shards[self.shard_index(zip_code)]
+
+    def shard_for_id(self, restaurant_id):
+        restaurant_id = int(restaurant_id)
+        if restaurant_id < 1:
+            return None
+        k = (restaurant_id - 1) // SHARD_ID_SPAN
+        if k < len(self.shards):
+            return self.shards[k]
+        return None
+
+    def shard_for_inspection(self, inspection_id):
+        for shard in self.shards:
+            if shard.find_inspection(inspection_id):
+                return shard
+        return None
+
+    def group_by_shard(self, restaurant_ids):
+        groups = {}
+        for r_id in restaurant_ids:
+            shard = self.shard_for_id(r_id)
+            if shard is not None:
+                groups.setdefault(shard, []).append(r_id)
+        return groups.items()
+
+    def seed_id_ranges(self):
+        '''
+        Starts each shard's restaurant ids at its SHARD_ID_SPAN offset and
+        adds the trigger that keeps them inside it.
+        '''
+        for k, shard in enumerate(self.shards):
+            c = shard.conn.cursor()
+            c.execute('''SELECT name FROM sqlite_master
+                      WHERE name = 'sqlite_sequence' ''')
+            if not c.fetchall():
+                # No schema yet; /create seeds it
+                continue
+            c.execute('''SELECT seq FROM sqlite_sequence
+                      WHERE name = 'ri_restaurants' ''')
+            if k and not c.fetchall():
+                c.execute('''INSERT INTO sqlite_sequence (name, seq)
+                          VALUES ('ri_restaurants', ?)''', [k * SHARD_ID_SPAN])
+            c.execute(SHARD_ID_TRIGGER % {'low': k * SHARD_ID_SPAN,
+                                          'high': (k + 1) * SHARD_ID_SPAN,
+                                          'shard': k})
+            shard.conn.commit()
+
+    def check_id_ranges(self):
+        '''
+        Raises an InspError if a shard holds restaurant ids outside its span,
+        eg when the files were given in another order or another --shards.
+        '''
+        for k, shard in enumerate(self.shards):
+            c = shard.conn.cursor()
+            c.execute('''SELECT name FROM sqlite_master
+                      WHERE name = 'ri_restaurants' ''')
+            if not c.fetchall():
+                continue
+            c.execute('SELECT min(id), max(id) FROM ri_restaurants')
+            low, high = c.fetchone()
+            if low is not None and (low <= k * SHARD_ID_SPAN
+                                    or high > (k + 1) * SHARD_ID_SPAN):
+                raise InspError("Shard %d holds restaurant ids %d-%d, outside "
+                                "its range" % (k, low, high), 500)
+
+    def create_script(self):
+        for shard in self.shards:
+            shard.create_script()
+        self.seed_id_ranges()
+
+    def restore_template(self, template):
+        for shard in self.shards:
+            shard.restore_template(template)
+        self.seed_id_ranges()
+
+    def seed_data(self):
+        self.shards[0].seed_data()
+
+    def migrate(self):
+        for shard in self.shards:
+            shard.migrate()
+        self.check_id_ranges()
+        self.seed_id_ranges()
+
+    def begin_transaction(self):
+        # BEGIN is deferred, so shards that are not written take no lock.
+        # Shards with an open /txn batch of their own carry on in it
+        for shard in self.shards:
+            if not shard.in_transaction():
+                shard.begin_transaction()
+
+    def commit_active(self):
+        for shard in self.shards:
+            shard.commit_active()
+        self.end_batches()
+
+    def rollback_active(self):
+        for shard in self.shards:
+            shard.rollback_active()
+        self.end_batches()
+
+    def end_batches(self):
+        self.batch_sizes = [0] * len(self.shards)
+        self.batch_ids = [set() for _ in self.shards]
+
+    def lock_all(self):
+        for lock in self.locks:
+            lock.acquire()
+
+    def unlock_all(self):
+        for lock in reversed(self.locks):
+            lock.release()
+
+    @contextmanager
+    def exclusive(self):
+        '''
+        Holds every shard's lock, in shard order, for work that may touch
+        any shard.
+        '''
+        self.lock_all()
+        try:
+            yield
+        finally:
+            self.unlock_all()
+
+    def add_to_batch(self, inspection, transaction_size):
+        '''
+        Adds an inspection to its shard's own /txn batch, holding only that
+        shard's lock, so loaders writing other zip ranges are not held up.
+        The batch is committed once it holds transaction_size inspections.
+        Returns add_inspection_for_restaurant's (status, restaurant id) and
+        the restaurant ids of the batch if it was committed, else None.
+        '''
+        k = self.shard_index(inspection['zip'])
+        shard = self.shards[k]
+        with self.locks[k]:
+            if not shard.in_transaction():
+                shard.begin_transaction()
+            response_code, r_id = shard.add_inspection_for_restaurant(inspection)
+            if r_id is not None:
+                self.batch_ids[k].add(r_id)
+            self.batch_sizes[k] += 1
+            if self.batch_sizes[k] < transaction_size:
+                return (response_code, r_id), None
+            shard.commit_active()
+            committed = self.batch_ids[k]
+            self.batch_sizes[k] = 0
+            self.batch_ids[k] = set()
+        return (response_code, r_id), committed
+
+    def in_transaction(self):
+        return any(shard.in_transaction() for shard in self.shards)
+
+    def savepoint(self, name):
+        for shard in self.shards:
+            shard.savepoint(name)
+
+    def release_savepoint(self, name):
+        for shard in self.shards:
+            shard.release_savepoint(name)
+
+    def rollback_to_savepoint(self, name):
+        for shard in self.shards:
+            shard.rollback_to_savepoint(name)
+
+    def add_inspection_for_restaurant(self, inspection):
+        return self.shard_for_zip(inspection['zip']).add_inspection_for_restaurant(
+            inspection)
+
+    def find_restaurant(self, restaurant_id):
+        shard = self.shard_for_id(restaurant_id)
+        return shard.find_restaurant(restaurant_id) if shard else None
+
+    def find_inspections(self, restaurant_id, limit=None, after=None,
+                         violations=True):
+        shard = self.shard_for_id(restaurant_id) or self.shards[0]
+        return shard.find_inspections(restaurant_id, limit, after, violations)
+
+    def iter_inspections(self, restaurant_id, limit=None, after=None,
+                         violations=True, batch_size=STREAM_BATCH_SIZE):
+        shard = self.shard_for_id(restaurant_id) or self.shards[0]
+        return shard.iter_inspections(restaurant_id, limit, after, violations,
+                                      batch_size)
+
+    def find_tweets(self, restaurant_id):
+        shard = self.shard_for_id(restaurant_id) or self.shards[0]
+        return shard.find_tweets(restaurant_id)
+
+    def find_restaurant_withinspection(self, inspection_id):
+        for shard in self.shards:
+            restaurant = shard.find_restaurant_withinspection(inspection_id)
+            if restaurant is not None:
+                return restaurant
+        return None
+
+    def count_inspections(self):
+        return sum(shard.count_inspections() for shard in self.shards)
+
+    def get_counters(self):
+        counters = {}
+        for shard in self.shards:
+            for name, value in shard.get_counters().items():
+                counters[name] = counters.get(name, 0) + value
+        return counters
+
+    def query_zip_rollup(self, zip_code, month_from=None, month_to=None):
+        # Restaurants are placed by their zip, so one shard holds it all
+        return self.shard_for_zip(zip_code).query_zip_rollup(
+            zip_code, month_from, month_to)
+
+    def find_cluster_rollup(self, restaurant_id):
+        shard = self.shard_for_id(restaurant_id)
+        return shard.find_cluster_rollup(restaurant_id) if shard else None
+
+    def search_violations(self, query, zips=None, date_from=None,
+                          date_to=None, clean=None, limit=SEARCH_PAGE_SIZE,
+                          offset=0):
+        # Each shard ranks its own rows; the page is cut from their merge.
+        # bm25 weighs terms by each shard's own statistics
+        pages = [shard.search_violations(query, zips, date_from, date_to,
+                                         clean, offset + limit, 0)
+                 for shard in self.shards]
+        score = pages[0].columns.index('score')
+        rows = sorted((row for page in pages for row in page),
+                      key=lambda row: -row[score])
+        return ResultRows(pages[0].columns, rows[offset:offset + limit])
+
+    def match_and_add_tweet(self, tweet, index=None):
+        # The persisted match index only covers a single file
+        matches = []
+        for shard in self.shards:
+            matches.extend(shard.match_and_add_tweet(tweet))
+        return matches
+
+    def find_restaurants(self, restaurant_ids):
+        found = {}
+        for shard, ids in self.group_by_shard(restaurant_ids):
+            found.update(shard.find_restaurants(ids))
+        return found
+
+    def find_inspections_by_restaurants(self, restaurant_ids):
+        found = {}
+        for shard, ids in self.group_by_shard(restaurant_ids):
+            found.update(shard.find_inspections_by_restaurants(ids))
+        return found
+
+    def find_tweets_by_restaurants(self, restaurant_ids):
+        found = {}
+        for shard, ids in self.group_by_shard(restaurant_ids):
+            found.update(shard.find_tweets_by_restaurants(ids))
+        return found
+
+    def query_export_restaurants(self, *args):
+        results = [shard.query_export_restaurants(*args)
+                   for shard in self.shards]
+        return ChainedCursor(c for c, _ in results), results[0][1]
+
+    def query_export_inspections(self, *args):
+        results = [shard.query_export_inspections(*args)
+                   for shard in self.shards]
+        return ChainedCursor(c for c, _ in results), results[0][1]
+
+    def clean_parallel(self, scaling, workers=None):
+        '''
+        Cleans every shard at once, one process per shard. Returns the merged
+        primary records and dirty ids.
+        '''
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        self.commit_active()
+        context = multiprocessing.get_context('spawn')
+        primary_records = {}
+        dirty_ids = []
+        with ProcessPoolExecutor(workers or len(self.files),
+                                 mp_context=context) as pool:
+            for records, dirty in pool.map(clean_shard, self.files,
+                                           [scaling] * len(self.files)):
+                primary_records.update(records)
+                dirty_ids.extend(dirty)
+        return primary_records, dirty_ids
+
+
+class SerialRequests:
+    """
+    Bottle plugin for the threaded server run with --shards. Every route
+    runs with all shard locks held, as if requests were handled one at a
+    time, except the (method, rule) pairs in `concurrent`, which take the
+    locks of the shards they use themselves.
+    """
+    name = 'serial_requests'
+    api = 2
+
+    def __init__(self, db, concurrent=()):
+        self.db = db
+        self.concurrent = set(concurrent)
+
+    def apply(self, callback, route):
+        if (route.method, route.rule) in self.concurrent:
+            return callback
+
+        def wrapper(*args, **kwargs):
+            self.db.lock_all()
+            try:
+                body = callback(*args, **kwargs)
+            except BaseException:
+                self.db.unlock_all()
+                raise
+            if isinstance(body, GeneratorType):
+                return self.unlock_after(body)
+            self.db.unlock_all()
+            return body
+        return wrapper
+
+    def unlock_after(self, body):
+        '''
+        Streamed bodies read their cursors as they are sent, so the locks
+        are held until the body is exhausted or closed.
+        '''
+        try:
+            yield from body
+        finally:
+            self.db.unlock_all()
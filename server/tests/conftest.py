@@ -0,0 +1,20 @@
+# The server modules are scripts, not a package; import them, the bench
+# helpers and the client's loader from the repo. Schema scripts are looked up
+# relative to server/.
+import sys
+from os import path
+
+import pytest
+
+SERVER_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+# Server modules first: some benches share their module's name
+sys.path.insert(0, path.join(SERVER_DIR, 'bench'))
+sys.path.insert(0, SERVER_DIR)
+sys.path.append(path.join(path.dirname(SERVER_DIR), 'client'))
+
+
+@pytest.fixture(scope='session', autouse=True)
+def server_dir():
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(SERVER_DIR)
+        yield SERVER_DIR
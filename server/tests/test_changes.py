@@ -0,0 +1,62 @@
+# Consumers read committed changes from the log, only those of their tables,
+# and match keys are logged by restaurant id
+import pytest
+
+from benchutil import open_db
+from changes import ChangeConsumer
+from synthetic import Generator
+
+
+@pytest.fixture
+def db(server_dir, tmp_path):
+    db = open_db(str(tmp_path / 'insp.db'))
+    yield db
+    db.conn.close()
+
+
+def ingest(db, records):
+    db.begin_transaction()
+    ids = [db.add_inspection_for_restaurant(record)[1] for record in records]
+    db.commit_active()
+    return ids
+
+
+def consumer(tables=None):
+    seen = []
+    return seen, ChangeConsumer(
+        'test', lambda db: None,
+        lambda db, changes: seen.extend((c.table, c.row_id) for c in changes),
+        tables=tables)
+
+
+def test_keys_are_logged_by_restaurant_id(db):
+    seen, keys = consumer(('ri_restaurant_keys',))
+    assert keys.consume(db) is None
+    ids = ingest(db, Generator(0).records(3))
+    assert keys.consume(db) == 3
+    assert seen == [('ri_restaurant_keys', r_id) for r_id in ids]
+
+
+def test_other_tables_are_skipped(db):
+    seen, keys = consumer(('ri_restaurant_keys',))
+    keys.consume(db)
+    ingest(db, Generator(0).records(3))
+    keys.consume(db)
+    # Inspections only: the cursor moves to the end of the log anyway
+    record = next(Generator(0).records(1))
+    record['inspection_id'] = '9000001'
+    ingest(db, [record])
+    assert db.last_change_seq() > db.change_cursor('test')
+    assert keys.consume(db) == 0
+    assert db.change_cursor('test') == db.last_change_seq()
+
+
+def test_open_transaction_is_not_read(db):
+    seen, everything = consumer()
+    everything.consume(db)
+    db.begin_transaction()
+    added = db.add_inspection_for_restaurant(next(Generator(0).records(1)))
+    assert everything.consume(db) == 0
+    db.commit_active()
+    assert everything.consume(db) > 0
+    assert ('ri_restaurants', added[1]) in seen
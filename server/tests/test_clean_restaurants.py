@@ -0,0 +1,20 @@
+# Pair scoring in clean_restaurants.get_similarity
+from clean_restaurants import SIM_SCORE_THRESHOLD, get_similarity
+
+
+def fields(names, addresses):
+    return [(names, 0.5), (addresses, 0.5)]
+
+
+def test_equal_keys_score_one():
+    assert get_similarity(fields(['TACO HUT'] * 2, ['1 MAIN ST'] * 2), 0, 1) == 1
+
+
+def test_empty_addresses_are_not_a_match():
+    assert get_similarity(fields(['TACO HUT'] * 2, ['', '']),
+                          0, 1) < SIM_SCORE_THRESHOLD
+
+
+def test_one_empty_address_is_not_a_match():
+    assert get_similarity(fields(['TACO HUT'] * 2, ['1 MAIN ST', '']),
+                          0, 1) < SIM_SCORE_THRESHOLD
@@ -0,0 +1,101 @@
+# Restaurant changes reach the match index through the change log, without
+# rebuilding the file; inside an open batch tweets are matched with SQL
+import pytest
+
+from benchutil import open_db
+import match_index
+from match_index import MatchIndex
+from synthetic import Generator
+
+
+@pytest.fixture
+def db(server_dir, tmp_path):
+    db = open_db(str(tmp_path / 'insp.db'))
+    db.begin_transaction()
+    for record in Generator(0).records(50):
+        db.add_inspection_for_restaurant(record)
+    db.commit_active()
+    yield db
+    db.conn.close()
+
+
+@pytest.fixture
+def index(db, tmp_path):
+    index = MatchIndex(str(tmp_path / 'insp.match'))
+    index.refresh(db)
+    yield index
+    index.close()
+
+
+def new_restaurant(db, inspection_id):
+    record = next(Generator(1).records(1))
+    record.update({'inspection_id': inspection_id, 'name': 'Brand New Diner',
+                   'address': '1 Nowhere Ave', 'latitude': '41.5',
+                   'longitude': '-87.9'})
+    return record, db.add_inspection_for_restaurant(record)[1]
+
+
+def tweet(record, key):
+    return {'key': key, 'lat': record['latitude'],
+            'long': record['longitude'], 'text': 'Lunch at Brand New Diner'}
+
+
+def test_changes_are_overlaid_without_rebuilding(db, index, tmp_path):
+    built = (tmp_path / 'insp.match').stat().st_mtime_ns
+    record, r_id = new_restaurant(db, '9000001')
+    db.commit_active()
+    assert not index.is_fresh(db)
+    assert db.match_and_add_tweet(tweet(record, 't1'), index) == [r_id]
+    assert index.is_fresh(db)
+    assert index.builder is None
+    assert (tmp_path / 'insp.match').stat().st_mtime_ns == built
+    assert index.locate(record['latitude'], record['longitude']) == [r_id]
+    assert index.match_names(['BRAND NEW DINER']) == [r_id]
+
+
+def test_moved_and_renamed_restaurant(db, index):
+    r_id, lat, lon = db.query_match_points(limit=1)[0]
+    name = db.find_match_names([r_id])[r_id]
+    db.conn.execute('UPDATE ri_restaurants SET latitude = 41.5 WHERE id = ?',
+                    [r_id])
+    db.conn.execute("""UPDATE ri_restaurant_keys SET name_norm = 'renamed'
+                    WHERE restaurant_id = ?""", [r_id])
+    db.conn.commit()
+    assert index.catch_up(db)
+    assert r_id not in index.locate(lat, lon)
+    assert r_id in index.locate(41.5, lon)
+    assert r_id not in index.match_names([name])
+    assert index.match_names(['renamed']) == [r_id]
+
+
+def test_rebuild_runs_in_background(db, index, monkeypatch):
+    monkeypatch.setattr(match_index, 'OVERLAY_LIMIT', 0)
+    record, r_id = new_restaurant(db, '9000001')
+    db.commit_active()
+    # Current after the overlay is applied; the rebuild replaces it
+    assert index.catch_up(db)
+    assert index.builder is not None
+    index.builder.join()
+    assert index.catch_up(db)
+    assert not index.changed
+    assert index.locate(record['latitude'], record['longitude']) == [r_id]
+
+
+def test_lost_cursor_matches_with_sql_until_rebuilt(db, index):
+    index.consumer.stop(db)
+    record, r_id = new_restaurant(db, '9000001')
+    db.commit_active()
+    assert db.match_and_add_tweet(tweet(record, 't1'), index) == [r_id]
+    assert not index.is_fresh(db)
+    index.builder.join()
+    assert index.catch_up(db)
+    assert index.locate(record['latitude'], record['longitude']) == [r_id]
+
+
+def test_open_batch_matches_with_sql(db, index):
+    generation = index.generation
+    db.begin_transaction()
+    record, r_id = new_restaurant(db, '9000002')
+    assert db.match_and_add_tweet(tweet(record, 't2'), index) == [r_id]
+    # Not rebuilt from the batch's uncommitted rows
+    assert index.generation == generation
@@ -0,0 +1,36 @@
+# Hot queries on the request and ingest paths must not fully scan a large
+# table, checked with the workload and plan collection of bench/query_plans.py
+import pytest
+
+from benchutil import open_db
+from query_plans import (HOT_QUERIES, PlanConnection, advise, partial_indexes,
+                         run_workload, table_sizes)
+from synthetic import Generator
+
+RESTAURANTS = 600
+TWEETS = 200
+LARGE_ROWS = 200
+
+
+@pytest.fixture(scope='module')
+def report(server_dir, tmp_path_factory):
+    db = open_db(str(tmp_path_factory.mktemp('plans') / 'plans.db'),
+                 factory=PlanConnection)
+    try:
+        run_workload(db, Generator(0), RESTAURANTS, TWEETS)
+        return advise(db.conn.plans, table_sizes(db), partial_indexes(db),
+                      LARGE_ROWS)
+    finally:
+        db.conn.close()
+
+
+def test_workload_runs_every_hot_query(report):
+    assert set(HOT_QUERIES) <= {entry['function'] for entry in report}
+
+
+@pytest.mark.parametrize('function', HOT_QUERIES)
+def test_hot_query_scans_no_large_table(report, function):
+    scans = [(entry['statement'], entry['large_table_scans'])
+             for entry in report
+             if entry['function'] == function and entry['large_table_scans']]
+    assert scans == []
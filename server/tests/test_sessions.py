@@ -0,0 +1,140 @@
+# Transaction sessions commit independently, abort only their own writes,
+# fail bad records alone, and wait for a global /txn batch to end
+import json
+from argparse import Namespace
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import loader
+from benchutil import open_db, start_server, stop_server
+from cache import ResponseCache
+from sessions import SessionManager
+from synthetic import Generator
+
+
+@pytest.fixture
+def db(server_dir, tmp_path):
+    db = open_db(str(tmp_path / 'insp.db'))
+    yield db
+    db.conn.close()
+
+
+@pytest.fixture
+def manager():
+    return SessionManager(ResponseCache(), group_size=1000, group_delay=60)
+
+
+@pytest.fixture
+def server(tmp_path):
+    proc, base = start_server(str(tmp_path / 'server'))
+    try:
+        assert requests.get(base + '/create').ok
+        yield base
+    finally:
+        stop_server(proc)
+
+
+def records(n, seed=0):
+    return list(Generator(seed).records(n))
+
+
+def committed(db, batch):
+    return [bool(db.find_inspection(record['inspection_id']))
+            for record in batch]
+
+
+def test_interleaved_sessions_commit_independently(db, manager):
+    a, b = manager.open(size=10), manager.open(size=10)
+    batch = records(6)
+    for first, second in zip(batch[0::2], batch[1::2]):
+        manager.add(db, a, first)
+        manager.add(db, b, second)
+    results = manager.commit_session(db, a)
+    assert [r['inspection_id'] for r in results] == [
+        r['inspection_id'] for r in batch[0::2]]
+    assert committed(db, batch) == [True, False] * 3
+    assert len(manager.commit_session(db, b)) == 3
+    assert committed(db, batch) == [True] * 6
+
+
+def test_abort_before_group_commit(db, manager):
+    a, b = manager.open(size=2), manager.open(size=2)
+    batch = records(4)
+    for record in batch[:2]:
+        manager.add(db, a, record)
+    for record in batch[2:]:
+        manager.add(db, b, record)
+    # Both batches were flushed and wait for the group commit
+    assert manager.ready_records == 4
+    assert manager.abort_session(a) == 2
+    assert len(manager.commit_session(db, b)) == 2
+    assert committed(db, batch) == [False, False, True, True]
+    assert manager.commit_session(db, a) == []
+
+
+def test_failing_record_rolls_back_alone(db, manager):
+    session = manager.open(size=10)
+    batch = records(3)
+    bad = dict(records(1, seed=1)[0], inspection_id='9000001',
+               name='Brand New Diner')
+    # The restaurant is written before the missing field fails the inspection
+    del bad['results']
+    for record in (batch[0], bad, batch[1], batch[2]):
+        manager.add(db, session, record)
+    results = manager.commit_session(db, session)
+    assert [r['status'] for r in results] == [201, 400, 201, 201]
+    assert committed(db, batch) == [True] * 3
+    assert not committed(db, [bad])[0]
+    assert not db.check_restaurant(bad)
+
+
+def test_global_batch_holds_group_commit(db, manager):
+    session = manager.open(size=10)
+    batch = records(2)
+    db.begin_transaction()
+    db.add_inspection_for_restaurant(batch[0])
+    manager.add(db, session, batch[1])
+    assert manager.commit_session(db, session) is None
+    db.rollback_active()
+    # The global abort did not touch the session's batch
+    assert len(manager.commit_session(db, session)) == 1
+    assert committed(db, batch) == [False, True]
+
+
+def open_global_batch(base, record):
+    assert requests.get(base + '/txn/100').ok
+    assert requests.post(base + '/inspections', json=record).ok
+
+
+def test_session_commit_conflicts_with_global_batch(server):
+    batch = records(2)
+    open_global_batch(server, batch[0])
+    token = requests.post(server + '/txn').json()['token']
+    requests.post(server + '/inspections?txn=' + token, json=batch[1])
+    assert requests.post(server + '/txn/%s/commit' % token).status_code == 409
+    assert requests.get(server + '/commit').ok
+    results = requests.post(server + '/txn/%s/commit' % token).json()['results']
+    assert [r['inspection_id'] for r in results] == [batch[1]['inspection_id']]
+    assert requests.get(server + '/count').text == '2'
+
+
+def test_loader_retries_session_commit(server, tmp_path, monkeypatch):
+    batch = records(5)
+    open_global_batch(server, batch[0])
+    data = tmp_path / 'inspections.json'
+    data.write_text(json.dumps(batch[1:]))
+    waits = []
+
+    def sleep(seconds):
+        # The loader backs off after a 409; end the global batch meanwhile
+        waits.append(seconds)
+        if len(waits) == 1:
+            assert requests.get(server + '/commit').ok
+    monkeypatch.setattr(loader, 'time', SimpleNamespace(sleep=sleep))
+    loader.run_loader(Namespace(file=str(data), server='localhost',
+                                port=int(server.rsplit(':', 1)[1]),
+                                single=False, session=2))
+    assert len(waits) == 1
+    assert requests.get(server + '/count').text == '5'
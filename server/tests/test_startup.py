@@ -0,0 +1,53 @@
+# Importing server.py must stay within the import time budget, and leave the
+# cleaning, matching and profiling modules to be loaded on first use, which
+# is not an ingest
+import json
+import subprocess
+import sys
+
+from startup import IMPORT_BUDGET_MS, LAZY_MODULES, import_times
+from synthetic import Generator
+
+# Imports timed; the fastest counts, as the others include machine noise
+IMPORT_RUNS = 5
+IMPORT_SERVER = '''
+import json, sys
+import server
+print(json.dumps(sorted(sys.modules)))
+'''
+INGEST = '''
+import json, sqlite3, sys
+import server
+from db import DB
+db = DB(sqlite3.connect(':memory:'))
+db.create_script()
+db.add_inspection_for_restaurant(json.loads(sys.argv[1]))
+print(json.dumps(sorted(sys.modules)))
+'''
+
+
+def lazy_modules_loaded(server_dir, code, *args):
+    proc = subprocess.run([sys.executable, '-c', code] + list(args),
+                          cwd=server_dir, capture_output=True, text=True,
+                          check=True)
+    loaded = set(json.loads(proc.stdout.splitlines()[-1]))
+    return sorted(loaded.intersection(LAZY_MODULES))
+
+
+def test_lazy_modules_include_cleaning_and_profiling():
+    assert {'clean_restaurants', 'jellyfish', 'profiling'} <= set(LAZY_MODULES)
+
+
+def test_import_server_loads_no_lazy_modules(server_dir):
+    assert lazy_modules_loaded(server_dir, IMPORT_SERVER) == []
+
+
+def test_ingest_loads_no_lazy_modules(server_dir):
+    record = next(Generator(0).records(1))
+    assert lazy_modules_loaded(server_dir, INGEST, json.dumps(record)) == []
+
+
+def test_import_server_within_budget():
+    own_ms = min(server_ms - bottle_ms for server_ms, bottle_ms, _ in
+                 (import_times() for _ in range(IMPORT_RUNS)))
+    assert own_ms <= IMPORT_BUDGET_MS